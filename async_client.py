@@ -0,0 +1,350 @@
+"""
+Idler runs using asyncio (see `ASYNC_CLIENT`), rather than the synchronous
+Kubernetes client.
+
+The pods, pod metrics and deployments are listed at the same time, and then
+the apps to idle are idled up to `IDLE_CONCURRENCY` namespaces at the same
+time (like with threads), sharing up to `API_POOL_SIZE` connections to the
+API server. A run then takes about as long as the slowest LIST, plus the time
+to idle the apps.
+
+Responses are deserialized into the Kubernetes client's models, so apps are
+evaluated by the idler's usual logic. Requires aiohttp.
+"""
+
+import asyncio
+from collections import OrderedDict
+import json
+import logging
+import random
+import ssl
+from types import SimpleNamespace
+from urllib.parse import quote
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import idler
+import records
+import snapshot
+
+
+log = logging.getLogger('idler.async_client')
+
+PODS_PATH = idler.PODS_PATH
+POD_METRICS_PATH = idler.POD_METRICS_PATH
+DEPLOYMENTS_PATH = idler.DEPLOYMENTS_PATH
+SERVICE_PATH = idler.SERVICE_PATH
+# apply patches go through `idler.DEPLOYMENT_PATH` (apps/v1)
+V1BETA1_DEPLOYMENT_PATH = '/apis/apps/v1beta1/namespaces/{namespace}/deployments/{name}'
+
+JSON_PATCH = 'application/json-patch+json'
+STRATEGIC_MERGE_PATCH = 'application/strategic-merge-patch+json'
+MERGE_PATCH = 'application/merge-patch+json'
+APPLY_PATCH = 'application/apply-patch+yaml'
+
+
+def ssl_context(configuration):
+    if not configuration.verify_ssl:
+        return False
+
+    context = ssl.create_default_context(cafile=configuration.ssl_ca_cert)
+    if configuration.cert_file:
+        context.load_cert_chain(configuration.cert_file, configuration.key_file)
+    return context
+
+
+class AsyncApi(object):
+    """
+    Minimal asyncio client for the Kubernetes API calls made by the idler.
+    """
+
+    def __init__(self, session, configuration):
+        self.session = session
+        self.host = configuration.host.rstrip('/')
+        self.ssl = ssl_context(configuration)
+        self.headers = {'Accept': 'application/json'}
+        token = configuration.get_api_key_with_prefix('authorization')
+        if token:
+            self.headers['Authorization'] = token
+
+    async def request(self, method, path, path_params=None, params=None,
+                      body=None, content_type=None, response_type=None, record=None):
+        """
+        Makes an API request, retried like `idler.with_retries()`, and
+        returns its response deserialized as `response_type` (if given), or
+        as a list of `record`s (if given).
+        """
+        url = self.host + path.format(**{
+            name: quote(str(value), safe='')
+            for name, value in (path_params or {}).items()
+        })
+        headers = dict(self.headers)
+        data = None
+        if body is not None:
+            headers['Content-Type'] = content_type
+            data = json.dumps(body)
+
+        for attempt in range(idler.MAX_RETRIES + 1):
+            try:
+                with idler.API_REQUEST_DURATION.time(method=method, path=path):
+                    text = await self.send(method, url, params, data, headers)
+                break
+            except ApiException as e:
+                if e.status not in idler.RETRY_STATUSES or attempt == idler.MAX_RETRIES:
+                    raise
+
+                delay = idler.retry_after(e)
+                if delay is None:
+                    delay = idler.RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1)
+
+                log.debug(f'API call failed with {e.status} {e.reason}, retrying in {delay:.2f}s.')
+                await asyncio.sleep(delay)
+
+        if record is not None:
+            return records.decode_list(text, record)
+        if response_type is None:
+            return None
+        return idler.api_client().deserialize(SimpleNamespace(data=text), response_type)
+
+    async def send(self, method, url, params, data, headers):
+        async with self.session.request(
+                method, url, params=params, data=data, headers=headers,
+                ssl=self.ssl) as response:
+            text = await response.text()
+            if response.status >= 400:
+                e = ApiException(status=response.status, reason=response.reason)
+                e.body = text
+                e.headers = response.headers
+                raise e
+            return text
+
+    async def list_all(self, path, response_type, record, label_selector):
+        """
+        Returns all the items of the given list, a page at a time when
+        `PAGE_SIZE` is set.
+        """
+        params = {}
+        if label_selector:
+            params['labelSelector'] = label_selector
+        if idler.PAGE_SIZE:
+            params['limit'] = str(idler.PAGE_SIZE)
+
+        items = []
+        while True:
+            if idler.FAST_DECODE:
+                page = await self.request('GET', path, params=params, record=record)
+            else:
+                page = await self.request('GET', path, params=params, response_type=response_type)
+            items.extend(page.items or [])
+            _continue = page.metadata._continue if page.metadata else None
+            if not _continue:
+                return items
+            params['continue'] = _continue
+
+    async def idle(self, deployment):
+        """
+        Idles the given deployment, like `idler.idle()`.
+        """
+        key = idler.get_key(deployment)
+        app = {'name': deployment.metadata.name, 'namespace': deployment.metadata.namespace}
+
+        service = await self.request('GET', SERVICE_PATH, app, response_type='V1Service')
+
+        try:
+            await self.patch_service(app, service)
+            log.debug(f'{key}: Service pointed to unidler (set ServiceType to ExternalName, etc).')
+
+            await self.scale_to_zero(app, deployment.spec.replicas)
+        except Exception as e:
+            log.error(f'{key}: Failed to idle, pointing service back to the app: {e}')
+            try:
+                service.metadata.resource_version = None
+                service.spec.cluster_ip = None
+                await self.request(
+                    'PUT', SERVICE_PATH, app,
+                    body=idler.api_client().sanitize_for_serialization(service),
+                    content_type='application/json',
+                )
+            except Exception as restore_error:
+                log.error(f'{key}: Failed to point service back to the app: {restore_error}')
+            raise
+
+        log.debug(f'{key}: Deployment idled: Set replicas to 0, added labels and annotations.')
+
+    async def patch_service(self, app, service):
+        """
+        Points the app service (as previously read) to the unidler, like
+        `idler.App.redirect_to_unidler()`.
+        """
+        if idler.PATCH_MODE == 'apply':
+            json_patch = idler.unidler_service_json_patch(service)
+            if json_patch:
+                await self.request(
+                    'PATCH', SERVICE_PATH, app, body=json_patch, content_type=JSON_PATCH)
+            await self.apply(
+                SERVICE_PATH, app, idler.unidler_service_manifest(app['name'], app['namespace']))
+            return
+
+        await self.request(
+            'PATCH', SERVICE_PATH, app,
+            body=idler.unidler_service_patch(), content_type=STRATEGIC_MERGE_PATCH)
+
+    async def scale_to_zero(self, app, replicas_when_unidled):
+        patch = idler.idled_deployment_patch(replicas_when_unidled)
+
+        if idler.PATCH_MODE == 'apply':
+            await self.apply(
+                idler.DEPLOYMENT_PATH, app,
+                idler.manifest("apps/v1", "Deployment", app['name'], app['namespace'], patch))
+        elif idler.PATCH_MODE == 'scale':
+            await self.request(
+                'PATCH', V1BETA1_DEPLOYMENT_PATH, app,
+                body={"metadata": patch["metadata"]}, content_type=MERGE_PATCH)
+            try:
+                await self.request(
+                    'PATCH', V1BETA1_DEPLOYMENT_PATH + '/scale', app,
+                    body={"spec": {"replicas": 0}}, content_type=MERGE_PATCH)
+            except Exception:
+                try:
+                    await self.request(
+                        'PATCH', V1BETA1_DEPLOYMENT_PATH, app,
+                        body={"metadata": {"labels": {idler.IDLED: None}}},
+                        content_type=MERGE_PATCH)
+                except Exception as e:
+                    log.error(f"({app['name']}, {app['namespace']}): Failed to remove {idler.IDLED} label: {e}")
+                raise
+        else:
+            await self.request(
+                'PATCH', V1BETA1_DEPLOYMENT_PATH, app, body=patch, content_type=STRATEGIC_MERGE_PATCH)
+
+    async def apply(self, path, app, body):
+        await self.request(
+            'PATCH', path, app,
+            params={'fieldManager': idler.FIELD_MANAGER, 'force': 'true'},
+            body=body, content_type=APPLY_PATCH)
+
+
+def run():
+    """
+    Idles the deployments which should be idled.
+
+    Returns the list of deployments which failed to idle.
+    """
+    if aiohttp is None:
+        raise RuntimeError('aiohttp is required by ASYNC_CLIENT')
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(sweep(client.Configuration()))
+    finally:
+        loop.close()
+
+
+async def sweep(configuration):
+    connector = aiohttp.TCPConnector(limit=idler.API_POOL_SIZE)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        api = AsyncApi(session, configuration)
+
+        with idler.PHASE_DURATION.time(phase='list'):
+            pods, pods_metrics, deployments = await asyncio.gather(
+                api.list_all(PODS_PATH, 'V1PodList', records.Pod, idler.LABEL_SELECTOR),
+                api.list_all(
+                    POD_METRICS_PATH, 'MetricsV1beta1PodMetricsList', records.PodMetrics,
+                    idler.LABEL_SELECTOR),
+                api.list_all(
+                    DEPLOYMENTS_PATH, 'AppsV1beta1DeploymentList', records.Deployment,
+                    idler.eligible_selector()),
+            )
+
+        deployments = build_lookups(pods, pods_metrics, deployments)
+
+        with idler.PHASE_DURATION.time(phase='idle'):
+            if idler.DRY_RUN:
+                return idler.process(deployments)
+
+            if idler.WARMUP_SECONDS:
+                idler.build_pod_starts_lookup()
+
+            selected, failed = idler.select(deployments)
+            results = await idle_all(api, selected)
+
+    for deployment, result in zip(selected, results):
+        if result is not None:
+            deploy_id = f"({deployment.metadata.namespace}, {deployment.metadata.name})"
+            log.error(f"Failed to idle {deploy_id} deployment: {result}")
+            failed.append(deploy_id)
+            idler.DEPLOYMENTS.inc(result='failed')
+        else:
+            idler.DEPLOYMENTS.inc(result='idled')
+
+    return failed
+
+
+async def idle_all(api, deployments):
+    """
+    Idles the given deployments like `idler.idle_concurrently()`: up to
+    `IDLE_CONCURRENCY` namespaces at the same time, and the deployments
+    within a namespace one at a time, in order.
+
+    Returns the exception each deployment failed to idle with (`None` if it
+    was idled), in order.
+    """
+    by_namespace = OrderedDict()
+    for deployment in deployments:
+        by_namespace.setdefault(deployment.metadata.namespace, []).append(deployment)
+
+    semaphore = asyncio.Semaphore(idler.IDLE_CONCURRENCY)
+    errors = {}
+
+    async def idle_namespace(namespace_deployments):
+        async with semaphore:
+            for deployment in namespace_deployments:
+                try:
+                    await api.idle(deployment)
+                except Exception as e:
+                    errors[id(deployment)] = e
+
+    await asyncio.gather(*(
+        idle_namespace(namespace_deployments)
+        for namespace_deployments in by_namespace.values()
+    ))
+    return [errors.get(id(deployment)) for deployment in deployments]
+
+
+def build_lookups(pods, pods_metrics, deployments):
+    """
+    Builds the lookups from the given lists and returns the deployments, of
+    this idler's shard only (see `SHARD_COUNT`).
+    """
+    pods = list(idler.sharded(pods))
+    pods_metrics = list(idler.sharded(pods_metrics))
+    deployments = list(idler.sharded(deployments))
+
+    recorder = idler.recorder
+    if recorder is not None:
+        for kind, objs in [
+                (snapshot.POD, pods),
+                (snapshot.POD_METRICS, pods_metrics),
+                (snapshot.DEPLOYMENT, deployments)]:
+            for obj in objs:
+                recorder.record(kind, obj)
+
+    for pod in pods:
+        idler.add_pod(pod)
+    for pod_metrics in pods_metrics:
+        idler.add_pod_metrics(pod_metrics)
+
+    log.debug(
+        f'{len(pods)} pods, {len(pods_metrics)} metrics and {len(deployments)} '
+        f'eligible deployments found.')
+
+    if idler.CPU_HISTORY_FILE:
+        idler.record_cpu_history()
+
+    return deployments
@@ -0,0 +1,108 @@
+"""
+Benchmarks decoding list responses into the Kubernetes client's models, into
+compact records (see `FAST_DECODE`) and from protobuf (see `PROTOBUF`).
+
+Usage:
+
+    python -m benchmark.decode [--items 1000 10000] [--json]
+
+For each list (pods, pod metrics and deployments) of the stub cluster and
+each decoder it reports the size of the response, the decoding time and the
+memory held by the decoded list.
+"""
+
+import argparse
+import gc
+import json
+import sys
+import time
+from types import SimpleNamespace
+import tracemalloc
+
+from kubernetes.client import ApiClient
+
+from benchmark import fake_apiserver
+import metrics_api  # noqa: F401 (registers the metrics models)
+import protobuf
+import records
+
+
+LISTS = {
+    'pods': ('V1PodList', records.Pod),
+    'metrics': ('MetricsV1beta1PodMetricsList', records.PodMetrics),
+    'deployments': ('AppsV1beta1DeploymentList', records.Deployment),
+}
+
+
+def measure(decode, data):
+    gc.collect()
+    started = time.perf_counter()
+    decode(data)
+    elapsed = time.perf_counter() - started
+
+    # measured separately, as tracing allocations slows decoding down
+    gc.collect()
+    tracemalloc.start()
+    decoded = decode(data)
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del decoded
+    return {'time': elapsed, 'memory': held}
+
+
+DECODERS = ('models', 'records', 'protobuf')
+
+
+def benchmark(items):
+    cluster = fake_apiserver.Cluster(items)
+    api_client = ApiClient()
+
+    results = []
+    for kind, (response_type, record) in LISTS.items():
+        body = cluster.list(kind, {})
+        data = json.dumps(body).encode('utf-8')
+        encoded = fake_apiserver.encode_list(kind, body)
+
+        models = measure(
+            lambda data: api_client.deserialize(SimpleNamespace(data=data), response_type),
+            data)
+        compact = measure(lambda data: records.decode_list(data, record), data)
+        wire = measure(lambda data: protobuf.decode_list(data, record), encoded)
+        models['bytes'] = compact['bytes'] = len(data)
+        wire['bytes'] = len(encoded)
+        results.append({
+            'items': items, 'list': kind, 'models': models, 'records': compact, 'protobuf': wire,
+        })
+    return results
+
+
+def report(results):
+    header = ''.join(f'{decoder:>30}' for decoder in DECODERS)
+    print(f"{'items':>8} {'list':<12}{header}")
+    for result in results:
+        columns = ''.join(
+            f"{result[decoder]['bytes'] / 2**20:6.1f} MiB {result[decoder]['time']:6.3f}s "
+            f"{result[decoder]['memory'] / 2**20:6.1f} MiB"
+            for decoder in DECODERS
+        )
+        print(f"{result['items']:>8} {result['list']:<12}{columns}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        '--items', type=int, nargs='+', default=[1000, 10000],
+        help='list sizes to benchmark')
+    parser.add_argument(
+        '--json', action='store_true', help='output results as JSON')
+    args = parser.parse_args(argv)
+
+    results = [result for items in args.items for result in benchmark(items)]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    main()
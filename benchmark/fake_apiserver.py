@@ -0,0 +1,447 @@
+"""
+Stub Kubernetes API server serving a synthetic cluster.
+
+The cluster has one idleable app (a deployment, its pod and service) in each
+of `apps` user namespaces. Every other app is busy (using 95% of its CPU
+limit), the others are idle. It serves the LIST calls (with `limit`/`continue`
+paging, as `PartialObjectMetadataList` and in protobuf when asked to) and
+accepts the calls `App` makes to idle an app, counting every request it
+receives.
+"""
+
+from bisect import bisect_left
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+import json
+import re
+import threading
+from urllib.parse import parse_qs, urlparse
+
+
+IDLED = 'mojanalytics.xyz/idled'
+IDLEABLE = 'mojanalytics.xyz/idleable'
+
+SERVICE_PATH = re.compile(r'^/api/v1/namespaces/([^/]+)/services/([^/]+)$')
+DEPLOYMENT_PATH = re.compile(
+    r'^/apis/apps/v1(?:beta1)?/namespaces/([^/]+)/deployments/([^/]+)(?:/scale)?$')
+
+CREATED = '2019-01-01T00:00:00Z'
+
+
+class Cluster(object):
+
+    def __init__(self, apps):
+        self.apps = apps
+        self.idled = set()
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        # the API server lists objects in the order of their namespace (and
+        # name), e.g. `user-10` before `user-2`
+        self.order = sorted(range(apps), key=self.namespace)
+        self.namespaces = [self.namespace(i) for i in self.order]
+
+    def namespace(self, i):
+        return f'user-{i}'
+
+    def labels(self, i):
+        return {'app': 'rstudio', IDLEABLE: 'true'}
+
+    def pod(self, i):
+        return {
+            'metadata': {
+                'name': f'rstudio-5d8c9b7f4-{i:05d}',
+                'namespace': self.namespace(i),
+                'labels': dict(self.labels(i), **{'pod-template-hash': '5d8c9b7f4'}),
+                'resourceVersion': '1',
+                'creationTimestamp': CREATED,
+                'ownerReferences': [{
+                    'apiVersion': 'apps/v1',
+                    'kind': 'ReplicaSet',
+                    'name': 'rstudio-5d8c9b7f4',
+                    'uid': f'rs-{i}',
+                    'controller': True,
+                }],
+            },
+            'spec': {
+                'nodeName': f'node-{i % 50}',
+                'containers': [{
+                    'name': 'rstudio',
+                    'image': 'rstudio',
+                    'resources': {
+                        'limits': {'cpu': '1500m', 'memory': '12Gi'},
+                        'requests': {'cpu': '200m', 'memory': '5Gi'},
+                    },
+                }],
+            },
+            'status': {
+                'phase': 'Running',
+                'startTime': CREATED,
+            },
+        }
+
+    def pod_metrics(self, i):
+        busy = i % 2 == 0
+        return {
+            'metadata': {
+                'name': f'rstudio-5d8c9b7f4-{i:05d}',
+                'namespace': self.namespace(i),
+                'labels': self.labels(i),
+                'creationTimestamp': CREATED,
+            },
+            'timestamp': CREATED,
+            'window': '30s',
+            'containers': [{
+                'name': 'rstudio',
+                'usage': {
+                    'cpu': '1425000000n' if busy else '1500000n',
+                    'memory': '3145728Ki',
+                },
+            }],
+        }
+
+    def deployment(self, i):
+        return {
+            'metadata': {
+                'name': 'rstudio',
+                'namespace': self.namespace(i),
+                'labels': self.labels(i),
+                'resourceVersion': '1',
+                'creationTimestamp': CREATED,
+            },
+            'spec': {
+                'replicas': 1,
+                'selector': {'matchLabels': {'app': 'rstudio'}},
+                'template': {
+                    'metadata': {'labels': self.labels(i)},
+                    'spec': self.pod(i)['spec'],
+                },
+            },
+            'status': {'replicas': 1, 'availableReplicas': 1},
+        }
+
+    def service(self, i):
+        return {
+            'metadata': {
+                'name': 'rstudio',
+                'namespace': self.namespace(i),
+                'resourceVersion': '1',
+            },
+            'spec': {
+                'type': 'ClusterIP',
+                'clusterIP': '10.0.0.1',
+                'selector': {'app': 'rstudio'},
+                'ports': [{'name': 'http', 'port': 80, 'targetPort': 8787, 'protocol': 'TCP'}],
+            },
+        }
+
+    def index(self, namespace):
+        return int(namespace[len('user-'):])
+
+    def items(self, kind, query, start=0):
+        indexes = islice(self.order, start, None)
+        if kind == 'deployments':
+            exclude_idled = f'!{IDLED}' in query.get('labelSelector', [''])[0]
+            return (
+                self.deployment(i) for i in indexes
+                if not (exclude_idled and i in self.idled)
+            )
+
+        build = self.pod if kind == 'pods' else self.pod_metrics
+        return (build(i) for i in indexes)
+
+    def list(self, kind, query, metadata_only=False):
+        limit = int(query.get('limit', ['0'])[0])
+        # like the API server's, the continue token is the key of the last
+        # item returned rather than an offset, so the items deleted (or no
+        # longer matching) meanwhile don't shift the following pages
+        _continue = query.get('continue', [None])[0]
+        if _continue:
+            start = bisect_left(self.namespaces, _continue.split('/', 1)[0])
+            items = (
+                item for item in self.items(kind, query, start)
+                if key(item) > _continue
+            )
+        else:
+            items = self.items(kind, query)
+
+        metadata = {'resourceVersion': '1'}
+        if limit:
+            items = list(islice(items, limit + 1))
+            if len(items) > limit:
+                items = items[:limit]
+                metadata['continue'] = key(items[-1])
+
+        if metadata_only:
+            return {
+                'kind': 'PartialObjectMetadataList',
+                'apiVersion': 'meta.k8s.io/v1',
+                'metadata': metadata,
+                'items': [
+                    {
+                        'kind': 'PartialObjectMetadata',
+                        'apiVersion': 'meta.k8s.io/v1',
+                        'metadata': item['metadata'],
+                    }
+                    for item in items
+                ],
+            }
+
+        return {'kind': 'List', 'apiVersion': 'v1', 'metadata': metadata, 'items': list(items)}
+
+
+def key(item):
+    metadata = item['metadata']
+    return f"{metadata['namespace']}/{metadata['name']}"
+
+
+# Kubernetes protobuf encoding of the objects above: field name -> (field
+# number, type), where the type is a scalar type, a message (dict), or a map
+# of scalars ('map', type)
+TIME = 'time'
+OBJECT_META = {
+    'name': (1, 'string'),
+    'namespace': (3, 'string'),
+    'resourceVersion': (6, 'string'),
+    'creationTimestamp': (8, TIME),
+    'labels': (11, ('map', 'string')),
+    'annotations': (12, ('map', 'string')),
+    'ownerReferences': (13, {
+        'kind': (1, 'string'),
+        'name': (3, 'string'),
+        'uid': (4, 'string'),
+        'apiVersion': (5, 'string'),
+        'controller': (6, 'bool'),
+    }),
+}
+POD_SPEC = {
+    'containers': (2, {
+        'name': (1, 'string'),
+        'image': (2, 'string'),
+        'resources': (8, {
+            'limits': (1, ('map', 'quantity')),
+            'requests': (2, ('map', 'quantity')),
+        }),
+    }),
+    'nodeName': (10, 'string'),
+}
+PROTOBUF_SCHEMAS = {
+    'pods': ('v1', 'PodList', {
+        'metadata': (1, OBJECT_META),
+        'spec': (2, POD_SPEC),
+        'status': (3, {
+            'phase': (1, 'string'),
+            'startTime': (7, TIME),
+        }),
+    }),
+    'metrics': ('metrics.k8s.io/v1beta1', 'PodMetricsList', {
+        'metadata': (1, OBJECT_META),
+        'timestamp': (2, TIME),
+        'window': (3, 'duration'),
+        'containers': (4, {
+            'name': (1, 'string'),
+            'usage': (2, ('map', 'quantity')),
+        }),
+    }),
+    'deployments': ('apps/v1beta1', 'DeploymentList', {
+        'metadata': (1, OBJECT_META),
+        'spec': (2, {
+            'replicas': (1, 'int'),
+            'selector': (2, {'matchLabels': (1, ('map', 'string'))}),
+            'template': (3, {
+                'metadata': (1, OBJECT_META),
+                'spec': (2, POD_SPEC),
+            }),
+        }),
+        'status': (3, {
+            'replicas': (2, 'int'),
+            'availableReplicas': (4, 'int'),
+        }),
+    }),
+}
+PARTIAL_OBJECT_METADATA = {'metadata': (1, OBJECT_META)}
+LIST_META = {
+    'resourceVersion': (2, 'string'),
+    'continue': (3, 'string'),
+}
+
+
+def encode_varint(value):
+    if value < 0:
+        value += 1 << 64
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def encode_field(number, wire_type, payload):
+    if wire_type == 0:
+        return encode_varint(number << 3) + encode_varint(payload)
+    return encode_varint(number << 3 | 2) + encode_varint(len(payload)) + payload
+
+
+def encode_value(number, field_type, value):
+    if isinstance(field_type, dict):
+        return encode_field(number, 2, encode_message(value, field_type))
+    if isinstance(field_type, tuple):
+        return b''.join(
+            encode_field(number, 2, encode_field(1, 2, key.encode('utf-8')) +
+                         encode_value(2, field_type[1], item))
+            for key, item in value.items()
+        )
+    if field_type in ('int', 'bool'):
+        return encode_field(number, 0, int(value))
+    if field_type == 'string':
+        return encode_field(number, 2, value.encode('utf-8'))
+    if field_type == 'quantity':
+        return encode_field(number, 2, encode_field(1, 2, value.encode('utf-8')))
+    if field_type == TIME:
+        when = datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+        return encode_field(number, 2, encode_field(1, 0, int(when.timestamp())))
+    if field_type == 'duration':
+        return encode_field(number, 2, encode_field(1, 0, int(float(value[:-1]) * 10**9)))
+    raise ValueError(f'Unknown field type {field_type}')
+
+
+def encode_message(obj, schema):
+    fields = []
+    for name, value in obj.items():
+        number, field_type = schema[name]
+        for item in (value if isinstance(value, list) else [value]):
+            fields.append(encode_value(number, field_type, item))
+    return b''.join(fields)
+
+
+def encode_list(kind, body):
+    """
+    Returns the given list response in the Kubernetes protobuf encoding.
+    """
+    api_version, list_kind, item_schema = PROTOBUF_SCHEMAS[kind]
+    if body['kind'] == 'PartialObjectMetadataList':
+        api_version, list_kind, item_schema = body['apiVersion'], body['kind'], PARTIAL_OBJECT_METADATA
+
+    fields = [encode_field(1, 2, encode_message(body['metadata'], LIST_META))]
+    for item in body['items']:
+        item = {name: value for name, value in item.items() if name in item_schema}
+        fields.append(encode_field(2, 2, encode_message(item, item_schema)))
+    raw = b''.join(fields)
+
+    type_meta = encode_field(1, 2, api_version.encode('utf-8')) + encode_field(2, 2, list_kind.encode('utf-8'))
+    return b'k8s\x00' + encode_field(1, 2, type_meta) + encode_field(2, 2, raw)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    LISTS = {
+        '/api/v1/pods': 'pods',
+        '/apis/metrics.k8s.io/v1beta1/pods': 'metrics',
+        '/apis/apps/v1beta1/deployments': 'deployments',
+    }
+
+    @property
+    def cluster(self):
+        return self.server.cluster
+
+    def count(self, route):
+        with self.cluster.lock:
+            self.cluster.requests[f'{self.command} {route}'] += 1
+
+    def respond(self, body, status=200, content_type='application/json'):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length)
+
+    def not_found(self):
+        self.respond({'kind': 'Status', 'code': 404}, status=404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path in self.LISTS:
+            kind = self.LISTS[url.path]
+            self.count(kind)
+            accept = self.headers.get('Accept', '')
+            metadata_only = 'as=PartialObjectMetadataList' in accept
+            body = self.cluster.list(kind, parse_qs(url.query), metadata_only)
+            if 'application/vnd.kubernetes.protobuf' in accept:
+                return self.respond(
+                    encode_list(kind, body), content_type='application/vnd.kubernetes.protobuf')
+            return self.respond(body)
+
+        match = SERVICE_PATH.match(url.path)
+        if match:
+            self.count('service')
+            return self.respond(self.cluster.service(self.cluster.index(match.group(1))))
+
+        match = DEPLOYMENT_PATH.match(url.path)
+        if match:
+            self.count('deployment')
+            return self.respond(self.cluster.deployment(self.cluster.index(match.group(1))))
+
+        self.not_found()
+
+    def do_PATCH(self):
+        url = urlparse(self.path)
+        self.read_body()
+
+        match = SERVICE_PATH.match(url.path)
+        if match:
+            self.count('service')
+            return self.respond(self.cluster.service(self.cluster.index(match.group(1))))
+
+        match = DEPLOYMENT_PATH.match(url.path)
+        if match:
+            self.count('deployment')
+            i = self.cluster.index(match.group(1))
+            with self.cluster.lock:
+                self.cluster.idled.add(i)
+            return self.respond(self.cluster.deployment(i))
+
+        self.not_found()
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        self.read_body()
+
+        match = SERVICE_PATH.match(url.path)
+        if match:
+            self.count('service')
+            return self.respond(self.cluster.service(self.cluster.index(match.group(1))))
+
+        self.not_found()
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(apps, host='127.0.0.1', port=0):
+    """
+    Starts serving a synthetic cluster with the given number of apps in a
+    background thread.
+
+    Returns the server; `server.cluster` gives access to the cluster state and
+    request counts.
+    """
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.cluster = Cluster(apps)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def url(server):
+    host, port = server.server_address
+    return f'http://{host}:{port}'
@@ -0,0 +1,136 @@
+"""
+Benchmarks `idle_deployments` against a stub API server.
+
+Usage:
+
+    python -m benchmark.run [--apps 100 1000 10000] [--json]
+
+For each cluster size the idler runs in its own process (so its peak RSS
+isn't mixed up with the stub server's or with the other runs') and the wall
+time, peak RSS, number of API requests, time spent in each phase and mean
+API request latency are reported.
+
+The idler's configuration environment variables (e.g. `PAGE_SIZE` or
+`IDLE_CONCURRENCY`) are passed through, so configurations can be compared.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from benchmark import fake_apiserver
+
+
+def run_idler(url):
+    """
+    Runs `idle_deployments` against the API server at the given URL and
+    returns its measurements.
+    """
+    from kubernetes import client
+
+    import idler
+
+    configuration = client.Configuration()
+    configuration.host = url
+    client.Configuration.set_default(configuration)
+
+    started = time.perf_counter()
+    try:
+        idler.idle_deployments()
+    except SystemExit:
+        pass
+    wall_time = time.perf_counter() - started
+
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    phases = {
+        labels[0][1]: seconds
+        for _, labels, seconds in idler.PHASE_DURATION.samples()
+    }
+
+    api_latency = {}
+    for name, labels, value in idler.API_REQUEST_DURATION.samples():
+        request = ' '.join(value for _, value in labels)
+        if name.endswith('_sum'):
+            api_latency.setdefault(request, {})['total'] = value
+        elif name.endswith('_count'):
+            api_latency.setdefault(request, {})['count'] = value
+
+    return {
+        'wall_time': wall_time,
+        'peak_rss': peak_rss,
+        'phases': phases,
+        'api_latency': {
+            request: latency['total'] / latency['count']
+            for request, latency in api_latency.items()
+        },
+    }
+
+
+def benchmark(apps):
+    server = fake_apiserver.serve(apps)
+    try:
+        env = dict(os.environ)
+        env.setdefault('LOG_LEVEL', 'WARNING')
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmark.run', '--child', fake_apiserver.url(server)],
+            env=env,
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+        result = json.loads(output)
+        result['apps'] = apps
+        result['idled'] = len(server.cluster.idled)
+        result['requests'] = dict(server.cluster.requests)
+        return result
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def report(results):
+    for result in results:
+        requests = result['requests']
+        print(f"{result['apps']} apps:")
+        print(f"  wall time     {result['wall_time']:.3f}s")
+        print(f"  peak RSS      {result['peak_rss'] / 2**20:.1f} MiB")
+        print(f"  requests      {sum(requests.values())}")
+        for route, count in sorted(requests.items()):
+            print(f"    {route:<24}{count}")
+        print(f"  idled         {result['idled']}")
+        print("  phases")
+        for name, seconds in result['phases'].items():
+            print(f"    {name:<24}{seconds:.3f}s")
+        print("  mean API latency")
+        for request, seconds in sorted(result['api_latency'].items()):
+            print(f"    {request:<70}{seconds * 1000:.2f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        '--apps', type=int, nargs='+', default=[100, 1000, 10000],
+        help='cluster sizes (number of apps) to benchmark')
+    parser.add_argument(
+        '--json', action='store_true', help='output results as JSON')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        json.dump(run_idler(args.child), sys.stdout)
+        return
+
+    results = [benchmark(apps) for apps in args.apps]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Business hours calendars, to leave apps alone while people are working on
+them and idle them overnight, at weekends and on holidays.
+
+Calendars are defined in the policy file (see `policies.py`), e.g.:
+
+    calendars:
+      london:
+        timezone: Europe/London
+        workdays: [mon, tue, wed, thu, fri]
+        hours: '08:00-19:00'
+        holidays: ['2019-12-25', '2019-12-26']
+"""
+
+from datetime import date
+import re
+
+from dateutil import tz
+
+
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+TIME_RANGE = re.compile(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$')
+
+FIELDS = {'timezone', 'workdays', 'hours', 'holidays'}
+
+
+def parse_time_range(time_range):
+    """
+    Returns the given `HH:MM-HH:MM` range as minutes since midnight.
+    """
+    match = TIME_RANGE.match(str(time_range).strip())
+    if not match:
+        raise ValueError(f'Invalid time range "{time_range}", expected HH:MM-HH:MM')
+
+    start_hour, start_minute, end_hour, end_minute = map(int, match.groups())
+    if max(start_hour, end_hour) > 24 or max(start_minute, end_minute) > 59:
+        raise ValueError(f'Invalid time range "{time_range}"')
+
+    return start_hour * 60 + start_minute, end_hour * 60 + end_minute
+
+
+def in_time_range(when, time_range):
+    """
+    Returns whether the time of `when` is in the given range (as returned by
+    `parse_time_range`). Ranges ending before they start span midnight.
+    """
+    start, end = time_range
+    minute = when.hour * 60 + when.minute
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+class Calendar(object):
+
+    def __init__(self, timezone='UTC', workdays=WEEKDAYS[:5], hours='09:00-18:00', holidays=()):
+        self.timezone = tz.gettz(timezone)
+        if self.timezone is None:
+            raise ValueError(f'Unknown timezone "{timezone}"')
+
+        self.workdays = set()
+        for day in workdays:
+            try:
+                self.workdays.add(WEEKDAYS.index(str(day).strip().lower()[:3]))
+            except ValueError:
+                raise ValueError(f'Invalid workday "{day}"')
+
+        self.hours = parse_time_range(hours)
+
+        # YAML parses unquoted dates itself
+        self.holidays = {
+            holiday if isinstance(holiday, date) else date.fromisoformat(str(holiday))
+            for holiday in holidays
+        }
+
+    def is_business_time(self, when):
+        """
+        Returns whether the given (timezone aware) time is during business
+        hours, in the calendar's timezone.
+        """
+        local = when.astimezone(self.timezone)
+        if local.date() in self.holidays:
+            return False
+        if local.weekday() not in self.workdays:
+            return False
+        return in_time_range(local, self.hours)
+
+
+def parse(spec):
+    """
+    Returns the calendar described by the given (parsed) mapping.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('expected a mapping')
+
+    unknown = set(spec) - FIELDS
+    if unknown:
+        raise ValueError(f'unknown fields {", ".join(sorted(unknown))}')
+
+    return Calendar(**spec)
@@ -0,0 +1,218 @@
+"""
+Runs the idler as a long running controller instead of a one-off job.
+
+Pods and eligible deployments are kept in a local cache which is populated by
+a single LIST and then kept up to date by watching the API server (resuming
+from the last seen `resourceVersion`, with bookmarks enabled). Every
+`IDLE_INTERVAL` seconds the cached deployments are evaluated with the same
+`should_idle` logic used by the one-off run.
+
+Pod metrics can't be watched, so they're still listed on every evaluation.
+"""
+
+import os
+import threading
+import time
+
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+
+import idler
+from idler import log
+
+
+IDLE_INTERVAL = 300
+try:
+    IDLE_INTERVAL = int(os.environ.get('IDLE_INTERVAL', IDLE_INTERVAL))
+    log.debug(f'IDLE_INTERVAL={IDLE_INTERVAL}s')
+except ValueError:
+    log.warning(
+        f'Invalid value for IDLE_INTERVAL, using default ({IDLE_INTERVAL}s)')
+
+# How long a single watch request is kept open before it's renewed
+WATCH_TIMEOUT = 600
+
+HTTP_GONE = 410
+
+
+class Cache(object):
+    """
+    Local copy of the objects returned by a `list_*` API call.
+
+    `sync()` (re)lists the objects, `watch()` applies the changes streamed by
+    the API server until stopped, relisting when the watch fails (e.g. when
+    the `resourceVersion` it's watching from is too old).
+    """
+
+    def __init__(self, name, list_fn, key, items=None, project=None, keep=None, **kwargs):
+        self.name = name
+        self.list_fn = list_fn
+        self.key = key
+        # what's cached of each object, the whole object by default
+        self.project = project or (lambda obj: obj)
+        # which objects are cached, all of them by default
+        self.keep = keep or (lambda obj: True)
+        self.items = {} if items is None else items
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.resource_version = None
+        self._watch = None
+
+    def sync(self):
+        items = {}
+        for page in idler.list_pages(self.list_fn, **self.kwargs):
+            for item in page.items:
+                if self.keep(item):
+                    items[self.key(item)] = self.project(item)
+            resource_version = page.metadata.resource_version
+
+        with self.lock:
+            self.items.clear()
+            self.items.update(items)
+            self.resource_version = resource_version
+
+        log.debug(f'{self.name}: {len(items)} cached at resourceVersion {resource_version}.')
+
+    def apply(self, event):
+        event_type = event['type']
+
+        if event_type == 'ERROR':
+            raw = event['raw_object']
+            raise ApiException(status=raw.get('code'), reason=raw.get('message'))
+
+        obj = event['object']
+        with self.lock:
+            if event_type in ('ADDED', 'MODIFIED'):
+                if self.keep(obj):
+                    self.items[self.key(obj)] = self.project(obj)
+            elif event_type == 'DELETED':
+                self.items.pop(self.key(obj), None)
+            # BOOKMARK events only move the resourceVersion forward
+            self.resource_version = obj.metadata.resource_version
+
+    def watch(self):
+        while self._watch is not None:
+            try:
+                if self.resource_version is None:
+                    self.sync()
+
+                stream = self._watch.stream(
+                    self.list_fn,
+                    resource_version=self.resource_version,
+                    allow_watch_bookmarks=True,
+                    timeout_seconds=WATCH_TIMEOUT,
+                    **self.kwargs,
+                )
+                for event in stream:
+                    self.apply(event)
+            except ApiException as e:
+                if e.status == HTTP_GONE:
+                    log.info(f'{self.name}: resourceVersion {self.resource_version} too old, relisting.')
+                else:
+                    log.error(f'{self.name}: Watch failed, relisting: {e}')
+                    time.sleep(1)
+                self.resource_version = None
+            except Exception as e:
+                log.error(f'{self.name}: Watch failed, relisting: {e}')
+                time.sleep(1)
+                self.resource_version = None
+
+    def start(self):
+        self.sync()
+        self._watch = watch.Watch()
+        thread = threading.Thread(target=self.watch, name=self.name, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.stop()
+            self._watch = None
+
+    def values(self):
+        with self.lock:
+            return list(self.items.values())
+
+
+pod_key = idler.pod_key
+
+
+def deployment_key(deployment):
+    return (deployment.metadata.namespace, deployment.metadata.name)
+
+
+def build_caches():
+    pods = Cache(
+        'pods',
+        client.CoreV1Api(idler.api_client()).list_pod_for_all_namespaces,
+        pod_key,
+        items=idler.pods_lookup,
+        project=idler.project_pod,
+        keep=idler.in_shard,
+        label_selector=idler.LABEL_SELECTOR,
+    )
+    deployments = Cache(
+        'deployments',
+        client.AppsV1beta1Api(idler.api_client()).list_deployment_for_all_namespaces,
+        deployment_key,
+        keep=idler.in_shard,
+        label_selector=idler.eligible_selector(),
+    )
+    return pods, deployments
+
+
+def evaluate(pods, deployments):
+    """
+    Idles the cached deployments which should be idled.
+
+    Returns the list of deployments which failed to idle.
+    """
+    idler.registry.reset()
+    idler.load_policies()
+
+    if not idler.worth_sweeping():
+        idler.skip_sweep()
+        return []
+
+    with idler.RUN_DURATION.time():
+        with idler.PHASE_DURATION.time(phase='build_metrics_lookup'), pods.lock:
+            idler.metrics_lookup.clear()
+            idler.build_metrics_lookup()
+
+        eligible = deployments.values()
+        log.debug(f'Evaluating {len(eligible)} cached deployments.')
+
+        with idler.PHASE_DURATION.time(phase='idle'):
+            failed = idler.process(eligible)
+
+    if idler.evaluations is not None:
+        idler.save_evaluations()
+
+    idler.LAST_RUN.set(time.time())
+    idler.export_metrics()
+    idler.log_connection_stats()
+
+    if failed:
+        failed_deployments = "\n".join(failed)
+        log.error(f"Failed to idle following deployments:\n {failed_deployments}")
+
+    return failed
+
+
+def run():
+    pods, deployments = build_caches()
+    pods.start()
+    deployments.start()
+
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                evaluate(pods, deployments)
+            except Exception as e:
+                log.exception(f'Evaluation failed: {e}')
+            elapsed = time.monotonic() - started
+            time.sleep(max(0, IDLE_INTERVAL - elapsed))
+    finally:
+        pods.stop()
+        deployments.stop()
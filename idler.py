@@ -11,27 +11,47 @@ See https://kubernetes.io/docs/concepts/overview/working-with-objects/labels/
 for label selector syntax.
 """
 
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from functools import partial
+from itertools import chain
 import json
 import logging
 import os
+import random
+import sys
 from sys import exit
+import threading
+import time
 
 from kubernetes import client, config
+from kubernetes.client.rest import ApiException
 
 # provides swagger definitions for metrics api
 import metrics_api
+import policies
+import prometheus
+import protobuf
+import quantity
+import records
+import shards
+import snapshot
+import state
 
 
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
 
-log = logging.getLogger(__name__)
+# named explicitly (rather than `__name__`) so the helper modules can log
+# through it using child loggers (e.g. `idler.state`)
+log = logging.getLogger('idler')
 log.setLevel(LOG_LEVEL)
-log_formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-log_handler = logging.StreamHandler()
-log_handler.setFormatter(log_formatter)
-log.addHandler(log_handler)
+if not log.handlers:
+    log_formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(log_formatter)
+    log.addHandler(log_handler)
 
 
 CPU_ACTIVITY_THRESHOLD = 90
@@ -47,34 +67,815 @@ except ValueError:
 LABEL_SELECTOR = os.environ.get('LABEL_SELECTOR', 'mojanalytics.xyz/idleable=true').strip()
 log.debug(f'LABEL_SELECTOR="{LABEL_SELECTOR}"')
 
+# Number of items requested per LIST call, 0 disables paging
+PAGE_SIZE = 0
+try:
+    PAGE_SIZE = int(os.environ.get('PAGE_SIZE', PAGE_SIZE))
+    log.debug(f'PAGE_SIZE={PAGE_SIZE}')
+except ValueError:
+    log.warning(
+        f'Invalid value for PAGE_SIZE, using default ({PAGE_SIZE})')
+# Number of namespaces idled concurrently, 1 idles deployments one at a time
+IDLE_CONCURRENCY = 1
+try:
+    IDLE_CONCURRENCY = max(1, int(os.environ.get(
+        'IDLE_CONCURRENCY', IDLE_CONCURRENCY)))
+    log.debug(f'IDLE_CONCURRENCY={IDLE_CONCURRENCY}')
+except ValueError:
+    log.warning(
+        f'Invalid value for IDLE_CONCURRENCY, using default ({IDLE_CONCURRENCY})')
+
+# File keeping recent CPU usage samples of each app between runs. When set,
+# apps are idled based on a statistic (`CPU_HISTORY_STATISTIC`, e.g. `mean`,
+# `max` or `p95`) of the samples of the last `CPU_HISTORY_WINDOW` seconds
+# instead of only the latest sample
+CPU_HISTORY_FILE = os.environ.get('CPU_HISTORY_FILE', '').strip()
+CPU_HISTORY_STATISTIC = os.environ.get('CPU_HISTORY_STATISTIC', 'p95').strip()
+CPU_HISTORY_SIZE = 30
+CPU_HISTORY_WINDOW = 3600
+try:
+    CPU_HISTORY_SIZE = int(os.environ.get('CPU_HISTORY_SIZE', CPU_HISTORY_SIZE))
+    CPU_HISTORY_WINDOW = int(os.environ.get(
+        'CPU_HISTORY_WINDOW', CPU_HISTORY_WINDOW))
+except ValueError:
+    log.warning(
+        f'Invalid value for CPU_HISTORY_SIZE or CPU_HISTORY_WINDOW, using defaults ({CPU_HISTORY_SIZE}, {CPU_HISTORY_WINDOW}s)')
+try:
+    state.window_statistic([0], CPU_HISTORY_STATISTIC)
+except ValueError:
+    CPU_HISTORY_STATISTIC = 'p95'
+    log.warning(
+        f'Invalid value for CPU_HISTORY_STATISTIC, using default ({CPU_HISTORY_STATISTIC})')
+log.debug(
+    f'CPU_HISTORY_FILE="{CPU_HISTORY_FILE}", CPU_HISTORY_STATISTIC={CPU_HISTORY_STATISTIC}, '
+    f'CPU_HISTORY_SIZE={CPU_HISTORY_SIZE}, CPU_HISTORY_WINDOW={CPU_HISTORY_WINDOW}s')
+
+# Maximum number of connections to the API server kept open for reuse
+API_POOL_SIZE = max(4, IDLE_CONCURRENCY)
+try:
+    API_POOL_SIZE = int(os.environ.get('API_POOL_SIZE', API_POOL_SIZE))
+    log.debug(f'API_POOL_SIZE={API_POOL_SIZE}')
+except ValueError:
+    log.warning(
+        f'Invalid value for API_POOL_SIZE, using default ({API_POOL_SIZE})')
+
+# Number of times API calls failing with a conflict, rate limiting or server
+# error are retried, waiting exponentially longer (from `RETRY_BACKOFF`
+# seconds) between attempts
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.5
+try:
+    MAX_RETRIES = int(os.environ.get('MAX_RETRIES', MAX_RETRIES))
+    RETRY_BACKOFF = float(os.environ.get('RETRY_BACKOFF', RETRY_BACKOFF))
+    log.debug(f'MAX_RETRIES={MAX_RETRIES}, RETRY_BACKOFF={RETRY_BACKOFF}s')
+except ValueError:
+    log.warning(
+        f'Invalid value for MAX_RETRIES or RETRY_BACKOFF, using defaults ({MAX_RETRIES}, {RETRY_BACKOFF}s)')
+
+RETRY_STATUSES = {409, 429, 500, 502, 503, 504}
+HTTP_GONE = 410
+
+# Where to export the run's Prometheus metrics: a file for the node exporter's
+# textfile collector and/or a Pushgateway
+METRICS_TEXTFILE = os.environ.get('METRICS_TEXTFILE', '').strip()
+PUSHGATEWAY_URL = os.environ.get('PUSHGATEWAY_URL', '').strip()
+log.debug(f'METRICS_TEXTFILE="{METRICS_TEXTFILE}", PUSHGATEWAY_URL="{PUSHGATEWAY_URL}"')
+
+# 'cpu' idles the deployments in the order they're listed, 'memory' idles the
+# ones using the most memory first. With 'memory', setting
+# `FREE_MEMORY_PER_NODE` (GiB) only idles the deployments using the most
+# memory on each node until that much memory is freed on it
+IDLE_POLICY = os.environ.get('IDLE_POLICY', 'cpu').strip().lower()
+FREE_MEMORY_PER_NODE = 0
+try:
+    FREE_MEMORY_PER_NODE = float(os.environ.get(
+        'FREE_MEMORY_PER_NODE', FREE_MEMORY_PER_NODE))
+except ValueError:
+    log.warning(
+        f'Invalid value for FREE_MEMORY_PER_NODE, using default ({FREE_MEMORY_PER_NODE})')
+log.debug(f'IDLE_POLICY={IDLE_POLICY}, FREE_MEMORY_PER_NODE={FREE_MEMORY_PER_NODE}GiB')
+
+# When set, deployments are only evaluated: instead of idling them, a plan of
+# what would be done is written (as JSON lines) to `PLAN_FILE` (`-` for
+# stdout)
+DRY_RUN = os.environ.get('DRY_RUN', 'false').strip().lower() == 'true'
+PLAN_FILE = os.environ.get('PLAN_FILE', '-').strip()
+log.debug(f'DRY_RUN={DRY_RUN}, PLAN_FILE="{PLAN_FILE}"')
+
+# When set, the pods, metrics and deployments listed are recorded to this
+# (gzipped JSON lines) file so the run can be replayed offline with
+# `replay.py`. Can include `strftime` placeholders, e.g.
+# `/snapshots/%Y%m%dT%H%M%S.jsonl.gz`
+SNAPSHOT_FILE = os.environ.get('SNAPSHOT_FILE', '').strip()
+log.debug(f'SNAPSHOT_FILE="{SNAPSHOT_FILE}"')
+
+# When set, the policies of this (YAML) file override the settings above
+# (e.g. `CPU_ACTIVITY_THRESHOLD`) for the deployments they match, see
+# `policies.py`
+POLICY_FILE = os.environ.get('POLICY_FILE', '').strip()
+log.debug(f'POLICY_FILE="{POLICY_FILE}"')
+
+# Apps aren't idled for this many seconds after they (re)started: after their
+# pods started, their deployment became available or they were last idled
+# (e.g. just unidled, before their pods report any metrics)
+WARMUP_SECONDS = 0
+try:
+    WARMUP_SECONDS = int(os.environ.get('WARMUP_SECONDS', WARMUP_SECONDS))
+except ValueError:
+    log.warning(f'Invalid value for WARMUP_SECONDS, using default ({WARMUP_SECONDS}s)')
+log.debug(f'WARMUP_SECONDS={WARMUP_SECONDS}s')
+
+# When set, the decision made for each app is persisted to this (JSON) file.
+# Apps which were kept running are then not evaluated again until their
+# deployment changes (its `resourceVersion`) or `EVALUATION_GRACE` seconds
+# have passed
+STATE_FILE = os.environ.get('STATE_FILE', '').strip()
+EVALUATION_GRACE = 900
+try:
+    EVALUATION_GRACE = int(os.environ.get('EVALUATION_GRACE', EVALUATION_GRACE))
+except ValueError:
+    log.warning(
+        f'Invalid value for EVALUATION_GRACE, using default ({EVALUATION_GRACE}s)')
+log.debug(f'STATE_FILE="{STATE_FILE}", EVALUATION_GRACE={EVALUATION_GRACE}s')
+
+# How services and deployments are patched when idling apps:
+# - 'merge': (strategic) merge patches
+# - 'apply': server-side apply, as `FIELD_MANAGER`, taking over the fields
+#   idling sets (e.g. `replicas`) from other managers (e.g. Helm)
+# - 'scale': replicas set with the deployment's `/scale` subresource, and
+#   labels and annotations with a merge patch of the metadata only
+PATCH_MODE = os.environ.get('PATCH_MODE', 'merge').strip().lower()
+if PATCH_MODE not in ('merge', 'apply', 'scale'):
+    log.warning('Invalid value for PATCH_MODE, using default (merge)')
+    PATCH_MODE = 'merge'
+FIELD_MANAGER = os.environ.get('FIELD_MANAGER', 'idler').strip()
+log.debug(f'PATCH_MODE={PATCH_MODE}, FIELD_MANAGER="{FIELD_MANAGER}"')
+
+# When set, the pods, metrics and deployments are listed at the same time (in
+# threads) rather than one after the other. Each list is then held in memory
+# in full, rather than processed a page at a time
+PREFETCH = os.environ.get('PREFETCH', 'false').strip().lower() == 'true'
+log.debug(f'PREFETCH={PREFETCH}')
+
+# When set, pods, metrics and deployments are decoded straight from JSON into
+# compact records holding only the fields the idler uses (see `records.py`),
+# rather than into the Kubernetes client's models
+FAST_DECODE = os.environ.get('FAST_DECODE', 'false').strip().lower() == 'true'
+log.debug(f'FAST_DECODE={FAST_DECODE}')
+
+# When set, pods and deployments are listed as metadata only
+# (`PartialObjectMetadataList`) rather than as full objects. Deployments are
+# then only fetched in full (one at a time) when their metadata doesn't
+# already rule out idling them (schedule, minimum age, warm-up, unchanged
+# since last evaluated). Pods are still listed in full when their status or
+# spec is needed (`WARMUP_SECONDS`, `IDLE_POLICY=memory`). Ignored in dry runs,
+# so plans cover all the deployments
+METADATA_ONLY = os.environ.get('METADATA_ONLY', 'false').strip().lower() == 'true'
+log.debug(f'METADATA_ONLY={METADATA_ONLY}')
+
+# When set, pods, metrics and deployments are requested in the Kubernetes
+# protobuf encoding, smaller and only partly decoded (see `protobuf.py`), into
+# the same records as with `FAST_DECODE`. Lists the API server (or metrics
+# server) only serves as JSON are decoded from JSON
+PROTOBUF = os.environ.get('PROTOBUF', 'false').strip().lower() == 'true'
+log.debug(f'PROTOBUF={PROTOBUF}')
+
+# When set, runs use asyncio (and aiohttp, see `requirements-async.txt`)
+# rather than the Kubernetes client: pods, metrics and deployments are listed
+# at the same time and apps idled `IDLE_CONCURRENCY` namespaces at a time, see
+# `async_client.py`
+ASYNC_CLIENT = os.environ.get('ASYNC_CLIENT', 'false').strip().lower() == 'true'
+log.debug(f'ASYNC_CLIENT={ASYNC_CLIENT}')
+
+# Namespaces are split into `SHARD_COUNT` shards and only the apps in the
+# namespaces of shard `SHARD_INDEX` (from 0) are idled, see `shards.py`. One
+# idler per shard then splits the work between them, each writing its own
+# `CPU_HISTORY_FILE`, `STATE_FILE`, `METRICS_TEXTFILE` and `SNAPSHOT_FILE`
+# (with `SHARD_INDEX` before their extension, see `shard_file()`)
+SHARD_COUNT = 1
+SHARD_INDEX = 0
+try:
+    SHARD_COUNT = int(os.environ.get('SHARD_COUNT', SHARD_COUNT))
+    SHARD_INDEX = int(os.environ.get('SHARD_INDEX', SHARD_INDEX))
+    if SHARD_COUNT < 1 or not 0 <= SHARD_INDEX < SHARD_COUNT:
+        raise ValueError(f'Invalid shard {SHARD_INDEX} of {SHARD_COUNT}')
+except ValueError:
+    SHARD_COUNT = 1
+    SHARD_INDEX = 0
+    log.warning('Invalid value for SHARD_COUNT or SHARD_INDEX, using defaults (no sharding)')
+log.debug(f'SHARD_COUNT={SHARD_COUNT}, SHARD_INDEX={SHARD_INDEX}')
+
+# 'once' idles deployments and exits (e.g. CronJob), 'daemon' keeps running
+# and idles deployments periodically, see `controller.py`
+RUN_MODE = os.environ.get('RUN_MODE', 'once').strip().lower()
+log.debug(f'RUN_MODE={RUN_MODE}')
+
 IDLED = 'mojanalytics.xyz/idled'
 IDLED_AT = 'mojanalytics.xyz/idled-at'
 REPLICAS_WHEN_UNIDLED = 'mojanalytics.xyz/replicas-when-unidled'
 SERVICE_TYPE_EXTERNAL_NAME = "ExternalName"
 UNIDLER_SERVICE_HOST = "unidler.default.svc.cluster.local"
+SERVICE_PATH = '/api/v1/namespaces/{namespace}/services/{name}'
+DEPLOYMENT_PATH = '/apis/apps/v1/namespaces/{namespace}/deployments/{name}'
+PODS_PATH = '/api/v1/pods'
+POD_METRICS_PATH = '/apis/metrics.k8s.io/v1beta1/pods'
+DEPLOYMENTS_PATH = '/apis/apps/v1beta1/deployments'
+
 
+# what's kept of each pod listed, see `project_pod()`
+PodEntry = namedtuple('PodEntry', ['app', 'owner', 'start_time', 'phase', 'node'])
 
 metrics_lookup = {}
+# (pod name, namespace) -> PodEntry
 pods_lookup = {}
+pod_starts_lookup = {}
+cpu_history = None
+evaluations = None
+rules = None
+recorder = None
+
+_api_client = None
+_api_client_lock = threading.Lock()
+_evaluations_lock = threading.Lock()
+
+registry = prometheus.Registry()
+RUN_DURATION = registry.register(prometheus.Gauge(
+    'idler_run_duration_seconds',
+    'Duration of the idler run.',
+))
+LAST_RUN = registry.register(prometheus.Gauge(
+    'idler_last_run_timestamp_seconds',
+    'Time the idler run completed.',
+))
+PHASE_DURATION = registry.register(prometheus.Gauge(
+    'idler_phase_duration_seconds',
+    'Time spent in each phase of the idler run.',
+    labelnames=['phase'],
+))
+DEPLOYMENTS = registry.register(prometheus.Gauge(
+    'idler_deployments',
+    'Number of deployments evaluated, idled, skipped and failed to idle.',
+    labelnames=['result'],
+))
+API_REQUEST_DURATION = registry.register(prometheus.Histogram(
+    'idler_api_request_duration_seconds',
+    'Latency of the requests to the Kubernetes API server.',
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    labelnames=['method', 'path'],
+))
+APP_CPU_USAGE = registry.register(prometheus.Histogram(
+    'idler_app_cpu_usage_percent',
+    'CPU usage of the evaluated apps, as a percentage of their limits.',
+    buckets=[1, 5, 10, 25, 50, 75, 90, 100, 150],
+))
+SWEEP_SKIPPED = registry.register(prometheus.Gauge(
+    'idler_sweep_skipped',
+    'Whether the run was skipped as no app could be idled at the time.',
+))
 
 
 def idle_deployments():
-    build_lookups()
+    registry.reset()
+    load_policies()
+
+    if not worth_sweeping():
+        skip_sweep()
+        return
+
+    if SNAPSHOT_FILE:
+        start_recording()
 
+    try:
+        with RUN_DURATION.time():
+            if ASYNC_CLIENT:
+                import async_client
+                failed = async_client.run()
+            else:
+                # the deployments which failed to be fetched, as they're
+                # processed
+                failed = []
+                if PREFETCH:
+                    deployments = Timed(prefetch(failed=failed))
+                else:
+                    build_lookups()
+
+                    with PHASE_DURATION.time(phase='eligible_deployments'):
+                        deployments = Timed(eligible_deployments(failed=failed))
+
+                with PHASE_DURATION.time(phase='idle'):
+                    failed = process(deployments) + failed
+
+                # the deployments are listed (a page at a time) and fetched
+                # (see `METADATA_ONLY`) as they're idled
+                PHASE_DURATION.inc(deployments.elapsed, phase='eligible_deployments')
+                PHASE_DURATION.inc(-deployments.elapsed, phase='idle')
+    finally:
+        if recorder is not None:
+            stop_recording()
+
+    if evaluations is not None:
+        save_evaluations()
+
+    LAST_RUN.set(time.time())
+    export_metrics()
+    log_connection_stats()
+
+    if failed:
+        failed_deployments = "\n".join(failed)
+        log.error(f"Failed to idle following deployments:\n {failed_deployments}")
+        exit(1)
+
+
+class Timed(object):
+    """
+    Iterator over the given iterable keeping track of the time spent getting
+    its items (`elapsed`, in seconds), e.g. listing and fetching them.
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.elapsed = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+
+def worth_sweeping(now=None):
+    """
+    Returns whether any app could be idled at the given time, given their
+    policies' schedules and calendars. Otherwise there's no point listing
+    anything.
+    """
+    if rules is None:
+        return True
+
+    if now is None:
+        now = datetime.now(timezone.utc)
+    return rules.any_allows(now)
+
+
+def skip_sweep():
+    log.info('No app can be idled at this time, skipping the run.')
+    SWEEP_SKIPPED.set(1)
+    LAST_RUN.set(time.time())
+    export_metrics()
+
+
+def start_recording():
+    global recorder
+    path = datetime.now(timezone.utc).strftime(shard_file(SNAPSHOT_FILE))
+    try:
+        recorder = snapshot.Recorder(
+            path,
+            api_client().sanitize_for_serialization,
+            label_selector=LABEL_SELECTOR,
+        )
+        log.debug(f'Recording snapshot to {path}.')
+    except OSError as e:
+        log.error(f'Failed to record snapshot to {path}: {e}')
+
+
+def stop_recording():
+    global recorder
+    try:
+        recorder.close()
+    except OSError as e:
+        log.error(f'Failed to record snapshot to {recorder.path}: {e}')
+    recorder = None
+
+
+def api_client():
+    """
+    Returns the `ApiClient` shared by all the API calls.
+
+    Sharing it means the API calls share its connection pool, reusing
+    keep-alive connections to the API server instead of opening (and doing
+    the TLS handshake for) new ones. Must be called after the Kubernetes
+    configuration has been loaded.
+    """
+    global _api_client
+    with _api_client_lock:
+        if _api_client is None:
+            configuration = client.Configuration()
+            configuration.connection_pool_maxsize = API_POOL_SIZE
+            _api_client = client.ApiClient(configuration)
+            instrument(_api_client)
+        return _api_client
+
+
+def instrument(api_client):
+    """
+    Records the latency of the requests made by the given `ApiClient`.
+    """
+    call_api = api_client.call_api
+
+    def timed_call_api(resource_path, method, *args, **kwargs):
+        with API_REQUEST_DURATION.time(method=method, path=resource_path):
+            return call_api(resource_path, method, *args, **kwargs)
+
+    api_client.call_api = timed_call_api
+
+
+def export_metrics():
+    if METRICS_TEXTFILE:
+        path = shard_file(METRICS_TEXTFILE)
+        try:
+            registry.write_textfile(path, const_labels=grouping_key())
+        except OSError as e:
+            log.error(f'Failed to write metrics to {path}: {e}')
+
+    if PUSHGATEWAY_URL:
+        try:
+            registry.push(PUSHGATEWAY_URL, job='idler', grouping_key=grouping_key())
+        except OSError as e:
+            log.error(f'Failed to push metrics to {PUSHGATEWAY_URL}: {e}')
+
+
+def grouping_key():
+    # each shard pushes (or writes) its own metrics, rather than replacing
+    # the others'
+    if SHARD_COUNT > 1:
+        return {'shard': SHARD_INDEX}
+    return None
+
+
+def connection_stats():
+    """
+    Returns the number of connections to the API server opened and the number
+    of requests which reused an already open connection.
+    """
+    opened = 0
+    requests = 0
+    if _api_client is not None:
+        pools = _api_client.rest_client.pool_manager.pools
+        for pool_key in pools.keys():
+            pool = pools[pool_key]
+            opened += pool.num_connections
+            requests += pool.num_requests
+    return opened, requests - opened
+
+
+def log_connection_stats():
+    opened, reused = connection_stats()
+    log.debug(f'API server connections: {opened} opened, {reused} reused.')
+
+
+def process(deployments):
+    """
+    Idles the given deployments which should be idled, or only writes the
+    plan when `DRY_RUN` is set.
+
+    Returns the list of deployments which failed to idle.
+    """
+    if WARMUP_SECONDS:
+        build_pod_starts_lookup()
+
+    failed = []
+    selected = None
+    if IDLE_POLICY == 'memory':
+        if DRY_RUN:
+            # all planned, including the ones kept running
+            deployments = list(deployments)
+        selected, failed = select(deployments)
+
+    if DRY_RUN:
+        return failed + write_plan(deployments, selected=selected)
+
+    evaluated = selected is not None
+    if evaluated:
+        deployments = selected
+
+    if IDLE_CONCURRENCY > 1:
+        return failed + idle_concurrently(deployments, evaluated=evaluated)
+
+    return failed + idle_in_order(deployments, evaluated=evaluated)
+
+
+def select(deployments):
+    """
+    Returns the deployments which should be idled (see `IDLE_POLICY`) and the
+    list of deployments which failed to be evaluated.
+    """
+    if IDLE_POLICY == 'memory':
+        return select_by_memory(deployments)
+    return evaluate_all(deployments)
+
+
+def evaluate_all(deployments):
+    """
+    Returns the deployments which should be idled, in order, and the list of
+    deployments which failed to be evaluated.
+    """
+    selected = []
     failed = []
-    for deployment in eligible_deployments():
+    for deployment in deployments:
+        DEPLOYMENTS.inc(result='evaluated')
         try:
             if should_idle(deployment):
+                selected.append(deployment)
+            else:
+                DEPLOYMENTS.inc(result='skipped')
+        except Exception as e:
+            deploy_id = f"({deployment.metadata.namespace}, {deployment.metadata.name})"
+            log.error(f"Failed to evaluate {deploy_id} deployment: {e}")
+            failed.append(deploy_id)
+            DEPLOYMENTS.inc(result='failed')
+
+    return selected, failed
+
+
+def select_by_memory(deployments):
+    """
+    Returns the deployments which should be idled, using the most memory
+    first, and the list of deployments which failed to be evaluated.
+
+    When `FREE_MEMORY_PER_NODE` is set, only the deployments needed to free
+    that much memory on each node are returned, see `largest_first_to_free()`.
+    """
+    selected, failed = evaluate_all(deployments)
+
+    candidates = []
+    for deployment in selected:
+        key = get_key(deployment)
+        try:
+            usage = memory_usage_by_node(deployment)
+        except ValueError as ve:
+            log.warning(f'{key}: Using unknown unit of memory, assuming no memory usage: {ve}')
+            usage = {}
+
+        candidates.append((sum(usage.values()), usage, deployment))
+
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+    if FREE_MEMORY_PER_NODE:
+        selected = largest_first_to_free(
+            [usage for _, usage, _ in candidates],
+            FREE_MEMORY_PER_NODE * 2 ** 30,
+        )
+        DEPLOYMENTS.inc(len(candidates) - len(selected), result='skipped')
+        candidates = [candidates[i] for i in selected]
+
+    for memory, _, deployment in candidates:
+        log.debug(f'{get_key(deployment)}: will free {memory} bytes of memory.')
+
+    return [deployment for _, _, deployment in candidates], failed
+
+
+def largest_first_to_free(usages, target):
+    """
+    Returns the indexes (in order) of the candidates to idle to free `target`
+    bytes of memory on each node, where possible.
+
+    `usages` are the memory used by each candidate on each node
+    (`{node: bytes}`), sorted by total memory used, descending. For each node
+    the candidates using the most memory on it are picked first, accounting
+    for the memory the candidates already picked free on it. This is greedy:
+    it usually picks few candidates, but not necessarily the fewest.
+    """
+    by_node = {}
+    for i, usage in enumerate(usages):
+        for node, memory in usage.items():
+            if node is not None:
+                by_node.setdefault(node, []).append((memory, i))
+
+    freed = {}
+    selected = set()
+    for node in sorted(by_node):
+        for memory, i in sorted(by_node[node], key=lambda entry: entry[0], reverse=True):
+            if freed.get(node, 0) >= target:
+                break
+            if i in selected:
+                continue
+            selected.add(i)
+            for other_node, other_memory in usages[i].items():
+                freed[other_node] = freed.get(other_node, 0) + other_memory
+
+    return sorted(selected)
+
+
+def memory_usage_by_node(deployment):
+    """
+    Returns the memory (bytes) used by the deployment's pods on each node.
+    """
+    usage = {}
+    for pod_metrics in metrics_lookup.get(get_key(deployment), []):
+        pod = pods_lookup.get((pod_metrics.metadata.name, pod_metrics.metadata.namespace))
+        node = pod.node if pod is not None else None
+        for container in pod_metrics.containers:
+            memory = container.usage.get('memory')
+            if memory is not None:
+                usage[node] = usage.get(node, 0) + mem_val_with_unit_to_int(memory)
+    return usage
+
+
+def write_plan(deployments, selected=None):
+    """
+    Writes the plan to `PLAN_FILE`, see `write_plan_to()`.
+    """
+    if PLAN_FILE == '-':
+        failed = write_plan_to(sys.stdout, deployments, selected=selected)
+        sys.stdout.flush()
+    else:
+        with open(PLAN_FILE, 'w') as f:
+            failed = write_plan_to(f, deployments, selected=selected)
+    return failed
+
+
+def write_plan_to(f, deployments, selected=None, now=None):
+    """
+    Writes the plan of the given deployments (at the given time, now by
+    default). The ones to idle are the `selected` ones if they've already
+    been selected (and counted as evaluated), see `select()`.
+
+    Returns the list of deployments which failed to be planned, planned as
+    `failed`.
+    """
+    selected_ids = None if selected is None else {id(deployment) for deployment in selected}
+
+    idled = 0
+    failed = []
+    for deployment in deployments:
+        if selected_ids is None:
+            DEPLOYMENTS.inc(result='evaluated')
+        try:
+            if selected_ids is None:
+                entry = plan(deployment, now=now)
+            else:
+                entry = plan(deployment, decision=id(deployment) in selected_ids)
+        except Exception as e:
+            deploy_id = f"({deployment.metadata.namespace}, {deployment.metadata.name})"
+            log.error(f"Failed to plan {deploy_id} deployment: {e}")
+            failed.append(deploy_id)
+            DEPLOYMENTS.inc(result='failed')
+            entry = failed_plan(deployment, e)
+        if entry['decision'] == 'idle':
+            idled += 1
+        f.write(json.dumps(entry))
+        f.write('\n')
+
+    log.info(f'Dry run: {idled} deployments would be idled, {len(failed)} failed.')
+    return failed
+
+
+def failed_plan(deployment, error):
+    """
+    Returns the plan of a deployment which failed to be evaluated.
+    """
+    entry = {
+        'namespace': deployment.metadata.namespace,
+        'deployment': deployment.metadata.name,
+        'decision': 'failed',
+        'error': str(error),
+        'reclaimed': {'cpu': 0, 'memory': 0},
+    }
+    if SHARD_COUNT > 1:
+        entry['shard'] = SHARD_INDEX
+    return entry
+
+
+def plan(deployment, decision=None, now=None):
+    """
+    Returns what would be done with the given deployment (at the given time,
+    now by default) and why, given the decision if it's already been made.
+    """
+    key = get_key(deployment)
+    policy = policy_for(deployment)
+    usage = cpu_percent(deployment, window=policy.window)
+    if decision is None:
+        decision = should_idle(deployment, usage=usage, now=now)
+
+    try:
+        millicores = cpu_usage(deployment, window=policy.window)
+    except ValueError as ve:
+        log.warning(f'{key}: Using unknown unit of CPU: {ve}')
+        millicores = None
+
+    limits = {'cpu': None, 'memory': None}
+    try:
+        limits = {
+            'cpu': pod_limits(deployment, 'cpu', core_val_with_unit_to_int),
+            'memory': pod_limits(deployment, 'memory', mem_val_with_unit_to_int),
+        }
+    except ValueError as ve:
+        log.warning(f'{key}: Using unknown unit of resources: {ve}')
+
+    replicas = deployment.spec.replicas or 0
+    reclaimed = {'cpu': 0, 'memory': 0}
+    if decision:
+        try:
+            reclaimed = {
+                'cpu': replicas * pod_resources(deployment, 'cpu', core_val_with_unit_to_int),
+                'memory': replicas * pod_resources(deployment, 'memory', mem_val_with_unit_to_int),
+            }
+        except ValueError as ve:
+            log.warning(f'{key}: Using unknown unit of resources: {ve}')
+
+    entry = {
+        'app': key[0],
+        'namespace': deployment.metadata.namespace,
+        'deployment': deployment.metadata.name,
+        'replicas': replicas,
+        'cpu_percent': usage,
+        # millicores used per replica, `None` if its metrics weren't found
+        'cpu_usage': millicores,
+        'threshold': policy.threshold,
+        'decision': 'idle' if decision else 'keep',
+        # millicores and bytes each pod is limited to
+        'limits': limits,
+        # millicores and bytes requested by the deployment's pods
+        'reclaimed': reclaimed,
+    }
+    # to merge the shards' plans, see `shards.py`
+    if SHARD_COUNT > 1:
+        entry['shard'] = SHARD_INDEX
+    return entry
+
+
+def pod_resources(deployment, resource, parse):
+    """
+    Returns the amount of the given resource requested by each pod of the
+    deployment (the limit if a container has no request, as Kubernetes
+    does).
+    """
+    total = 0
+    for container in deployment.spec.template.spec.containers:
+        requests = container.resources.requests or {}
+        limits = container.resources.limits or {}
+        quantity = requests.get(resource, limits.get(resource))
+        if quantity is not None:
+            total += parse(quantity)
+    return total
+
+
+def pod_limits(deployment, resource, parse):
+    """
+    Returns the amount of the given resource each pod of the deployment is
+    limited to (of the containers with a limit).
+    """
+    total = 0
+    for container in deployment.spec.template.spec.containers:
+        quantity = (container.resources.limits or {}).get(resource)
+        if quantity is not None:
+            total += parse(quantity)
+    return total
+
+
+def idle_in_order(deployments, evaluated=False):
+    """
+    Idles the given deployments one at a time, unless they shouldn't be idled
+    (not checked if they've already been `evaluated`).
+
+    Returns the list of deployments which failed to idle.
+    """
+    failed = []
+    for deployment in deployments:
+        if not evaluated:
+            DEPLOYMENTS.inc(result='evaluated')
+        try:
+            if evaluated or should_idle(deployment):
                 idle(deployment)
+                DEPLOYMENTS.inc(result='idled')
+            else:
+                DEPLOYMENTS.inc(result='skipped')
         except Exception as e:
             deploy_id = f"({deployment.metadata.namespace}, {deployment.metadata.name})"
             log.error(f"Failed to idle {deploy_id} deployment: {e}")
             failed.append(deploy_id)
+            DEPLOYMENTS.inc(result='failed')
 
-    if failed:
-        failed_deployments = "\n".join(failed)
-        log.error(f"Failed to idle following deployments:\n {failed_deployments}")
-        exit(1)
+    return failed
+
+
+def idle_concurrently(deployments, evaluated=False):
+    """
+    Idles the given deployments using up to `IDLE_CONCURRENCY` threads.
+
+    Deployments are grouped by namespace: namespaces are idled concurrently
+    while the deployments within a namespace are idled one at a time, in the
+    order they were listed.
+
+    Returns the list of deployments which failed to idle.
+    """
+    by_namespace = OrderedDict()
+    for deployment in deployments:
+        by_namespace.setdefault(
+            deployment.metadata.namespace, []).append(deployment)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=IDLE_CONCURRENCY) as executor:
+        for namespace_failed in executor.map(
+                partial(idle_in_order, evaluated=evaluated),
+                by_namespace.values()):
+            failed.extend(namespace_failed)
+
+    return failed
 
 
 def get_key(pod_or_deployment):
@@ -84,58 +885,533 @@ def get_key(pod_or_deployment):
     )
 
 
-def build_metrics_lookup():
-    metrics = client.MetricsV1beta1Api().list_pod_metrics_for_all_namespaces(
-        label_selector=LABEL_SELECTOR).items
-    log.debug(f"{len(metrics)} metrics found matching the '{LABEL_SELECTOR}' label selector.")
+def list_all(list_fn, **kwargs):
+    """
+    Returns an iterator over the items of a `list_*` API call.
+
+    When `PAGE_SIZE` is set the items are requested `PAGE_SIZE` at a time
+    using `limit`/`continue`, so only one page is held in memory at once.
+    The first page is requested straight away, the others as the iterator
+    is consumed.
+    """
+    pages = list_pages(list_fn, **kwargs)
+    first_page = next(pages)
+    return chain(
+        first_page.items,
+        chain.from_iterable(page.items for page in pages),
+    )
+
+
+def decoded(list_fn, record):
+    """
+    Returns the given list function, decoding its responses into records of
+    the given type when `FAST_DECODE` is set.
+    """
+    if not FAST_DECODE:
+        return list_fn
+
+    def list_records(**kwargs):
+        response = list_fn(_preload_content=False, **kwargs)
+        return records.stream_list(stream(response), record)
+
+    return list_records
+
+
+def stream(response):
+    """
+    Yields the body of the given (not preloaded) response in chunks.
+    """
+    try:
+        yield from response.stream(records.CHUNK_SIZE)
+    finally:
+        response.release_conn()
+
+
+def list_objects(path, record, metadata_only=False):
+    """
+    Returns a list function (like the client's `list_*` ones) listing the
+    objects at the given path into records of the given type, in protobuf
+    when `PROTOBUF` is set, and as metadata only (the records then only have
+    their `metadata` set) if asked to.
+
+    The Kubernetes client can't request either, so the requests are made
+    with the API client directly.
+    """
+    def list_fn(label_selector=None, limit=None, _continue=None):
+        query_params = [
+            (name, value)
+            for name, value in [
+                ('labelSelector', label_selector),
+                ('limit', limit),
+                ('continue', _continue),
+            ]
+            if value
+        ]
+        response = api_client().call_api(
+            path, 'GET',
+            query_params=query_params,
+            header_params={'Accept': accept(metadata_only)},
+            auth_settings=['BearerToken'],
+            _preload_content=False,
+            _return_http_data_only=True,
+        )
+
+        if protobuf.is_protobuf(response.getheader('Content-Type')):
+            try:
+                return protobuf.decode_list(response.data, record)
+            finally:
+                response.release_conn()
+        return records.stream_list(stream(response), record)
+
+    return list_fn
+
+
+def accept(metadata_only=False):
+    """
+    Returns the `Accept` header of list requests, falling back to (full
+    objects in) JSON on API servers not supporting protobuf or metadata only
+    lists.
+    """
+    media_types = ['application/json']
+    if PROTOBUF:
+        media_types.insert(0, protobuf.CONTENT_TYPE)
+
+    if metadata_only:
+        media_types = [
+            f'{media_type};as=PartialObjectMetadataList;g=meta.k8s.io;v={version}'
+            for version in ('v1', 'v1beta1')
+            for media_type in media_types
+        ] + media_types
+
+    return ', '.join(media_types)
+
+
+def list_pages(list_fn, **kwargs):
+    """
+    Yields the responses of a `list_*` API call, one per page.
+
+    Pages are requested with retries (see `with_retries()`). When the
+    continue token of a page has expired (410 Gone, e.g. the previous pages
+    took longer to go through than the API server keeps them for), the list
+    is restarted, skipping the items already gone through as the API server
+    lists them in order (of namespace and name).
+    """
+    if not PAGE_SIZE:
+        yield with_retries(list_fn, **kwargs)
+        return
+
+    kwargs['limit'] = PAGE_SIZE
+    last = None
+    skip_to = None
+
+    def resumed(items):
+        nonlocal last, skip_to
+        for item in items:
+            if skip_to is not None:
+                if storage_key(item) <= skip_to:
+                    continue
+                skip_to = None
+            last = item
+            yield item
+
+    while True:
+        try:
+            page = with_retries(list_fn, **kwargs)
+        except ApiException as e:
+            if e.status != HTTP_GONE or '_continue' not in kwargs:
+                raise
+            if last is not None:
+                skip_to = storage_key(last)
+            log.info(f'Continue token expired after "{skip_to}", listing again from there.')
+            del kwargs['_continue']
+            continue
+
+        page.items = resumed(page.items or [])
+        yield page
+
+        _continue = page.metadata._continue
+        if not _continue:
+            return
+
+        kwargs['_continue'] = _continue
+
+
+def storage_key(obj):
+    """
+    Returns the key the API server lists the given object in the order of.
+    """
+    return f'{obj.metadata.namespace}/{obj.metadata.name}'
+
+
+def list_pod_metrics():
+    if PROTOBUF:
+        list_fn = list_objects(POD_METRICS_PATH, records.PodMetrics)
+    else:
+        list_fn = decoded(
+            client.MetricsV1beta1Api(api_client()).list_pod_metrics_for_all_namespaces,
+            records.PodMetrics)
+    return list_all(list_fn, label_selector=LABEL_SELECTOR)
+
+
+def build_metrics_lookup(metrics=None):
+    if metrics is None:
+        metrics = list_pod_metrics()
 
+    metrics = sharded(metrics)
+
+    if recorder is not None:
+        metrics = recorder.tee(snapshot.POD_METRICS, metrics)
+
+    count = 0
     for pod_metrics in metrics:
-        pod_name = pod_metrics.metadata.name
-        namespace = pod_metrics.metadata.namespace
+        count += 1
+        add_pod_metrics(pod_metrics)
+
+    log.debug(f"{count} metrics found matching the '{LABEL_SELECTOR}' label selector.")
+
+    if CPU_HISTORY_FILE:
+        record_cpu_history()
+
+
+def add_pod_metrics(pod_metrics):
+    pod_name = pod_metrics.metadata.name
+    namespace = pod_metrics.metadata.namespace
+    try:
         pod = pods_lookup[(pod_name, namespace)]
-        app_name = pod.metadata.labels['app']
+    except KeyError:
+        log.debug(f'({pod_name}, {namespace}): Pod not found, ignoring its metrics.')
+        return
+    app_name = pod.app
+
+    # all the replicas of an app share its label, collect all of them
+    metrics_lookup.setdefault((app_name, namespace), []).append(pod_metrics)
+
+
+def record_cpu_history():
+    global cpu_history
+    if cpu_history is None:
+        cpu_history = state.CpuHistory.load(shard_file(CPU_HISTORY_FILE), CPU_HISTORY_SIZE)
+
+    # dry runs (e.g. alongside the real runs) plan with the history but don't
+    # add to it, which would shrink the window the real runs average over
+    if DRY_RUN:
+        return
+
+    for key, pods_metrics in metrics_lookup.items():
+        try:
+            cpu_history.record(key, cpu_usage_per_replica(pods_metrics))
+        except ValueError as ve:
+            log.warning(f'{key}: Using unknown unit of CPU, not recording it: {ve}')
+
+    path = shard_file(CPU_HISTORY_FILE)
+    try:
+        cpu_history.save(path, window=CPU_HISTORY_WINDOW)
+    except OSError as e:
+        log.error(f'Failed to save CPU usage history to {path}: {e}')
+
+
+def list_pods():
+    if metadata_only() and not (WARMUP_SECONDS or IDLE_POLICY == 'memory'):
+        list_fn = list_objects(PODS_PATH, records.Pod, metadata_only=True)
+    elif PROTOBUF:
+        list_fn = list_objects(PODS_PATH, records.Pod)
+    else:
+        list_fn = decoded(client.CoreV1Api(api_client()).list_pod_for_all_namespaces, records.Pod)
+    return list_all(list_fn, label_selector=LABEL_SELECTOR)
 
-        metrics_lookup[(app_name, namespace)] = pod_metrics
 
+def build_pods_lookup(pods=None):
+    if pods is None:
+        pods = list_pods()
 
-def build_pods_lookup():
-    pods = client.CoreV1Api().list_pod_for_all_namespaces(
-        label_selector=LABEL_SELECTOR).items
-    log.debug(f"{len(pods)} pods found matching the '{LABEL_SELECTOR}' label selector.")
+    pods = sharded(pods)
 
+    if recorder is not None:
+        pods = recorder.tee(snapshot.POD, pods)
+
+    count = 0
     for pod in pods:
-        pods_lookup[(pod.metadata.name, pod.metadata.namespace)] = pod
+        count += 1
+        add_pod(pod)
 
+    log.debug(f"{count} pods found matching the '{LABEL_SELECTOR}' label selector.")
 
-def build_lookups():
-    build_pods_lookup()
-    build_metrics_lookup()
+
+def add_pod(pod):
+    pods_lookup[pod_key(pod)] = project_pod(pod)
+
+
+def pod_key(pod):
+    return (pod.metadata.name, intern(pod.metadata.namespace))
+
+
+def project_pod(pod):
+    """
+    Returns the `PodEntry` of the given pod: only what the idler uses of it.
+
+    Keeping the whole pods (with their specs and statuses) would use a lot of
+    memory on big clusters. The strings many pods have in common (e.g. app
+    names and nodes) are interned so they're only held once.
+    """
+    metadata = pod.metadata
+    owners = metadata.owner_references or []
+    status = pod.status
+    return PodEntry(
+        app=intern((metadata.labels or {}).get('app')),
+        owner=intern(owners[0].name) if owners else None,
+        start_time=status.start_time if status is not None else None,
+        phase=intern(status.phase) if status is not None else None,
+        node=intern(pod.spec.node_name) if pod.spec is not None else None,
+    )
 
 
-def eligible_deployments():
+def intern(string):
+    return sys.intern(string) if isinstance(string, str) else string
+
+
+def build_pod_starts_lookup():
+    """
+    Builds the lookup of when the latest pod of each app started. Pods not
+    started yet count as starting now.
+    """
+    now = datetime.now(timezone.utc)
+    pod_starts_lookup.clear()
+    # copied, as the lookup is updated by watches in daemon mode
+    for (_, namespace), pod in list(pods_lookup.items()):
+        key = (pod.app, namespace)
+        started = pod.start_time or now
+        if key not in pod_starts_lookup or started > pod_starts_lookup[key]:
+            pod_starts_lookup[key] = started
+
+
+def build_lookups():
+    with PHASE_DURATION.time(phase='build_pods_lookup'):
+        build_pods_lookup()
+    with PHASE_DURATION.time(phase='build_metrics_lookup'):
+        build_metrics_lookup()
+
+
+def prefetch(failed=None):
+    """
+    Lists the pods, pod metrics and eligible deployments at the same time and
+    then builds the lookups from them.
+
+    Returns the eligible deployments, see `eligible_deployments()`.
+    """
+    # the lists are read in full by their thread, so all of their pages are
+    # held in memory at once
+    def fetch(list_fn):
+        return list(sharded(list_fn()))
+
+    with PHASE_DURATION.time(phase='prefetch'):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            pods = executor.submit(fetch, list_pods)
+            metrics = executor.submit(fetch, list_pod_metrics)
+            deployments = executor.submit(fetch, list_eligible_deployments)
+
+    with PHASE_DURATION.time(phase='build_pods_lookup'):
+        build_pods_lookup(pods.result())
+    with PHASE_DURATION.time(phase='build_metrics_lookup'):
+        build_metrics_lookup(metrics.result())
+
+    return eligible_deployments(deployments.result(), failed=failed)
+
+
+def in_shard(obj):
+    """
+    Returns whether the given object's namespace is in this idler's shard.
+    """
+    return SHARD_COUNT == 1 or shards.shard_of(obj.metadata.namespace, SHARD_COUNT) == SHARD_INDEX
+
+
+def shard_file(path):
+    """
+    Returns the path of this shard's copy of the given file (e.g.
+    `STATE_FILE`), with `SHARD_INDEX` before its extension when sharding
+    (e.g. `state.2.json`), so that shards sharing a volume don't overwrite
+    each other's.
+    """
+    if SHARD_COUNT == 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}.{SHARD_INDEX}{extension}'
+
+
+def sharded(objects):
+    """
+    Returns the given objects in this idler's shard, filtered as they're
+    iterated over so the other shards' are never held.
+    """
+    if SHARD_COUNT == 1:
+        return objects
+    return (obj for obj in objects if in_shard(obj))
+
+
+def eligible_selector():
     selector = f"!{IDLED}"
     if LABEL_SELECTOR:
         selector = f"{selector},{LABEL_SELECTOR}"
+    return selector
+
 
-    deployments = client.AppsV1beta1Api().list_deployment_for_all_namespaces(
-        label_selector=selector).items
-    log.debug(f"{len(deployments)} deployments found matching the '{selector}' label selector.")
+def list_eligible_deployments():
+    selector = eligible_selector()
+
+    log.debug(f"Listing deployments matching the '{selector}' label selector.")
+    if metadata_only() or PROTOBUF:
+        list_fn = list_objects(DEPLOYMENTS_PATH, records.Deployment, metadata_only=metadata_only())
+    else:
+        list_fn = decoded(
+            client.AppsV1beta1Api(api_client()).list_deployment_for_all_namespaces,
+            records.Deployment)
+    return list_all(list_fn, label_selector=selector)
+
+
+def eligible_deployments(deployments=None, failed=None):
+    """
+    Returns the eligible deployments (listed, unless given). Those which
+    failed to be fetched (see `METADATA_ONLY`) are added to `failed`.
+    """
+    if deployments is None:
+        deployments = list_eligible_deployments()
+
+    deployments = sharded(deployments)
+
+    if metadata_only():
+        deployments = fetch_candidates(deployments, [] if failed is None else failed)
+
+    if recorder is not None:
+        deployments = recorder.tee(snapshot.DEPLOYMENT, deployments)
 
     return deployments
 
 
-def should_idle(deployment):
-    usage = 0
-    key = get_key(deployment)
+def metadata_only():
+    return METADATA_ONLY and not DRY_RUN
+
+
+def fetch_candidates(deployments, failed):
+    """
+    Yields the full deployments of the given metadata only ones, except the
+    ones whose metadata already rules out idling them, which aren't fetched.
 
+    Deployments are fetched concurrently, using the connection pool
+    (`API_POOL_SIZE`), and yielded in order. At most `API_POOL_SIZE * 2` are
+    fetched ahead of the one being yielded, so the deployments are still
+    listed (see `PAGE_SIZE`) and held a few at a time. The ones which failed
+    to be evaluated or fetched are added to `failed`, rather than ending the
+    run.
+    """
+    now = datetime.now(timezone.utc)
+
+    def candidates():
+        for deployment in deployments:
+            try:
+                if worth_fetching(deployment, now):
+                    yield deployment
+            except Exception as e:
+                fail(deployment, 'evaluate', e, failed)
+
+    def fetched(deployment, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            fail(deployment, 'fetch', e, failed)
+            return None
+        return result
+
+    window = deque()
+    with ThreadPoolExecutor(max_workers=API_POOL_SIZE) as executor:
+        for deployment in candidates():
+            if len(window) >= API_POOL_SIZE * 2:
+                result = fetched(*window.popleft())
+                if result is not None:
+                    yield result
+            window.append((deployment, executor.submit(fetch_deployment, deployment)))
+
+        while window:
+            result = fetched(*window.popleft())
+            if result is not None:
+                yield result
+
+
+def fail(deployment, action, error, failed):
+    deploy_id = f"({deployment.metadata.namespace}, {deployment.metadata.name})"
+    log.error(f"Failed to {action} {deploy_id} deployment: {error}")
+    failed.append(deploy_id)
+    DEPLOYMENTS.inc(result='evaluated')
+    DEPLOYMENTS.inc(result='failed')
+
+
+def worth_fetching(deployment, now):
+    key = get_key(deployment)
+    reason = keep_reason(deployment, policy_for(deployment), now)
+    if reason is None and STATE_FILE:
+        resource_version = deployment.metadata.resource_version
+        if evaluation_cache().unchanged(key, resource_version, EVALUATION_GRACE):
+            reason = "as it hasn't changed since it was last evaluated"
+
+    if reason is None:
+        return True
+
+    log.info(f"{key}: will not be idled {reason}.")
+    DEPLOYMENTS.inc(result='evaluated')
+    DEPLOYMENTS.inc(result='skipped')
+    return False
+
+
+def fetch_deployment(deployment):
+    """
+    Returns the full deployment of the given metadata only one, `None` if
+    it's been deleted since it was listed.
+    """
+    metadata = deployment.metadata
     try:
-        usage = avg_cpu_percent(deployment)
-    except ValueError as ve:
-        log.exception(f'{key}: Using unknown unit of CPU: {ve}', exc_info=True)
+        return read_deployment(metadata.name, metadata.namespace)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        log.debug(f'{get_key(deployment)}: Deployment deleted since it was listed, ignoring it.')
+        return None
 
-    log.debug(f'{key}: Using {usage}% of CPU')
 
-    if usage > CPU_ACTIVITY_THRESHOLD:
+def read_deployment(name, namespace):
+    read_fn = client.AppsV1beta1Api(api_client()).read_namespaced_deployment
+    if FAST_DECODE:
+        response = with_retries(read_fn, name=name, namespace=namespace, _preload_content=False)
+        return records.Deployment.decode(json.loads(response.data))
+    return with_retries(read_fn, name=name, namespace=namespace)
+
+
+def should_idle(deployment, usage=None, now=None):
+    key = get_key(deployment)
+    policy = policy_for(deployment)
+
+    if now is None:
+        now = datetime.now(timezone.utc)
+
+    reason = keep_reason(deployment, policy, now)
+    if reason is not None:
+        log.info(f"{key}: will not be idled {reason}.")
+        return False
+
+    # only decisions based on the live usage are remembered, not the ones
+    # made for a given usage (e.g. plans, replays)
+    remember = usage is None and STATE_FILE
+    if remember:
+        resource_version = deployment.metadata.resource_version
+        if evaluation_cache().unchanged(key, resource_version, EVALUATION_GRACE):
+            log.debug(f"{key}: will not be idled as it hasn't changed since it was last evaluated.")
+            return False
+
+    if usage is None:
+        usage = cpu_percent(deployment, window=policy.window)
+
+    will_idle = usage <= policy.threshold
+    if remember:
+        evaluations.record(key, resource_version, will_idle)
+
+    if not will_idle:
         log.info(f"{key}: will not be idled as it's using {usage}% of CPU.")
         return False
 
@@ -143,106 +1419,467 @@ def should_idle(deployment):
     return True
 
 
-def core_val_with_unit_to_int(core_val_with_unit: str):
-    # millicpus have the 'm' suffix
-    if core_val_with_unit.endswith('m'):
-        return int(core_val_with_unit.rstrip('m'), 10)
-    elif core_val_with_unit.endswith('n'):
-        # nanocpus have the 'n' suffix
-        return int(core_val_with_unit.rstrip('n'), 10) / 1000000
-    elif core_val_with_unit.endswith('u'):
-        # microcpus (μ)
-        return int(core_val_with_unit.rstrip('u'), 10) / 1000
-    else:
-        # if the result is 0 then there is no suffix
-        return int(core_val_with_unit, 10)
+def keep_reason(deployment, policy, now):
+    """
+    Returns why the deployment shouldn't be idled (at the given time) given
+    its policy, metadata and when it last started, or `None`. Only needs the
+    deployment's metadata.
+    """
+    if not policy.allows(now):
+        return "at this time, as per its schedule"
+
+    if policy.min_age:
+        age = (now - deployment.metadata.creation_timestamp).total_seconds()
+        if age < policy.min_age:
+            return f"as it was only created {age:.0f}s ago"
+
+    if WARMUP_SECONDS:
+        started = last_started(deployment)
+        if started is not None:
+            uptime = (now - started).total_seconds()
+            if uptime < WARMUP_SECONDS:
+                return f"as it only started {uptime:.0f}s ago"
+
+    return None
+
+
+def last_started(deployment):
+    """
+    Returns when the app last (re)started, as far as we know: the latest of
+    when its pods started, its deployment became available and it was last
+    idled (it can only have been unidled since). `None` if unknown.
+    """
+    key = get_key(deployment)
+    times = []
+
+    started = pod_starts_lookup.get(key)
+    if started is not None:
+        times.append(started)
+
+    # not known from the metadata only
+    status = deployment.status
+    for condition in ((status.conditions if status is not None else None) or []):
+        if condition.type == 'Available' and condition.status == 'True' \
+                and condition.last_transition_time is not None:
+            times.append(condition.last_transition_time)
+
+    idled_at = (deployment.metadata.annotations or {}).get(IDLED_AT)
+    if idled_at:
+        try:
+            idled_at = datetime.fromisoformat(idled_at)
+            if idled_at.tzinfo is None:
+                idled_at = idled_at.replace(tzinfo=timezone.utc)
+            times.append(idled_at)
+        except ValueError:
+            log.debug(f'{key}: Invalid {IDLED_AT} annotation "{idled_at}", ignoring it.')
+
+    return max(times, default=None)
+
+
+def load_policies():
+    global rules
+    if POLICY_FILE and rules is None:
+        rules = policies.load(POLICY_FILE)
+        log.debug(f'{len(rules.rules)} policy rules loaded from {POLICY_FILE}.')
+
+
+def policy_for(deployment):
+    """
+    Returns the policy of the given deployment, with the global settings for
+    the ones it doesn't override.
+    """
+    policy = policies.DEFAULT
+    if rules is not None:
+        metadata = deployment.metadata
+        policy = rules.lookup(metadata.namespace, metadata.labels, metadata.annotations)
+
+    return policy.with_defaults(
+        threshold=CPU_ACTIVITY_THRESHOLD,
+        window=CPU_HISTORY_WINDOW,
+        min_age=0,
+    )
+
+
+def evaluation_cache():
+    global evaluations
+    # loaded once, even when deployments are idled concurrently
+    with _evaluations_lock:
+        if evaluations is None:
+            evaluations = state.Evaluations.load(shard_file(STATE_FILE))
+    return evaluations
 
 
-def avg_cpu_percent(deployment):
+def save_evaluations():
+    path = shard_file(STATE_FILE)
+    try:
+        evaluations.save(path, grace=EVALUATION_GRACE)
+    except OSError as e:
+        log.error(f'Failed to save evaluations to {path}: {e}')
+
+
+def cpu_percent(deployment, window=None):
+    usage = 0
     key = get_key(deployment)
+
     try:
-        metrics = metrics_lookup[key]
-    except KeyError as e:
-        log.warning(f'{key}: Metrics not found, pod may be unhealthy. Assuming 0% CPU usage.')
-        return 0
+        usage = avg_cpu_percent(deployment, window=window)
+    except ValueError as ve:
+        log.exception(f'{key}: Using unknown unit of CPU: {ve}', exc_info=True)
+
+    log.debug(f'{key}: Using {usage}% of CPU')
+    APP_CPU_USAGE.observe(usage)
+
+    return usage
+
+
+def core_val_with_unit_to_int(core_val_with_unit: str):
+    """
+    Returns the given amount of CPU in millicores (e.g. `100m`, `1.5`,
+    `250000n`).
+    """
+    return quantity.cpu_millicores(core_val_with_unit)
+
 
+def mem_val_with_unit_to_int(mem_val_with_unit: str):
+    """
+    Returns the given amount of memory in bytes (e.g. `512Mi`, `1G`).
+    """
+    return quantity.memory_bytes(mem_val_with_unit)
+
+
+def cpu_usage_per_replica(pods_metrics):
+    """
+    Returns the CPU usage of an app, averaged across its replicas.
+
+    This is the total usage of all the replicas' containers divided by the
+    number of replicas, to be compared with the limits of a single replica
+    (the deployment's pod template).
+    """
     usage = 0
-    for container in metrics.containers:
-        usage += core_val_with_unit_to_int(container.usage['cpu'])
+    for pod_metrics in pods_metrics:
+        for container in pod_metrics.containers:
+            usage += core_val_with_unit_to_int(container.usage['cpu'])
+    return usage / len(pods_metrics)
+
+
+def cpu_usage(deployment, window=None):
+    """
+    Returns the app's CPU usage (millicores) per replica: the statistic of its
+    usage over the `window` when `CPU_HISTORY_FILE` is set, or else its latest
+    usage. `None` if its metrics weren't found.
+    """
+    key = get_key(deployment)
 
-    total = 0
-    for container in deployment.spec.template.spec.containers:
-        total += core_val_with_unit_to_int(container.resources.limits['cpu'])
+    if cpu_history is not None:
+        usage = cpu_history.statistic(
+            key, CPU_HISTORY_STATISTIC, window or CPU_HISTORY_WINDOW)
+        if usage is not None:
+            return usage
+
+    pods_metrics = metrics_lookup.get(key)
+    if pods_metrics is None:
+        return None
+    return cpu_usage_per_replica(pods_metrics)
 
-    return usage / total * 100.0
+
+def cpu_limit(deployment):
+    """
+    Returns the CPU limit (millicores) of each pod of the deployment (of the
+    containers with a limit).
+    """
+    return pod_limits(deployment, 'cpu', core_val_with_unit_to_int)
+
+
+def avg_cpu_percent(deployment, window=None):
+    usage = cpu_usage(deployment, window=window)
+    if usage is None:
+        log.warning(f'{get_key(deployment)}: Metrics not found, pod may be unhealthy. Assuming 0% CPU usage.')
+        return 0
+
+    limit = cpu_limit(deployment)
+    if not limit:
+        # not as a `ValueError`, the app would be assumed idle
+        raise LookupError('No CPU limit set')
+
+    return usage / limit * 100.0
 
 
 def idle(deployment):
+    """
+    Idles the given deployment.
+
+    The app service is pointed to the unidler and then the deployment scaled
+    down. If either fails (e.g. part way through pointing the service to the
+    unidler in apply mode) the service is restored, so an app is never left
+    running behind the unidler.
+    """
     key = get_key(deployment)
 
     app = App(deployment.metadata.name, deployment.metadata.namespace)
 
-    app.redirect_to_unidler()
-    log.debug(f'{key}: Service pointed to unidler (set ServiceType to ExternalName, etc).')
+    service = app.get_service()
+
+    try:
+        app.redirect_to_unidler(service)
+        log.debug(f'{key}: Service pointed to unidler (set ServiceType to ExternalName, etc).')
+
+        app.scale_to_zero(replicas_when_unidled=deployment.spec.replicas)
+    except Exception as e:
+        log.error(f'{key}: Failed to idle, pointing service back to the app: {e}')
+        try:
+            app.restore_service(service)
+        except Exception as restore_error:
+            log.error(f'{key}: Failed to point service back to the app: {restore_error}')
+        raise
 
-    app.scale_to_zero(replicas_when_unidled=deployment.spec.replicas)
     log.debug(f'{key}: Deployment idled: Set replicas to 0, added labels and annotations.')
 
 
+def with_retries(fn, *args, **kwargs):
+    """
+    Calls the given API function, retrying it when it fails because of a
+    conflict, rate limiting or a server error.
+
+    Waits exponentially longer (with jitter) between attempts, or as long as
+    requested by the API server's `Retry-After` header.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except ApiException as e:
+            if e.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                raise
+
+            delay = retry_after(e)
+            if delay is None:
+                delay = RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1)
+
+            log.debug(f'API call failed with {e.status} {e.reason}, retrying in {delay:.2f}s.')
+            time.sleep(delay)
+
+
+def retry_after(api_exception):
+    try:
+        return float(api_exception.headers['Retry-After'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def unidler_service_patch():
+    """
+    Returns the patch pointing an app service to the unidler.
+    """
+    return {
+        "spec": {
+            "selector": None, # remove
+            "clusterIP": None, # remove
+            "type": SERVICE_TYPE_EXTERNAL_NAME,
+            "externalName": UNIDLER_SERVICE_HOST,
+            "ports": [
+                {
+                    "name": "http",
+                    "port": 80,
+                    "protocol": "TCP",
+                    "targetPort": 80
+                }
+            ]
+        }
+    }
+
+
+def unidler_service_manifest(name, namespace):
+    """
+    Returns the (partial) service to server-side apply to point an app
+    service to the unidler (making it an ExternalName one): only the fields
+    idling sets, see `unidler_service_json_patch()` for the ones it removes.
+    """
+    spec = {
+        field: value
+        for field, value in unidler_service_patch()["spec"].items()
+        if value is not None
+    }
+    return manifest("v1", "Service", name, namespace, {"spec": spec})
+
+
+def unidler_service_json_patch(service):
+    """
+    Returns the JSON patch removing the selector and cluster IP of the given
+    (previously read) service.
+
+    Server-side apply doesn't remove the fields other managers own (e.g.
+    Helm's selector) when they're sent as null. Everything else is left to
+    the apply (`unidler_service_manifest()`).
+    """
+    spec = service.spec
+    return [
+        {"op": "remove", "path": f"/spec/{field}"}
+        for field, value in [("selector", spec.selector), ("clusterIP", spec.cluster_ip)]
+        if value is not None
+    ]
+
+
+def idled_deployment_patch(replicas_when_unidled):
+    """
+    Returns the patch scaling a deployment down and marking it as idled.
+    """
+    idled_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+    return {
+        "spec": {
+            "replicas": 0
+        },
+        "metadata": {
+            "labels": {
+                IDLED: "true",
+            },
+            "annotations": {
+                IDLED_AT: idled_at,
+                REPLICAS_WHEN_UNIDLED: str(replicas_when_unidled),
+            },
+        },
+    }
+
+
+def manifest(api_version, kind, name, namespace, patch):
+    """
+    Returns the given patch as a (partial) object to server-side apply.
+    """
+    metadata = dict(patch.get("metadata", {}), name=name, namespace=namespace)
+    return {"apiVersion": api_version, "kind": kind, **patch, "metadata": metadata}
+
+
+def apply(path, name, namespace, body):
+    """
+    Server-side applies the given (partial) object as `FIELD_MANAGER`,
+    forcing conflicts.
+
+    The Kubernetes client doesn't support the apply patch content type, so
+    the request is made with the API client directly.
+    """
+    return api_client().call_api(
+        path, 'PATCH',
+        path_params={'name': name, 'namespace': namespace},
+        query_params=[('fieldManager', FIELD_MANAGER), ('force', 'true')],
+        header_params={
+            'Accept': 'application/json',
+            # JSON is valid YAML
+            'Content-Type': 'application/apply-patch+yaml',
+        },
+        body=json.dumps(body),
+        auth_settings=['BearerToken'],
+        _return_http_data_only=True,
+    )
+
+
 class App(object):
 
     def __init__(self, name, namespace):
         self.name = name
         self.namespace = namespace
 
-    def redirect_to_unidler(self):
-        patch = {
-            "spec": {
-                "selector": None, # remove
-                "clusterIP": None, # remove
-                "type": SERVICE_TYPE_EXTERNAL_NAME,
-                "externalName": UNIDLER_SERVICE_HOST,
-                "ports": [
-                    {
-                        "name": "http",
-                        "port": 80,
-                        "protocol": "TCP",
-                        "targetPort": 80
-                    }
-                ]
-            }
-        }
-
-        client.CoreV1Api().patch_namespaced_service(
+    def get_service(self):
+        return with_retries(
+            client.CoreV1Api(api_client()).read_namespaced_service,
             name=self.name,
             namespace=self.namespace,
-            body=patch,
         )
 
-    def scale_to_zero(self, replicas_when_unidled=1):
-        idled_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    def redirect_to_unidler(self, service):
+        """
+        Points the app service (as previously read) to the unidler.
+        """
+        core_api = client.CoreV1Api(api_client())
+
+        if PATCH_MODE == 'apply':
+            # the JSON patch removes the fields apply can't, the apply then
+            # takes over the fields idling sets
+            json_patch = unidler_service_json_patch(service)
+            if json_patch:
+                with_retries(
+                    core_api.patch_namespaced_service,
+                    name=self.name,
+                    namespace=self.namespace,
+                    body=json_patch,
+                )
+            with_retries(
+                apply, SERVICE_PATH, self.name, self.namespace,
+                body=unidler_service_manifest(self.name, self.namespace),
+            )
+            return
+
+        with_retries(
+            core_api.patch_namespaced_service,
+            name=self.name,
+            namespace=self.namespace,
+            body=unidler_service_patch(),
+        )
 
-        patch = {
-            "spec": {
-                "replicas": 0
-            },
-            "metadata": {
-                "labels": {
-                    IDLED: "true",
-                },
-                "annotations": {
-                    IDLED_AT: idled_at,
-                    REPLICAS_WHEN_UNIDLED: str(replicas_when_unidled),
-                },
-            },
-        }
+    def restore_service(self, service):
+        """
+        Replaces the app service with the given (previously read) one.
+        """
+        # the service changed since it was read and its cluster IP was
+        # released when it was pointed to the unidler
+        service.metadata.resource_version = None
+        service.spec.cluster_ip = None
+
+        with_retries(
+            client.CoreV1Api(api_client()).replace_namespaced_service,
+            name=self.name,
+            namespace=self.namespace,
+            body=service,
+        )
 
-        client.AppsV1beta1Api().patch_namespaced_deployment(
+    def scale_to_zero(self, replicas_when_unidled=1):
+        patch = idled_deployment_patch(replicas_when_unidled)
+
+        if PATCH_MODE == 'apply':
+            with_retries(
+                apply, DEPLOYMENT_PATH, self.name, self.namespace,
+                body=manifest("apps/v1", "Deployment", self.name, self.namespace, patch),
+            )
+        elif PATCH_MODE == 'scale':
+            self.scale_with_subresource(patch["metadata"])
+        else:
+            with_retries(
+                client.AppsV1beta1Api(api_client()).patch_namespaced_deployment,
+                self.name,
+                self.namespace,
+                body=patch,
+            )
+
+    def scale_with_subresource(self, metadata):
+        """
+        Labels the deployment as idled and then scales it down with the
+        `/scale` subresource. The label is removed if scaling down fails.
+        """
+        apps_api = client.AppsV1beta1Api(api_client())
+        with_retries(
+            apps_api.patch_namespaced_deployment,
             self.name,
             self.namespace,
-            body=patch,
+            body={"metadata": metadata},
         )
 
+        try:
+            with_retries(
+                apps_api.patch_namespaced_deployment_scale,
+                self.name,
+                self.namespace,
+                body={"spec": {"replicas": 0}},
+            )
+        except Exception:
+            try:
+                with_retries(
+                    apps_api.patch_namespaced_deployment,
+                    self.name,
+                    self.namespace,
+                    body={"metadata": {"labels": {IDLED: None}}},
+                )
+            except Exception as e:
+                log.error(f'({self.name}, {self.namespace}): Failed to remove {IDLED} label: {e}')
+            raise
+
 
 def load_kube_config():
     try:
@@ -255,6 +1892,17 @@ def load_kube_config():
         log.debug("Kubernetes configuration loaded from kube_config file.")
 
 
-if __name__ == '__main__':
+def main():
     load_kube_config()
-    idle_deployments()
+    if RUN_MODE == 'daemon':
+        import controller
+        controller.run()
+    else:
+        idle_deployments()
+
+
+if __name__ == '__main__':
+    # run as the `idler` module `controller` and `async_client` import, rather
+    # than as a second copy of it (`__main__`) with its own state
+    import idler
+    idler.main()
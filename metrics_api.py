@@ -33,6 +33,8 @@ class MetricsV1beta1Api(object):
             query_params.append(('continue', kwargs['_continue']))
         if 'label_selector' in kwargs:
             query_params.append(('labelSelector', kwargs['label_selector']))
+        if 'limit' in kwargs:
+            query_params.append(('limit', kwargs['limit']))
 
         form_params = []
         local_var_files = {}
@@ -0,0 +1,285 @@
+"""
+Idling policies: per namespace, label or annotation overrides of how apps are
+idled.
+
+Policies are read from a YAML (or JSON) file (see `POLICY_FILE`), e.g.:
+
+    rules:
+      - match:
+          namespace: user-alice
+        threshold: 50
+      - match:
+          namespace_prefix: airflow-
+          labels:
+            app: airflow-sqlite
+        threshold: 20
+        window: 7200
+        min_age: 3600
+        schedule:
+          - '19:00-07:00'
+      - match:
+          namespace_prefix: user-
+        calendar: london
+
+Each rule can match on the deployment's `namespace` (exact), `namespace_prefix`,
+`labels` and `annotations` (all given must match) and set:
+
+- `threshold`: CPU usage (percentage) above which the app isn't idled
+- `window`: CPU usage history window, in seconds
+- `min_age`: age (seconds) under which the deployment isn't idled
+- `schedule`: times of day (UTC) the app can be idled, e.g. `19:00-07:00`
+- `calendar`: name of the calendar (see `calendars.py`, defined under the
+  top-level `calendars`) whose business hours the app isn't idled during
+
+Rules are tried in the order they're listed and the first one matching gives
+the deployment's policy. Settings a rule doesn't set fall back to the ones of
+the top-level `default` policy (which also applies to the deployments no rule
+matches), then to the global ones (e.g. `CPU_ACTIVITY_THRESHOLD`).
+
+Rules are compiled into an index: each one is filed under the exact namespace,
+namespace prefix, label or annotation it matches on, so only the few rules
+which could match a deployment are tried, rather than all of them.
+"""
+
+from collections import namedtuple
+from datetime import timezone
+
+import yaml
+
+import calendars
+
+
+MATCH_FIELDS = {'namespace', 'namespace_prefix', 'labels', 'annotations'}
+POLICY_FIELDS = {'threshold', 'window', 'min_age', 'schedule', 'calendar'}
+
+
+class Policy(namedtuple('Policy', ['threshold', 'window', 'min_age', 'schedule', 'calendar'])):
+
+    def with_defaults(self, **defaults):
+        """
+        Returns the policy with its unset settings replaced by the defaults.
+        """
+        return self._replace(**{
+            name: value
+            for name, value in defaults.items()
+            if getattr(self, name) is None
+        })
+
+    def allows(self, when):
+        """
+        Returns whether apps can be idled at the given (timezone aware) time:
+        within their schedule and outside of their calendar's business hours.
+        """
+        if self.schedule is not None and not self.schedule.allows(when):
+            return False
+        if self.calendar is not None and self.calendar.is_business_time(when):
+            return False
+        return True
+
+
+DEFAULT = Policy(threshold=None, window=None, min_age=None, schedule=None, calendar=None)
+
+
+class Schedule(object):
+    """
+    Times of the day (UTC) apps can be idled, as `HH:MM-HH:MM` ranges. Ranges
+    ending before they start span midnight.
+    """
+
+    def __init__(self, ranges):
+        self.ranges = [calendars.parse_time_range(time_range) for time_range in ranges]
+
+    def allows(self, when):
+        when = when.astimezone(timezone.utc) if when.tzinfo else when
+        return any(calendars.in_time_range(when, time_range) for time_range in self.ranges)
+
+
+class Rule(object):
+
+    def __init__(self, match, policy):
+        self.namespace = match.get('namespace')
+        self.namespace_prefix = match.get('namespace_prefix')
+        self.labels = dict(match.get('labels') or {})
+        self.annotations = dict(match.get('annotations') or {})
+        self.policy = policy
+
+    def matches(self, namespace, labels, annotations):
+        if self.namespace is not None and namespace != self.namespace:
+            return False
+        if self.namespace_prefix is not None and not namespace.startswith(self.namespace_prefix):
+            return False
+        for name, value in self.labels.items():
+            if labels.get(name) != value:
+                return False
+        for name, value in self.annotations.items():
+            if annotations.get(name) != value:
+                return False
+        return True
+
+
+class Rules(object):
+    """
+    Index of the rules, see `lookup()`.
+    """
+
+    def __init__(self, rules, default=DEFAULT):
+        self.rules = rules
+        self.default = default
+        self.by_namespace = {}
+        self.by_namespace_prefix = {}
+        self.by_label = {}
+        self.by_annotation = {}
+        # rules without any condition match every deployment
+        self.unconditional = []
+
+        for position, rule in enumerate(rules):
+            # a rule only needs to be filed under one of its conditions, the
+            # others are checked when it's tried
+            if rule.namespace is not None:
+                self.by_namespace.setdefault(rule.namespace, []).append(position)
+            elif rule.namespace_prefix is not None:
+                self.by_namespace_prefix.setdefault(
+                    rule.namespace_prefix, []).append(position)
+            elif rule.labels:
+                label = sorted(rule.labels.items())[0]
+                self.by_label.setdefault(label, []).append(position)
+            elif rule.annotations:
+                annotation = sorted(rule.annotations.items())[0]
+                self.by_annotation.setdefault(annotation, []).append(position)
+            else:
+                self.unconditional.append(position)
+
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.by_namespace_prefix})
+
+    def candidates(self, namespace, labels, annotations):
+        """
+        Returns the positions of the rules which could match.
+        """
+        positions = list(self.unconditional)
+        positions.extend(self.by_namespace.get(namespace, ()))
+        for length in self.prefix_lengths:
+            if length > len(namespace):
+                break
+            positions.extend(self.by_namespace_prefix.get(namespace[:length], ()))
+        if self.by_label:
+            for label in labels.items():
+                positions.extend(self.by_label.get(label, ()))
+        if self.by_annotation:
+            for annotation in annotations.items():
+                positions.extend(self.by_annotation.get(annotation, ()))
+        return sorted(positions)
+
+    def lookup(self, namespace, labels=None, annotations=None):
+        """
+        Returns the policy of the first rule matching, or the default one.
+        """
+        labels = labels or {}
+        annotations = annotations or {}
+        for position in self.candidates(namespace, labels, annotations):
+            rule = self.rules[position]
+            if rule.matches(namespace, labels, annotations):
+                return rule.policy
+        return self.default
+
+    def any_allows(self, when):
+        """
+        Returns whether any app could be idled at the given time.
+        """
+        if self.default.allows(when):
+            return True
+        return any(rule.policy.allows(when) for rule in self.rules)
+
+
+def compile_rules(data):
+    """
+    Returns the `Rules` described by the given (parsed) policy file.
+
+    Raises `ValueError` if they're invalid.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('rules', []), list):
+        raise ValueError('Expected a mapping with a list of "rules"')
+
+    calendars_by_name = {}
+    for name, spec in (data.get('calendars') or {}).items():
+        try:
+            calendars_by_name[name] = calendars.parse(spec)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'Invalid calendar "{name}": {e}')
+
+    try:
+        default = compile_policy(data.get('default') or {}, calendars_by_name)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'Invalid default policy: {e}')
+
+    rules = []
+    for number, spec in enumerate(data.get('rules', []), start=1):
+        try:
+            rules.append(compile_rule(spec, calendars_by_name, default))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'Invalid rule #{number}: {e}')
+    return Rules(rules, default)
+
+
+def compile_rule(spec, calendars_by_name=None, default=DEFAULT):
+    if not isinstance(spec, dict):
+        raise ValueError('expected a mapping')
+
+    match = spec.get('match') or {}
+    unknown = set(match) - MATCH_FIELDS
+    if unknown:
+        raise ValueError(f'unknown fields {", ".join(sorted(unknown))}')
+
+    for name in ('labels', 'annotations'):
+        match[name] = {
+            str(key): str(value) for key, value in (match.get(name) or {}).items()
+        }
+
+    policy = compile_policy(
+        {name: value for name, value in spec.items() if name != 'match'},
+        calendars_by_name,
+    )
+    return Rule(match, policy.with_defaults(**default._asdict()))
+
+
+def compile_policy(spec, calendars_by_name=None):
+    if not isinstance(spec, dict):
+        raise ValueError('expected a mapping')
+
+    unknown = set(spec) - POLICY_FIELDS
+    if unknown:
+        raise ValueError(f'unknown fields {", ".join(sorted(unknown))}')
+
+    schedule = spec.get('schedule')
+    if schedule is not None:
+        if isinstance(schedule, str):
+            schedule = [schedule]
+        schedule = Schedule(schedule)
+
+    calendar = spec.get('calendar')
+    if calendar is not None:
+        try:
+            calendar = (calendars_by_name or {})[calendar]
+        except KeyError:
+            raise ValueError(f'unknown calendar "{calendar}"')
+
+    return Policy(
+        threshold=optional(float, spec.get('threshold')),
+        window=optional(int, spec.get('window')),
+        min_age=optional(int, spec.get('min_age')),
+        schedule=schedule,
+        calendar=calendar,
+    )
+
+
+def optional(convert, value):
+    if value is None:
+        return None
+    return convert(value)
+
+
+def load(path):
+    """
+    Returns the `Rules` of the given policy file.
+    """
+    with open(path) as f:
+        return compile_rules(yaml.safe_load(f) or {})
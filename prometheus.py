@@ -0,0 +1,199 @@
+"""
+Minimal Prometheus instrumentation.
+
+Metrics are rendered in the Prometheus text exposition format, to be written
+to a file picked up by the node exporter's textfile collector or pushed to a
+Pushgateway. The metrics describe a single run: `Registry.reset()` is called
+at the start of each one.
+"""
+
+from contextlib import contextmanager
+import logging
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+
+log = logging.getLogger('idler.prometheus')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'),
+        )
+        for name, value in labels
+    )
+    return '{' + pairs + '}'
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def label_values(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Yields `(name, labels, value)` tuples.
+        """
+        with self.lock:
+            values = dict(self.values)
+        for label_values, value in sorted(values.items()):
+            yield self.name, list(zip(self.labelnames, label_values)), value
+
+    def render(self, const_labels=()):
+        """
+        Renders the metric, adding the given `(name, value)` labels to all of
+        its samples.
+        """
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for name, labels, value in self.samples():
+            labels = list(const_labels) + labels
+            lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.label_values(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Sets the gauge to the duration of the block, in seconds.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.set(time.perf_counter() - started, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.buckets = sorted(buckets) + [float('inf')]
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            counts = [
+                count + 1 if value <= bound else count
+                for count, bound in zip(counts, self.buckets)
+            ]
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the duration of the block, in seconds.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for label_values, (counts, total) in sorted(values.items()):
+            labels = list(zip(self.labelnames, label_values))
+            for bound, count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket', labels + [('le', format_value(bound))], count
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, counts[-1]
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def render(self, const_labels=None):
+        const_labels = sorted((const_labels or {}).items())
+        return '\n'.join(metric.render(const_labels) for metric in self.metrics) + '\n'
+
+    def write_textfile(self, path, const_labels=None):
+        """
+        Writes the metrics to the given file, with the given labels added to
+        all of them (e.g. to tell apart the files of several instances).
+        """
+        # the textfile collector may read the file at any time, so it's
+        # written to a temporary file and then moved in place
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render(const_labels))
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def push(self, gateway_url, job, grouping_key=None, timeout=10):
+        """
+        Pushes the metrics to a Pushgateway, replacing the ones previously
+        pushed with the same job and grouping key.
+        """
+        url = f"{gateway_url.rstrip('/')}/metrics/job/{quote(job, safe='')}"
+        for name, value in sorted((grouping_key or {}).items()):
+            url += f"/{name}/{quote(str(value), safe='')}"
+
+        request = Request(
+            url,
+            data=self.render().encode('utf-8'),
+            method='PUT',
+            headers={'Content-Type': CONTENT_TYPE},
+        )
+        with urlopen(request, timeout=timeout) as response:
+            response.read()
@@ -0,0 +1,331 @@
+"""
+Decodes list responses in the Kubernetes protobuf encoding (see `PROTOBUF`)
+into the compact records of `records.py`.
+
+A Kubernetes protobuf response is the `k8s\\x00` magic prefix followed by a
+`runtime.Unknown` message, whose `raw` field holds the encoded object (e.g. a
+`PodList`). See
+https://github.com/kubernetes/community/blob/master/contributors/design-proposals/api-machinery/protobuf.md
+
+Only the fields the records hold are decoded, following the field numbers of
+the Kubernetes `generated.proto` files. The others are skipped without being
+decoded, so (unlike JSON) the bulk of the objects (e.g. `managedFields` or
+the pods' volumes) costs little more than reading past it.
+
+This is a minimal decoder of the protobuf wire format, rather than a
+dependency on the `protobuf` package and the Kubernetes `.proto` files.
+"""
+
+from datetime import datetime, timedelta, timezone
+import sys
+
+import records
+
+
+MAGIC = b'k8s\x00'
+CONTENT_TYPE = 'application/vnd.kubernetes.protobuf'
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def varint(data, pos):
+    """
+    Returns the varint at the given position and the position after it.
+    """
+    byte = data[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+
+    result = byte & 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        byte = data[pos]
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos + 1
+        shift += 7
+
+
+def parse(data):
+    """
+    Yields the `(field number, value)` pairs of the given (`memoryview` of a)
+    message: an `int` for varints and a `memoryview` for the others.
+    """
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = varint(data, pos)
+        wire_type = key & 7
+        if wire_type == VARINT:
+            value, pos = varint(data, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == FIXED64:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == FIXED32:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f'Unsupported wire type {wire_type}')
+
+        if pos > end:
+            raise ValueError('Truncated message')
+        yield key >> 3, value
+
+
+def string(value):
+    return str(value, 'utf-8')
+
+
+def time(value):
+    # k8s.io.apimachinery.pkg.apis.meta.v1.Time
+    seconds = nanos = 0
+    for number, field in parse(value):
+        if number == 1:
+            seconds = field
+        elif number == 2:
+            nanos = field
+    return EPOCH + timedelta(seconds=seconds, microseconds=nanos // 1000)
+
+
+def duration(value):
+    # k8s.io.apimachinery.pkg.apis.meta.v1.Duration, in nanoseconds, formatted
+    # like in JSON (e.g. `30s`)
+    nanoseconds = 0
+    for number, field in parse(value):
+        if number == 1:
+            nanoseconds = field
+    seconds = nanoseconds / 1e9
+    return f'{seconds:g}s'
+
+
+def quantity(value):
+    # k8s.io.apimachinery.pkg.api.resource.Quantity
+    for number, field in parse(value):
+        if number == 1:
+            return string(field)
+    return None
+
+
+def int32(value):
+    # negative values are encoded as 64 bits two's complement
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def map_of(decode_value):
+    """
+    Returns the decoder of the entries (`key = 1`, `value = 2`) of a map.
+    """
+    def decode_entry(value):
+        key = entry_value = None
+        for number, field in parse(value):
+            if number == 1:
+                # keys (e.g. `app` or `cpu`) are shared, like `json` does
+                key = sys.intern(string(field))
+            elif number == 2:
+                entry_value = decode_value(field)
+        return key, entry_value
+    return decode_entry
+
+
+SINGLE = 'single'
+REPEATED = 'repeated'
+MAP = 'map'
+
+# record type -> {field number: (attribute, decoder, kind)}
+SCHEMAS = {}
+
+
+def message(record, fields):
+    """
+    Registers the field numbers of the given record type and returns its
+    decoder.
+    """
+    SCHEMAS[record] = fields
+    return lambda value: decode(record, value)
+
+
+def decode(record, data):
+    """
+    Decodes the given (`memoryview` of a) message into a record of the given
+    type.
+    """
+    fields = SCHEMAS[record]
+    obj = record.__new__(record)
+    for name in record.__slots__:
+        setattr(obj, name, None)
+
+    for number, value in parse(data):
+        field = fields.get(number)
+        if field is None:
+            continue
+
+        name, decode_field, kind = field
+        if kind is SINGLE:
+            setattr(obj, name, decode_field(value))
+        elif kind is REPEATED:
+            values = getattr(obj, name)
+            if values is None:
+                values = []
+                setattr(obj, name, values)
+            values.append(decode_field(value))
+        else:
+            entries = getattr(obj, name)
+            if entries is None:
+                entries = {}
+                setattr(obj, name, entries)
+            key, entry_value = decode_field(value)
+            entries[key] = entry_value
+    return obj
+
+
+owner_reference = message(records.OwnerReference, {
+    1: ('kind', string, SINGLE),
+    3: ('name', string, SINGLE),
+})
+
+object_meta = message(records.ObjectMeta, {
+    1: ('name', string, SINGLE),
+    3: ('namespace', string, SINGLE),
+    6: ('resource_version', string, SINGLE),
+    8: ('creation_timestamp', time, SINGLE),
+    11: ('labels', map_of(string), MAP),
+    12: ('annotations', map_of(string), MAP),
+    13: ('owner_references', owner_reference, REPEATED),
+})
+
+list_meta = message(records.ListMeta, {
+    2: ('resource_version', string, SINGLE),
+    3: ('_continue', string, SINGLE),
+})
+
+pod_spec = message(records.PodSpec, {
+    10: ('node_name', string, SINGLE),
+})
+
+pod_status = message(records.PodStatus, {
+    1: ('phase', string, SINGLE),
+    7: ('start_time', time, SINGLE),
+})
+
+message(records.Pod, {
+    1: ('metadata', object_meta, SINGLE),
+    2: ('spec', pod_spec, SINGLE),
+    3: ('status', pod_status, SINGLE),
+})
+
+container_metrics = message(records.ContainerMetrics, {
+    1: ('name', string, SINGLE),
+    2: ('usage', map_of(quantity), MAP),
+})
+
+message(records.PodMetrics, {
+    1: ('metadata', object_meta, SINGLE),
+    2: ('timestamp', time, SINGLE),
+    3: ('window', duration, SINGLE),
+    4: ('containers', container_metrics, REPEATED),
+})
+
+resource_requirements = message(records.ResourceRequirements, {
+    1: ('limits', map_of(quantity), MAP),
+    2: ('requests', map_of(quantity), MAP),
+})
+
+container = message(records.Container, {
+    1: ('name', string, SINGLE),
+    8: ('resources', resource_requirements, SINGLE),
+})
+
+template_spec = message(records.TemplateSpec, {
+    2: ('containers', container, REPEATED),
+})
+
+pod_template = message(records.PodTemplate, {
+    2: ('spec', template_spec, SINGLE),
+})
+
+deployment_spec = message(records.DeploymentSpec, {
+    1: ('replicas', int32, SINGLE),
+    3: ('template', pod_template, SINGLE),
+})
+
+deployment_condition = message(records.DeploymentCondition, {
+    1: ('type', string, SINGLE),
+    2: ('status', string, SINGLE),
+    7: ('last_transition_time', time, SINGLE),
+})
+
+deployment_status = message(records.DeploymentStatus, {
+    6: ('conditions', deployment_condition, REPEATED),
+})
+
+# the same for apps/v1beta1, apps/v1beta2 and apps/v1
+message(records.Deployment, {
+    1: ('metadata', object_meta, SINGLE),
+    2: ('spec', deployment_spec, SINGLE),
+    3: ('status', deployment_status, SINGLE),
+})
+
+
+def is_protobuf(content_type):
+    return (content_type or '').split(';')[0].strip() == CONTENT_TYPE
+
+
+def unwrap(data):
+    """
+    Returns the kind and the (`memoryview` of the) encoded object of the
+    given response body.
+    """
+    if not data.startswith(MAGIC):
+        raise ValueError('Not a Kubernetes protobuf message')
+
+    kind = raw = None
+    for number, value in parse(memoryview(data)[len(MAGIC):]):
+        if number == 1:
+            # TypeMeta: apiVersion = 1, kind = 2
+            for type_number, type_value in parse(value):
+                if type_number == 2:
+                    kind = string(type_value)
+        elif number == 2:
+            raw = value
+        elif number == 3 and len(value):
+            raise ValueError(f'Unsupported content encoding "{string(value)}"')
+
+    if raw is None:
+        raise ValueError('Empty protobuf message')
+    return kind, raw
+
+
+def decode_list(data, record):
+    """
+    Decodes a list response (protobuf bytes) into a `records.List` of the
+    given record type.
+
+    Lists of `PartialObjectMetadata` (see `METADATA_ONLY`) decode too, into
+    records with only their `metadata` set.
+    """
+    kind, raw = unwrap(data)
+    if kind is not None and not kind.endswith('List'):
+        raise ValueError(f'Expected a list, got a {kind}')
+
+    metadata = None
+    items = []
+    for number, value in parse(raw):
+        if number == 1:
+            metadata = list_meta(value)
+        elif number == 2:
+            items.append(decode(record, value))
+
+    return records.List(
+        items=items,
+        metadata=metadata if metadata is not None else records.ListMeta.decode({}),
+    )
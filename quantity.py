@@ -0,0 +1,150 @@
+"""
+Parsing of Kubernetes resource quantities, e.g. `100m`, `1.5`, `2Gi`, `1e3`.
+
+See https://kubernetes.io/docs/reference/kubernetes-api/common-definitions/quantity/
+
+Quantities are parsed exactly. Integers with an optional suffix (e.g.
+`1425000000n` or `512Mi`), the form of almost all quantities, are parsed with
+integer arithmetic only. The other forms (decimals, exponents) are parsed as
+fractions and the results cached.
+"""
+
+from fractions import Fraction
+from functools import lru_cache
+import re
+
+
+SUFFIXES = {
+    'n': Fraction(1, 10 ** 9),
+    'u': Fraction(1, 10 ** 6),
+    'm': Fraction(1, 10 ** 3),
+    '': 1,
+    'k': 10 ** 3,
+    # not valid in Kubernetes but commonly used for kilo
+    'K': 10 ** 3,
+    'M': 10 ** 6,
+    'G': 10 ** 9,
+    'T': 10 ** 12,
+    'P': 10 ** 15,
+    'E': 10 ** 18,
+    'Ki': 2 ** 10,
+    'Mi': 2 ** 20,
+    'Gi': 2 ** 30,
+    'Ti': 2 ** 40,
+    'Pi': 2 ** 50,
+    'Ei': 2 ** 60,
+}
+
+QUANTITY = re.compile(r'''
+    ^
+    (?P<number>[+-]?(?:\d+(?:\.\d*)?|\.\d+))
+    (?:
+        [eE](?P<exponent>[+-]?\d+)
+      | (?P<suffix>[KMGTPE]i|[numkKMGTPE])
+    )?
+    $
+''', re.VERBOSE)
+
+CACHE_SIZE = 8192
+
+# suffix -> (numerator, denominator) of its value in millicores
+MILLICORES = {
+    suffix: (millicores.numerator, millicores.denominator)
+    for suffix, millicores in (
+        (suffix, Fraction(multiplier) * 1000) for suffix, multiplier in SUFFIXES.items()
+    )
+}
+
+
+def split_integer(quantity):
+    """
+    Returns the number and suffix of the given quantity if it's an integer
+    with an optional suffix (e.g. `1425000000n`), `None` otherwise.
+    """
+    if quantity[-1:] == 'i':
+        number, suffix = quantity[:-2], quantity[-2:]
+    elif quantity[-1:].isalpha():
+        number, suffix = quantity[:-1], quantity[-1:]
+    else:
+        number, suffix = quantity, ''
+
+    if suffix in SUFFIXES and number.isdigit() and number.isascii():
+        return int(number), suffix
+    return None
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse(quantity):
+    """
+    Returns the given quantity as an (exact) `Fraction`.
+
+    Raises `ValueError` if it isn't a valid quantity.
+    """
+    match = QUANTITY.match(quantity.strip())
+    if not match:
+        raise ValueError(f'Invalid quantity "{quantity}"')
+
+    number = match.group('number')
+    # Fraction(int) is much cheaper than parsing a decimal string
+    if number.lstrip('+-').isdigit():
+        value = Fraction(int(number))
+    else:
+        value = Fraction(number)
+    exponent = match.group('exponent')
+    if exponent is not None:
+        return value * Fraction(10) ** int(exponent)
+    return value * SUFFIXES[match.group('suffix') or '']
+
+
+def to_number(value):
+    # ints stay exact, other values are rounded to the nearest float
+    if value.denominator == 1:
+        return value.numerator
+    return float(value)
+
+
+def cpu_millicores(quantity):
+    """
+    Returns the given CPU quantity in millicores.
+    """
+    # called for every container of every pod's metrics, so the integer
+    # case is inlined rather than going through `split_integer()`
+    scale = MILLICORES.get(quantity[-1:])
+    if scale is None:
+        number, scale = quantity, MILLICORES['']
+    else:
+        number = quantity[:-1]
+    if not (number.isdigit() and number.isascii()):
+        return _cpu_millicores(quantity)
+
+    numerator, denominator = scale
+    value = int(number) * numerator
+    if value % denominator:
+        # int division is correctly rounded, like `to_number()`
+        return value / denominator
+    return value // denominator
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _cpu_millicores(quantity):
+    return to_number(parse(quantity) * 1000)
+
+
+def memory_bytes(quantity):
+    """
+    Returns the given memory quantity in (whole) bytes.
+    """
+    integer = split_integer(quantity)
+    if integer is None:
+        return _memory_bytes(quantity)
+
+    number, suffix = integer
+    multiplier = SUFFIXES[suffix]
+    if isinstance(multiplier, int):
+        return number * multiplier
+    return int(number * multiplier)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _memory_bytes(quantity):
+    return int(parse(quantity))
@@ -0,0 +1,312 @@
+"""
+Compact records for the pods, pod metrics and deployments listed by the idler
+(see `FAST_DECODE`).
+
+The Kubernetes client deserializes responses into full models (e.g. a
+`V1ObjectMeta`, with all its fields, for every object) going through its
+generic, type-string driven deserializer. Instead, responses are decoded
+straight from JSON into `__slots__` records holding only the fields the idler
+reads, with the same attribute names, so the rest of the idler works on
+either.
+
+Records have `openapi_types` and `attribute_map` like the client's models, so
+`ApiClient.sanitize_for_serialization()` serializes them (e.g. when recording
+snapshots).
+"""
+
+import codecs
+from datetime import datetime, timezone
+import json
+
+from dateutil.parser import isoparse
+
+
+class Record(object):
+    __slots__ = ()
+
+    # field name -> (JSON key, decoder)
+    fields = {}
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    @classmethod
+    def decode(cls, data):
+        record = cls.__new__(cls)
+        for name, (key, decode) in cls.fields.items():
+            value = data.get(key)
+            if value is not None and decode is not None:
+                value = decode(value)
+            setattr(record, name, value)
+        return record
+
+    def __eq__(self, other):
+        if not isinstance(other, self.__class__):
+            return False
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        values = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{self.__class__.__name__}({values})'
+
+
+def record_type(name, fields):
+    """
+    Returns a `Record` class with the given fields, a mapping of field names
+    to `(JSON key, decoder)` pairs.
+    """
+    return type(name, (Record,), {
+        '__slots__': tuple(fields),
+        'fields': fields,
+        # used by ApiClient.sanitize_for_serialization()
+        'openapi_types': {field: 'object' for field in fields},
+        'attribute_map': {field: key for field, (key, _) in fields.items()},
+    })
+
+
+def timestamp(value):
+    # timestamps are almost always in this format, which strptime parses
+    # much faster than a generic ISO 8601 parser
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return isoparse(value)
+
+
+def list_of(record):
+    return lambda values: [record.decode(value) for value in values]
+
+
+OwnerReference = record_type('OwnerReference', {
+    'kind': ('kind', None),
+    'name': ('name', None),
+})
+
+ObjectMeta = record_type('ObjectMeta', {
+    'name': ('name', None),
+    'namespace': ('namespace', None),
+    'labels': ('labels', None),
+    'annotations': ('annotations', None),
+    'resource_version': ('resourceVersion', None),
+    'creation_timestamp': ('creationTimestamp', timestamp),
+    'owner_references': ('ownerReferences', list_of(OwnerReference)),
+})
+
+ListMeta = record_type('ListMeta', {
+    '_continue': ('continue', None),
+    'resource_version': ('resourceVersion', None),
+})
+
+PodSpec = record_type('PodSpec', {
+    'node_name': ('nodeName', None),
+})
+
+PodStatus = record_type('PodStatus', {
+    'phase': ('phase', None),
+    'start_time': ('startTime', timestamp),
+})
+
+Pod = record_type('Pod', {
+    'metadata': ('metadata', ObjectMeta.decode),
+    'spec': ('spec', PodSpec.decode),
+    'status': ('status', PodStatus.decode),
+})
+
+ContainerMetrics = record_type('ContainerMetrics', {
+    'name': ('name', None),
+    'usage': ('usage', None),
+})
+
+PodMetrics = record_type('PodMetrics', {
+    'metadata': ('metadata', ObjectMeta.decode),
+    'timestamp': ('timestamp', timestamp),
+    'window': ('window', None),
+    'containers': ('containers', list_of(ContainerMetrics)),
+})
+
+ResourceRequirements = record_type('ResourceRequirements', {
+    'limits': ('limits', None),
+    'requests': ('requests', None),
+})
+
+Container = record_type('Container', {
+    'name': ('name', None),
+    'resources': ('resources', ResourceRequirements.decode),
+})
+
+TemplateSpec = record_type('TemplateSpec', {
+    'containers': ('containers', list_of(Container)),
+})
+
+PodTemplate = record_type('PodTemplate', {
+    'spec': ('spec', TemplateSpec.decode),
+})
+
+DeploymentSpec = record_type('DeploymentSpec', {
+    'replicas': ('replicas', None),
+    'template': ('template', PodTemplate.decode),
+})
+
+DeploymentCondition = record_type('DeploymentCondition', {
+    'type': ('type', None),
+    'status': ('status', None),
+    'last_transition_time': ('lastTransitionTime', timestamp),
+})
+
+DeploymentStatus = record_type('DeploymentStatus', {
+    'conditions': ('conditions', list_of(DeploymentCondition)),
+})
+
+Deployment = record_type('Deployment', {
+    'metadata': ('metadata', ObjectMeta.decode),
+    'spec': ('spec', DeploymentSpec.decode),
+    'status': ('status', DeploymentStatus.decode),
+})
+
+
+class List(object):
+    """
+    A page of a list, with the `items` and `metadata` (e.g. `_continue`) of
+    the client's list models.
+    """
+    __slots__ = ('items', 'metadata')
+
+    def __init__(self, items, metadata):
+        self.items = items
+        self.metadata = metadata
+
+
+def decode_list(data, record):
+    """
+    Decodes a list response (JSON bytes or string) into `List` of the given
+    record type.
+    """
+    response = json.loads(data)
+    return List(
+        items=[record.decode(item) for item in response.get('items') or []],
+        metadata=ListMeta.decode(response.get('metadata') or {}),
+    )
+
+
+CHUNK_SIZE = 64 * 1024
+
+DECODER = json.JSONDecoder()
+
+
+class JSONStream(object):
+    """
+    Reads JSON values one at a time from an iterator of byte chunks, holding
+    only the text of the current value (and the rest of its chunk) in memory.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Appends the next chunk to the buffer. Returns `False` at the end.
+        """
+        if self.eof:
+            return False
+        try:
+            text = self.decoder.decode(next(self.chunks))
+        except StopIteration:
+            self.eof = True
+            text = self.decoder.decode(b'', final=True)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return bool(text) or not self.eof
+
+    def peek(self):
+        """
+        Returns the next non-whitespace character, without consuming it.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'Expected "{char}" at "{self.buffer[self.pos:self.pos + 20]}"')
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            # a number or literal may go on in the next chunk
+            if end == len(self.buffer) and self.buffer[self.pos] not in '{["' and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def stream_list(chunks, record):
+    """
+    Decodes a list response, read from the given iterator of byte chunks,
+    into a `List` whose items are decoded as they're iterated over. Only one
+    item at a time is held in memory, rather than the whole response.
+
+    The list's metadata is decoded straight away when (as the API server
+    does) it's sent before the items, otherwise once the items have been
+    iterated over.
+    """
+    stream = JSONStream(chunks)
+    page = List(items=iter(()), metadata=ListMeta.decode({}))
+    stream.expect('{')
+    if _read_members(stream, page):
+        page.items = _items(stream, page, record)
+    return page
+
+
+def _read_members(stream, page):
+    """
+    Reads the members of the list up to its items. Returns whether they were
+    found.
+    """
+    while True:
+        char = stream.peek()
+        if char == '}':
+            stream.pos += 1
+            return False
+        if char == ',':
+            stream.pos += 1
+            continue
+
+        key = stream.value()
+        stream.expect(':')
+        if key == 'items' and stream.peek() == '[':
+            stream.pos += 1
+            return True
+
+        value = stream.value()
+        if key == 'metadata' and value is not None:
+            page.metadata = ListMeta.decode(value)
+
+
+def _items(stream, page, record):
+    while True:
+        char = stream.peek()
+        if char == ']':
+            stream.pos += 1
+            break
+        if char == ',':
+            stream.pos += 1
+            continue
+        yield record.decode(stream.value())
+
+    _read_members(stream, page)
@@ -0,0 +1,177 @@
+"""
+Replays recorded snapshots (see `SNAPSHOT_FILE`) offline.
+
+Each snapshot's deployments are evaluated with the idler's logic against the
+pods and metrics recorded with them, without talking to a cluster. Snapshots
+are streamed, so only the pods lookups of one snapshot are held in memory.
+
+Usage:
+
+    python replay.py [--threshold 50,70,90] [--plan] SNAPSHOT...
+
+For each snapshot and CPU threshold (`CPU_ACTIVITY_THRESHOLD` by default) it
+reports how many deployments would be idled and the CPU (millicores) and
+memory (bytes) their pods request. `--plan` writes the plan of each
+deployment (as JSON lines, using the first threshold) instead. The policies
+of `POLICY_FILE` override the threshold for the deployments they match.
+
+Deployments are evaluated at the time the snapshot was recorded, e.g. against
+their policies' schedules.
+"""
+
+import argparse
+from datetime import datetime, timezone
+import json
+from types import SimpleNamespace
+import sys
+
+from kubernetes.client import ApiClient
+
+import idler
+from idler import log
+import snapshot
+
+
+RESPONSE_TYPES = {
+    snapshot.POD: 'V1Pod',
+    snapshot.POD_METRICS: 'MetricsV1beta1PodMetrics',
+    snapshot.DEPLOYMENT: 'AppsV1beta1Deployment',
+}
+
+
+def deserialize(api_client, kind, raw):
+    return api_client.deserialize(
+        SimpleNamespace(data=json.dumps(raw)), RESPONSE_TYPES[kind])
+
+
+def read(path, api_client=None):
+    """
+    Returns when the given snapshot was recorded (`None` if unknown) and an
+    iterator over its deployments, see `deployments()`.
+    """
+    header, objects = snapshot.read(path)
+    return recorded_at(header), deployments(objects, api_client=api_client)
+
+
+def recorded_at(header):
+    try:
+        when = datetime.fromisoformat(header['recorded_at'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when
+
+
+def deployments(objects, api_client=None):
+    """
+    Loads the pods and metrics lookups from the given snapshot objects and
+    yields its deployments.
+    """
+    if api_client is None:
+        api_client = ApiClient()
+
+    idler.pods_lookup.clear()
+    idler.metrics_lookup.clear()
+
+    for kind, raw in objects:
+        obj = deserialize(api_client, kind, raw)
+        if kind == snapshot.POD:
+            idler.add_pod(obj)
+        elif kind == snapshot.POD_METRICS:
+            idler.add_pod_metrics(obj)
+        elif kind == snapshot.DEPLOYMENT:
+            yield obj
+
+
+def summarize(path, thresholds):
+    """
+    Returns, for each threshold, the number of deployments which would be
+    idled (at the time the snapshot was recorded) and the resources their
+    pods request, and the number which failed to be evaluated.
+    """
+    summary = {
+        threshold: {'evaluated': 0, 'idled': 0, 'failed': 0, 'cpu': 0, 'memory': 0}
+        for threshold in thresholds
+    }
+
+    now, snapshot_deployments = read(path)
+    default_threshold = idler.CPU_ACTIVITY_THRESHOLD
+    try:
+        for deployment in snapshot_deployments:
+            try:
+                decisions = evaluate(deployment, thresholds, now)
+            except Exception as e:
+                deploy_id = f"({deployment.metadata.namespace}, {deployment.metadata.name})"
+                log.error(f"Failed to evaluate {deploy_id} deployment: {e}")
+                decisions = None
+
+            replicas = deployment.spec.replicas or 0
+            for threshold in thresholds:
+                result = summary[threshold]
+                result['evaluated'] += 1
+                if decisions is None:
+                    result['failed'] += 1
+                elif decisions[threshold]:
+                    result['idled'] += 1
+                    result['cpu'] += replicas * idler.pod_resources(
+                        deployment, 'cpu', idler.core_val_with_unit_to_int)
+                    result['memory'] += replicas * idler.pod_resources(
+                        deployment, 'memory', idler.mem_val_with_unit_to_int)
+    finally:
+        idler.CPU_ACTIVITY_THRESHOLD = default_threshold
+
+    return summary
+
+
+def evaluate(deployment, thresholds, now):
+    """
+    Returns whether the given deployment would be idled at each threshold.
+    """
+    usage = idler.cpu_percent(deployment)
+    decisions = {}
+    for threshold in thresholds:
+        idler.CPU_ACTIVITY_THRESHOLD = threshold
+        decisions[threshold] = idler.should_idle(deployment, usage=usage, now=now)
+    return decisions
+
+
+def thresholds(value):
+    """
+    Parses a comma-separated list of CPU thresholds.
+    """
+    try:
+        return [int(threshold) for threshold in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid thresholds "{value}"')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('snapshots', nargs='+', metavar='SNAPSHOT')
+    parser.add_argument(
+        '--threshold', type=thresholds,
+        default=[idler.CPU_ACTIVITY_THRESHOLD],
+        help='comma-separated CPU thresholds (percentage) to evaluate')
+    parser.add_argument(
+        '--plan', action='store_true',
+        help='write the plan of each deployment instead of a summary')
+    args = parser.parse_args(argv)
+
+    # the policies (see `POLICY_FILE`) override the thresholds of the
+    # deployments they match, as in the runs recorded
+    idler.load_policies()
+
+    for path in args.snapshots:
+        if args.plan:
+            idler.CPU_ACTIVITY_THRESHOLD = args.threshold[0]
+            now, snapshot_deployments = read(path)
+            idler.write_plan_to(sys.stdout, snapshot_deployments, now=now)
+            continue
+
+        for threshold, result in summarize(path, args.threshold).items():
+            print(json.dumps({'snapshot': path, 'threshold': threshold, **result}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Splits the namespaces between several idlers (see `SHARD_COUNT`), each
+idling only the apps of its own shard of the namespaces.
+
+A namespace belongs to shard `crc32(namespace) % count`, so every idler
+agrees on it without coordinating, and all the apps of a namespace are
+handled by the same idler.
+
+Usage:
+
+    python shards.py which --count 4 NAMESPACE...
+    python shards.py merge [--count 4] PLAN...
+
+`which` prints the shard of each namespace. `merge` merges the plans written
+by the shards in dry runs (see `PLAN_FILE`) into one report: the number of
+deployments evaluated and idled and the resources reclaimed, overall and per
+shard. It fails if a namespace was planned by more than one shard or (given
+`--count`) a shard is missing.
+"""
+
+import argparse
+import json
+import sys
+import zlib
+
+
+def shard_of(namespace, count):
+    """
+    Returns the shard (from 0 to `count - 1`) of the given namespace.
+    """
+    return zlib.crc32(namespace.encode('utf-8')) % count
+
+
+def merge(entries, count=None):
+    """
+    Returns the report of the given plan entries of all the shards.
+
+    Raises `ValueError` if a namespace was planned by more than one shard or
+    a shard (of `count`, if given) is missing.
+    """
+    report = {'evaluated': 0, 'idled': 0, 'reclaimed': {'cpu': 0, 'memory': 0}, 'shards': {}}
+    planned_by = {}
+    for entry in entries:
+        shard = entry.get('shard', 0)
+        namespace = entry['namespace']
+        if planned_by.setdefault(namespace, shard) != shard:
+            raise ValueError(
+                f'Namespace "{namespace}" planned by shards {planned_by[namespace]} and {shard}')
+
+        for totals in (report, report['shards'].setdefault(
+                shard, {'evaluated': 0, 'idled': 0, 'reclaimed': {'cpu': 0, 'memory': 0}})):
+            totals['evaluated'] += 1
+            if entry['decision'] == 'idle':
+                totals['idled'] += 1
+                for resource, amount in entry['reclaimed'].items():
+                    totals['reclaimed'][resource] += amount
+
+    if count is not None:
+        missing = sorted(set(range(count)) - set(report['shards']))
+        if missing:
+            raise ValueError(f'Missing plans of shards {", ".join(map(str, missing))}')
+
+    report['shards'] = {str(shard): totals for shard, totals in sorted(report['shards'].items())}
+    return report
+
+
+def read_plans(paths):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    which = commands.add_parser('which', help='print the shard of each namespace')
+    which.add_argument('--count', type=int, required=True, help='number of shards')
+    which.add_argument('namespaces', nargs='+', metavar='NAMESPACE')
+
+    merging = commands.add_parser('merge', help="merge the shards' plans into one report")
+    merging.add_argument('--count', type=int, help='number of shards')
+    merging.add_argument('plans', nargs='+', metavar='PLAN')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'which':
+        for namespace in args.namespaces:
+            print(f'{namespace} {shard_of(namespace, args.count)}')
+        return
+
+    try:
+        report = merge(read_plans(args.plans), count=args.count)
+    except ValueError as e:
+        parser.exit(1, f'{e}\n')
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Snapshots of the cluster state the idler bases its decisions on.
+
+A snapshot is a gzipped JSON lines file: a header line followed by one line
+per pod, pod metrics and deployment, as returned by the API server, in the
+order the idler lists them (pods, then metrics, then deployments). This
+allows snapshots to be read back one object at a time, see `replay.py`.
+"""
+
+from datetime import datetime, timezone
+import gzip
+import json
+import threading
+
+
+VERSION = 1
+
+POD = 'pod'
+POD_METRICS = 'pod_metrics'
+DEPLOYMENT = 'deployment'
+
+
+class Recorder(object):
+    """
+    Writes the objects listed by the idler to a snapshot file.
+
+    `serialize` converts API objects to their JSON representation (e.g.
+    `ApiClient.sanitize_for_serialization`).
+    """
+
+    def __init__(self, path, serialize, **header):
+        self.path = path
+        self.serialize = serialize
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, 'wt', encoding='utf-8')
+        self.write({
+            'version': VERSION,
+            'recorded_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            **header,
+        })
+
+    def write(self, data):
+        line = json.dumps(data, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line)
+            self.file.write('\n')
+
+    def record(self, kind, obj):
+        self.write({'kind': kind, 'object': self.serialize(obj)})
+
+    def tee(self, kind, objs):
+        """
+        Records the objects of the given iterator as they're consumed.
+        """
+        for obj in objs:
+            self.record(kind, obj)
+            yield obj
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read(path):
+    """
+    Returns the header of the given snapshot and an iterator over its
+    `(kind, object)` pairs, read one line at a time.
+    """
+    f = gzip.open(path, 'rt', encoding='utf-8')
+    try:
+        header = json.loads(f.readline())
+    except ValueError:
+        f.close()
+        raise ValueError(f'{path} is not a snapshot')
+
+    if header.get('version') != VERSION:
+        f.close()
+        raise ValueError(f'{path}: unsupported snapshot version {header.get("version")}')
+
+    return header, _objects(f)
+
+
+def _objects(f):
+    with f:
+        for line in f:
+            entry = json.loads(line)
+            yield entry['kind'], entry['object']
@@ -0,0 +1,214 @@
+"""
+State kept by the idler between runs.
+
+State is stored as JSON in local files (e.g. on a volume mounted in the
+CronJob pod). Missing or unreadable files are treated as empty state, so
+losing them only means the idler starts again from scratch.
+"""
+
+from collections import deque
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+
+
+log = logging.getLogger('idler.state')
+
+
+def load(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        log.warning(f'Failed to load state from {path}, ignoring it: {e}')
+        return default
+
+
+def save(path, data):
+    # write to a temporary file first so a failed run can't leave a
+    # truncated file behind
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def encode_key(key):
+    app, namespace = key
+    return f'{namespace}/{app}'
+
+
+def decode_key(encoded):
+    namespace, app = encoded.split('/', 1)
+    return (app, namespace)
+
+
+def percentile(values, p):
+    """
+    Returns the `p`th percentile of the given values (nearest-rank method).
+    """
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def window_statistic(values, statistic):
+    """
+    Returns the given statistic (`mean`, `max`, `min` or a percentile like
+    `p95`) of the given values.
+    """
+    if statistic == 'mean':
+        return sum(values) / len(values)
+    if statistic == 'max':
+        return max(values)
+    if statistic == 'min':
+        return min(values)
+    if statistic.startswith('p'):
+        p = float(statistic[1:])
+        if not 0 <= p <= 100:
+            raise ValueError(f'Invalid percentile "{statistic}"')
+        return percentile(values, p)
+    raise ValueError(f'Unknown statistic "{statistic}"')
+
+
+class CpuHistory(object):
+    """
+    Recent CPU usage samples of each app.
+
+    Samples are `(timestamp, millicores)` pairs kept in a fixed-size ring
+    buffer per `(app, namespace)` key, so the oldest samples are dropped as
+    new ones are recorded.
+    """
+
+    def __init__(self, size, samples=None):
+        self.size = size
+        self.samples = {}
+        for key, values in (samples or {}).items():
+            self.samples[key] = deque(
+                (tuple(value) for value in values), maxlen=size)
+
+    @classmethod
+    def load(cls, path, size):
+        data = load(path, default={})
+        return cls(size, samples={
+            decode_key(encoded): values
+            for encoded, values in data.items()
+        })
+
+    def save(self, path, window=None, now=None):
+        """
+        Saves the samples, dropping apps without samples in the last `window`
+        seconds.
+        """
+        if now is None:
+            now = time.time()
+
+        data = {}
+        for key, values in self.samples.items():
+            if window and values and values[-1][0] < now - window:
+                continue
+            data[encode_key(key)] = list(values)
+
+        save(path, data)
+
+    def record(self, key, usage, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.size)
+        self.samples[key].append((timestamp, usage))
+
+    def statistic(self, key, statistic, window, now=None):
+        """
+        Returns the given statistic of the CPU usage samples of the last
+        `window` seconds or `None` if there are no such samples.
+        """
+        if now is None:
+            now = time.time()
+
+        values = [
+            usage
+            for timestamp, usage in self.samples.get(key, ())
+            if timestamp >= now - window
+        ]
+        if not values:
+            return None
+
+        return window_statistic(values, statistic)
+
+
+class Evaluations(object):
+    """
+    Last idling decision made for each app.
+
+    Records, for each `(app, namespace)` key, the `resourceVersion` of the
+    deployment evaluated, when it was evaluated and whether it was idled, so
+    apps which were kept running and haven't changed since can be skipped
+    for a while.
+    """
+
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        data = load(path, default={})
+        return cls({decode_key(encoded): entry for encoded, entry in data.items()})
+
+    def save(self, path, grace, now=None):
+        """
+        Saves the evaluations, dropping the ones older than `grace` seconds.
+        """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            data = {
+                encode_key(key): entry
+                for key, entry in self.entries.items()
+                if entry['evaluated_at'] >= now - grace
+            }
+
+        save(path, data)
+
+    def record(self, key, resource_version, idled, now=None):
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            self.entries[key] = {
+                'resource_version': resource_version,
+                'evaluated_at': now,
+                'idled': idled,
+            }
+
+    def unchanged(self, key, resource_version, grace, now=None):
+        """
+        Returns whether the app was kept running less than `grace` seconds ago
+        and its deployment hasn't changed since.
+        """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+        return (
+            entry is not None
+            and not entry['idled']
+            and entry['resource_version'] == resource_version
+            and entry['evaluated_at'] >= now - grace
+        )
@@ -0,0 +1,114 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import pytest
+from kubernetes import client
+
+pytest.importorskip('aiohttp')
+
+import async_client
+import idler
+from benchmark import fake_apiserver
+
+
+@pytest.fixture
+def cluster():
+    server = fake_apiserver.serve(apps=10)
+    configuration = client.Configuration()
+    configuration.host = fake_apiserver.url(server)
+
+    with patch('idler._api_client', None), \
+            patch('idler.pods_lookup', {}), \
+            patch('idler.metrics_lookup', {}), \
+            patch('idler.client.Configuration', return_value=configuration), \
+            patch('async_client.client.Configuration', return_value=configuration):
+        yield server.cluster
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_run(cluster):
+    idler.registry.reset()
+
+    assert async_client.run() == []
+
+    # every other app is busy
+    assert cluster.idled == {1, 3, 5, 7, 9}
+    assert dict(cluster.requests) == {
+        'GET pods': 1,
+        'GET metrics': 1,
+        'GET deployments': 1,
+        'GET service': 5,
+        'PATCH service': 5,
+        'PATCH deployment': 5,
+    }
+    assert idler.DEPLOYMENTS.values == {
+        ('evaluated',): 10, ('skipped',): 5, ('idled',): 5,
+    }
+
+
+def test_run_fast_decode(cluster):
+    with patch('idler.FAST_DECODE', True):
+        assert async_client.run() == []
+
+    assert cluster.idled == {1, 3, 5, 7, 9}
+
+
+def test_run_paged(cluster):
+    with patch('idler.PAGE_SIZE', 3):
+        async_client.run()
+
+    assert cluster.requests['GET pods'] == 4
+    assert len(cluster.idled) == 5
+
+
+@pytest.mark.parametrize('patch_mode', ['apply', 'scale'])
+def test_run_patch_modes(cluster, patch_mode):
+    with patch('idler.PATCH_MODE', patch_mode):
+        assert async_client.run() == []
+
+    assert len(cluster.idled) == 5
+    # scale mode patches the deployment and its /scale subresource
+    expected = 10 if patch_mode == 'scale' else 5
+    assert cluster.requests['PATCH deployment'] == expected
+
+
+def test_idle_all_bounded_and_ordered_by_namespace():
+    deployments = []
+    for namespace, name in [
+            ('user-alice', 'rstudio'), ('user-alice', 'jupyter-lab'),
+            ('user-bob', 'rstudio'), ('user-bob', 'broken'), ('user-carol', 'rstudio')]:
+        deployment = MagicMock()
+        deployment.metadata.namespace = namespace
+        deployment.metadata.name = name
+        deployments.append(deployment)
+
+    idled = []
+    running = set()
+    max_running = 0
+
+    class Api(object):
+        async def idle(self, deployment):
+            nonlocal max_running
+            namespace = deployment.metadata.namespace
+            # deployments of a namespace are never idled at the same time
+            assert namespace not in running
+            running.add(namespace)
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0.01)
+            running.remove(namespace)
+            if deployment.metadata.name == 'broken':
+                raise Exception('boom')
+            idled.append((namespace, deployment.metadata.name))
+
+    loop = asyncio.new_event_loop()
+    try:
+        with patch('idler.IDLE_CONCURRENCY', 2):
+            errors = loop.run_until_complete(async_client.idle_all(Api(), deployments))
+    finally:
+        loop.close()
+
+    assert max_running == 2
+    assert [str(error) if error else None for error in errors] == [None, None, None, 'boom', None]
+    assert [name for namespace, name in idled if namespace == 'user-alice'] == ['rstudio', 'jupyter-lab']
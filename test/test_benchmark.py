@@ -0,0 +1,46 @@
+from benchmark import run
+
+
+def test_benchmark():
+    result = run.benchmark(apps=10)
+
+    # every other app is busy
+    assert result['idled'] == 5
+    assert result['requests'] == {
+        'GET pods': 1,
+        'GET metrics': 1,
+        'GET deployments': 1,
+        'GET service': 5,
+        'PATCH service': 5,
+        'PATCH deployment': 5,
+    }
+    assert result['wall_time'] > 0
+    assert result['peak_rss'] > 0
+    assert set(result['phases']) == {
+        'build_pods_lookup',
+        'build_metrics_lookup',
+        'eligible_deployments',
+        'idle',
+    }
+    assert result['api_latency']['GET /api/v1/pods'] > 0
+
+
+def test_decode_benchmark():
+    from benchmark import decode
+
+    results = decode.benchmark(items=10)
+
+    assert [result['list'] for result in results] == ['pods', 'metrics', 'deployments']
+    for result in results:
+        assert result['records']['memory'] < result['models']['memory']
+        assert result['protobuf']['bytes'] < result['records']['bytes']
+
+
+def test_benchmark_paged(monkeypatch):
+    monkeypatch.setenv('PAGE_SIZE', '3')
+
+    result = run.benchmark(apps=10)
+
+    # apps idled while paging through the deployments don't shift the pages
+    assert result['idled'] == 5
+    assert result['requests']['GET deployments'] == 4
@@ -0,0 +1,43 @@
+from datetime import date, datetime, timezone
+
+import pytest
+
+import calendars
+
+
+@pytest.fixture
+def calendar():
+    return calendars.Calendar(
+        timezone='Europe/London',
+        workdays=['mon', 'tue', 'wed', 'thu', 'fri'],
+        hours='08:00-19:00',
+        holidays=['2019-12-25', date(2019, 12, 26)],
+    )
+
+
+@pytest.mark.parametrize('when, expected', [
+    # Monday, in winter (GMT) and summer (BST)
+    (datetime(2019, 12, 2, 8, 0), True),
+    (datetime(2019, 12, 2, 7, 59), False),
+    (datetime(2019, 7, 1, 7, 0), True),
+    (datetime(2019, 7, 1, 18, 0), False),
+    # Saturday
+    (datetime(2019, 12, 7, 12, 0), False),
+    # holidays
+    (datetime(2019, 12, 25, 12, 0), False),
+    (datetime(2019, 12, 26, 12, 0), False),
+])
+def test_is_business_time(calendar, when, expected):
+    assert calendar.is_business_time(when.replace(tzinfo=timezone.utc)) == expected
+
+
+@pytest.mark.parametrize('spec', [
+    {'timezone': 'Europe/Nowhere'},
+    {'workdays': ['someday']},
+    {'hours': '9-5'},
+    {'holidays': ['25/12/2019']},
+    {'weekends': ['sat']},
+])
+def test_parse_invalid(spec):
+    with pytest.raises(ValueError):
+        calendars.parse(spec)
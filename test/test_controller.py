@@ -0,0 +1,103 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from kubernetes.client.rest import ApiException
+
+import controller
+import idler
+
+
+def mock_pod(name, namespace='user-alice', resource_version='1'):
+    pod = MagicMock()
+    pod.metadata.name = name
+    pod.metadata.namespace = namespace
+    pod.metadata.resource_version = resource_version
+    return pod
+
+
+def mock_list(items, resource_version):
+    response = MagicMock()
+    response.items = items
+    response.metadata.resource_version = resource_version
+    return response
+
+
+@pytest.fixture
+def cache():
+    list_fn = MagicMock()
+    list_fn.return_value = mock_list([mock_pod('a'), mock_pod('b')], '10')
+    return controller.Cache('pods', list_fn, controller.pod_key, label_selector='foo')
+
+
+def test_sync(cache):
+    cache.sync()
+
+    cache.list_fn.assert_called_once_with(label_selector='foo')
+    assert set(cache.items) == {('a', 'user-alice'), ('b', 'user-alice')}
+    assert cache.resource_version == '10'
+
+
+def test_apply_events(cache):
+    cache.sync()
+
+    cache.apply({'type': 'ADDED', 'object': mock_pod('c', resource_version='11')})
+    cache.apply({'type': 'DELETED', 'object': mock_pod('a', resource_version='12')})
+    cache.apply({'type': 'BOOKMARK', 'object': mock_pod('', resource_version='15')})
+
+    assert set(cache.items) == {('b', 'user-alice'), ('c', 'user-alice')}
+    assert cache.resource_version == '15'
+
+
+def test_projection():
+    pod = mock_pod('a')
+    pod.metadata.labels = {'app': 'rstudio'}
+    pod.spec.node_name = 'node-a'
+    list_fn = MagicMock(return_value=mock_list([pod], '10'))
+    cache = controller.Cache('pods', list_fn, controller.pod_key, project=idler.project_pod)
+
+    cache.sync()
+    cache.apply({'type': 'MODIFIED', 'object': mock_pod('b', resource_version='11')})
+
+    assert cache.items[('a', 'user-alice')].app == 'rstudio'
+    assert cache.items[('a', 'user-alice')].node == 'node-a'
+    assert isinstance(cache.items[('b', 'user-alice')], idler.PodEntry)
+
+
+def test_keep():
+    list_fn = MagicMock(return_value=mock_list([mock_pod('a'), mock_pod('b', 'user-bob')], '10'))
+    cache = controller.Cache(
+        'pods', list_fn, controller.pod_key,
+        keep=lambda pod: pod.metadata.namespace == 'user-alice')
+
+    cache.sync()
+    cache.apply({'type': 'ADDED', 'object': mock_pod('c', 'user-bob', resource_version='11')})
+
+    assert set(cache.items) == {('a', 'user-alice')}
+    assert cache.resource_version == '11'
+
+
+def test_apply_error_event(cache):
+    cache.sync()
+
+    with pytest.raises(ApiException) as e:
+        cache.apply({
+            'type': 'ERROR',
+            'raw_object': {'code': 410, 'message': 'too old resource version'},
+        })
+
+    assert e.value.status == controller.HTTP_GONE
+
+
+def test_evaluate(cache):
+    cache.sync()
+    deployments = MagicMock()
+    deployments.values.return_value = ['deployment']
+
+    with patch('idler.build_metrics_lookup') as build_metrics_lookup, \
+            patch('idler.idle_in_order', return_value=[]) as idle_in_order, \
+            patch('idler.metrics_lookup', {'stale': 'metrics'}):
+        assert controller.evaluate(cache, deployments) == []
+        assert idler.metrics_lookup == {}
+
+    build_metrics_lookup.assert_called_once_with()
+    idle_in_order.assert_called_once_with(['deployment'], evaluated=False)
@@ -1,10 +1,12 @@
 from datetime import datetime, timezone
 import json
+import time
 from unittest.mock import MagicMock, patch
 
 import pytest
 from hypothesis import given, settings
 from hypothesis.strategies import integers, text, composite
+from kubernetes.client.rest import ApiException
 
 import idler
 from idler import (
@@ -131,7 +133,7 @@ def metrics(deployment):
     metric = mock_podmetric()
     cache = {
         (deployment.metadata.labels['app'], deployment.metadata.namespace):
-            metric,
+            [metric],
     }
     with patch('idler.metrics_lookup', cache):
         yield cache
@@ -140,7 +142,7 @@ def metrics(deployment):
 @pytest.yield_fixture
 def pods_lookup(pod):
     cache = {
-        (pod.metadata.labels['app'], pod.metadata.namespace): pod,
+        (pod.metadata.name, pod.metadata.namespace): idler.project_pod(pod),
     }
     with patch('idler.pods_lookup', cache):
         yield cache
@@ -244,5 +246,1094 @@ def test_should_not_idle(deployment, env):
 def test_avg_cpu_percent(
         client, deployment, pods_lookup, metrics, cpu_usage, expected):
     key = (deployment.metadata.labels['app'], deployment.metadata.namespace)
-    metrics[key] = mock_podmetric(cpu_usage)
+    metrics[key] = [mock_podmetric(cpu_usage)]
     assert idler.avg_cpu_percent(deployment) == expected
+
+
+@pytest.mark.parametrize('replicas_cpu_usage, expected', [
+    ([['100m', '0'], ['100m', '0']], 6.25),  # 200 / (2 * (1500+100))
+    ([['800m', '800m'], ['0', '0']], 50),  # 1600 / (2 * (1500+100))
+    ([['0', '0'], ['0', '0'], ['1200m', '0']], 25),  # 1200 / (3 * (1500+100))
+])
+def test_avg_cpu_percent_multiple_replicas(
+        deployment, metrics, replicas_cpu_usage, expected):
+    key = (deployment.metadata.labels['app'], deployment.metadata.namespace)
+    metrics[key] = [mock_podmetric(usage) for usage in replicas_cpu_usage]
+    assert idler.avg_cpu_percent(deployment) == expected
+
+
+def mock_page(items, _continue=None):
+    page = MagicMock()
+    page.items = items
+    page.metadata._continue = _continue
+    return page
+
+
+def test_list_all_unpaged():
+    list_fn = MagicMock()
+    list_fn.return_value = mock_page(['a', 'b'])
+
+    with patch('idler.PAGE_SIZE', 0):
+        assert list(idler.list_all(list_fn, label_selector='foo')) == ['a', 'b']
+
+    list_fn.assert_called_once_with(label_selector='foo')
+
+
+def test_list_all_paged():
+    list_fn = MagicMock()
+    list_fn.side_effect = [
+        mock_page(['a', 'b'], _continue='token-1'),
+        mock_page(['c', 'd'], _continue='token-2'),
+        mock_page(['e']),
+    ]
+
+    with patch('idler.PAGE_SIZE', 2):
+        items = idler.list_all(list_fn, label_selector='foo')
+        # first page is requested eagerly, the rest lazily
+        assert list_fn.call_count == 1
+        assert list(items) == ['a', 'b', 'c', 'd', 'e']
+
+    assert list_fn.call_args_list == [
+        ((), {'label_selector': 'foo', 'limit': 2}),
+        ((), {'label_selector': 'foo', 'limit': 2, '_continue': 'token-1'}),
+        ((), {'label_selector': 'foo', 'limit': 2, '_continue': 'token-2'}),
+    ]
+
+
+def mock_deployment(name, namespace):
+    deployment = MagicMock()
+    deployment.metadata.name = name
+    deployment.metadata.namespace = namespace
+    return deployment
+
+
+def test_idle_concurrently():
+    deployments = [
+        mock_deployment('rstudio', 'user-alice'),
+        mock_deployment('jupyter-lab', 'user-alice'),
+        mock_deployment('rstudio', 'user-bob'),
+        mock_deployment('broken', 'user-bob'),
+    ]
+    idled = []
+
+    def idle(deployment):
+        if deployment.metadata.name == 'broken':
+            raise Exception('boom')
+        idled.append((deployment.metadata.namespace, deployment.metadata.name))
+
+    with patch('idler.should_idle', return_value=True), \
+            patch('idler.idle', side_effect=idle), \
+            patch('idler.IDLE_CONCURRENCY', 2):
+        failed = idler.idle_concurrently(deployments)
+
+    assert failed == ['(user-bob, broken)']
+    assert sorted(idled) == [
+        ('user-alice', 'jupyter-lab'),
+        ('user-alice', 'rstudio'),
+        ('user-bob', 'rstudio'),
+    ]
+    # deployments in the same namespace are idled in order
+    alice = [name for namespace, name in idled if namespace == 'user-alice']
+    assert alice == ['rstudio', 'jupyter-lab']
+
+
+def test_idle_deployments_exits_on_failure(env):
+    with patch('idler.build_lookups'), \
+            patch('idler.eligible_deployments', return_value=[]), \
+            patch('idler.idle_concurrently', return_value=['(ns, app)']), \
+            patch('idler.IDLE_CONCURRENCY', 4), \
+            pytest.raises(SystemExit):
+        idler.idle_deployments()
+
+
+def test_build_metrics_lookup_ignores_unknown_pods(client, pod):
+    known = mock_podmetric()
+    known.metadata.name = pod.metadata.name
+    known.metadata.namespace = pod.metadata.namespace
+    unknown = mock_podmetric()
+    unknown.metadata.name = 'new-pod'
+    unknown.metadata.namespace = pod.metadata.namespace
+
+    metrics_api = client.MetricsV1beta1Api.return_value
+    metrics_api.list_pod_metrics_for_all_namespaces.return_value.items = [
+        known, unknown,
+    ]
+
+    with patch('idler.pods_lookup', {}), patch('idler.metrics_lookup', {}):
+        idler.add_pod(pod)
+        idler.build_metrics_lookup()
+        assert idler.metrics_lookup == {('rstudio', 'user-alice'): [known]}
+
+
+def test_build_metrics_lookup_collects_all_replicas(client):
+    pods = {}
+    replicas_metrics = []
+    for name in ['rstudio-1234-abcde', 'rstudio-1234-fghij']:
+        pods[(name, 'user-alice')] = idler.PodEntry(
+            app='rstudio', owner=None, start_time=None, phase='Running', node='node-a')
+        pod_metrics = mock_podmetric()
+        pod_metrics.metadata.name = name
+        pod_metrics.metadata.namespace = 'user-alice'
+        replicas_metrics.append(pod_metrics)
+
+    metrics_api = client.MetricsV1beta1Api.return_value
+    metrics_api.list_pod_metrics_for_all_namespaces.return_value.items = replicas_metrics
+
+    with patch('idler.pods_lookup', pods), patch('idler.metrics_lookup', {}):
+        idler.build_metrics_lookup()
+        assert idler.metrics_lookup == {('rstudio', 'user-alice'): replicas_metrics}
+
+
+def test_avg_cpu_percent_uses_cpu_history(deployment, metrics):
+    key = (deployment.metadata.labels['app'], deployment.metadata.namespace)
+    history = idler.state.CpuHistory(size=10)
+    for usage in [0, 800, 0]:
+        history.record(key, usage)
+
+    with patch('idler.cpu_history', history), \
+            patch('idler.CPU_HISTORY_STATISTIC', 'max'):
+        # 800 / (1500+100)
+        assert idler.avg_cpu_percent(deployment) == 50
+
+
+@pytest.mark.parametrize('dry_run', [False, True])
+def test_record_cpu_history(metrics, tmp_path, dry_run):
+    path = tmp_path / 'history.json'
+
+    with patch('idler.cpu_history', None), \
+            patch('idler.CPU_HISTORY_FILE', str(path)), \
+            patch('idler.DRY_RUN', dry_run):
+        idler.record_cpu_history()
+        # the history is loaded either way, to plan with
+        assert idler.cpu_history is not None
+
+    # dry runs don't add to the history
+    assert path.exists() != dry_run
+
+
+def test_decoded():
+    list_fn = MagicMock()
+    body = b'{"metadata": {"continue": "2"}, "items": [{"metadata": {"name": "rstudio"}}]}'
+    # streamed in chunks splitting values
+    list_fn.return_value.stream.return_value = [body[:20], body[20:50], body[50:]]
+
+    with patch('idler.FAST_DECODE', True):
+        page = idler.decoded(list_fn, idler.records.Deployment)(label_selector='app')
+
+    list_fn.assert_called_with(_preload_content=False, label_selector='app')
+    assert page.metadata._continue == '2'
+    assert [item.metadata.name for item in page.items] == ['rstudio']
+    list_fn.return_value.release_conn.assert_called_with()
+
+
+def test_prefetch_lists_concurrently(client, deployment, pod, metrics):
+    import threading
+    barrier = threading.Barrier(3, timeout=5)
+
+    def listed(response):
+        def list_fn(**kwargs):
+            # fails unless all three lists are in flight at the same time
+            barrier.wait()
+            return response
+        return list_fn
+
+    core_api = client.CoreV1Api.return_value
+    apps_api = client.AppsV1beta1Api.return_value
+    metrics_api = client.MetricsV1beta1Api.return_value
+    pod_metrics = mock_podmetric(cpu_usage=['0'])
+    pod_metrics.metadata.name = pod.metadata.name
+    pod_metrics.metadata.namespace = pod.metadata.namespace
+    metrics_api.list_pod_metrics_for_all_namespaces.return_value.items = [pod_metrics]
+    for list_fn in [
+            core_api.list_pod_for_all_namespaces,
+            apps_api.list_deployment_for_all_namespaces,
+            metrics_api.list_pod_metrics_for_all_namespaces]:
+        list_fn.side_effect = listed(list_fn.return_value)
+        list_fn.return_value.metadata._continue = None
+
+    with patch('idler.pods_lookup', {}), patch('idler.metrics_lookup', {}):
+        assert idler.prefetch() == [deployment]
+        assert idler.pods_lookup == {
+            (pod.metadata.name, pod.metadata.namespace): idler.project_pod(pod),
+        }
+        assert idler.metrics_lookup == {('rstudio', 'user-alice'): [pod_metrics]}
+
+
+def test_should_idle_uses_policy(deployment, env):
+    rules = idler.policies.compile_rules({'rules': [
+        {'match': {'namespace': 'user-alice'}, 'threshold': 50, 'window': 60},
+    ]})
+
+    with patch('idler.rules', rules), \
+            patch('idler.avg_cpu_percent', return_value=60) as cpu:
+        assert not idler.should_idle(deployment)
+        cpu.assert_called_with(deployment, window=60)
+
+
+def test_should_idle_respects_schedule_and_min_age(deployment, env):
+    rules = idler.policies.compile_rules({'rules': [
+        {'match': {}, 'schedule': '19:00-07:00', 'min_age': 3600},
+    ]})
+    deployment.metadata.creation_timestamp = datetime(2019, 1, 1, 19, 30, tzinfo=timezone.utc)
+
+    with patch('idler.rules', rules), \
+            patch('idler.avg_cpu_percent', return_value=0):
+        # outside of its schedule
+        assert not idler.should_idle(
+            deployment, now=datetime(2019, 1, 2, 18, 0, tzinfo=timezone.utc))
+        # too recent
+        assert not idler.should_idle(
+            deployment, now=datetime(2019, 1, 1, 20, 0, tzinfo=timezone.utc))
+        assert idler.should_idle(
+            deployment, now=datetime(2019, 1, 1, 21, 0, tzinfo=timezone.utc))
+
+
+def test_idle_deployments_skips_sweep_during_business_hours(client, env):
+    rules = idler.policies.compile_rules({
+        'calendars': {'everyday': {'hours': '00:00-24:00', 'workdays': idler.policies.calendars.WEEKDAYS}},
+        'default': {'calendar': 'everyday'},
+    })
+
+    with patch('idler.rules', rules), patch('idler.export_metrics'):
+        idler.idle_deployments()
+
+    client.CoreV1Api.return_value.list_pod_for_all_namespaces.assert_not_called()
+    client.AppsV1beta1Api.return_value.list_deployment_for_all_namespaces.assert_not_called()
+    assert idler.SWEEP_SKIPPED.values == {(): 1}
+
+
+def test_project_pod(pod):
+    started = datetime(2019, 1, 1, 12, 0, tzinfo=timezone.utc)
+    pod.metadata.owner_references = [MagicMock()]
+    pod.metadata.owner_references[0].name = 'rstudio-whatever-1234'
+    pod.status.start_time = started
+    pod.status.phase = 'Running'
+    pod.spec.node_name = ''.join(['node', '-a'])
+
+    entry = idler.project_pod(pod)
+
+    assert entry == idler.PodEntry(
+        app='rstudio', owner='rstudio-whatever-1234', start_time=started,
+        phase='Running', node='node-a')
+    # shared with the other pods on the node
+    assert entry.node is idler.project_pod(pod).node
+
+
+def test_build_pod_starts_lookup(pod):
+    started = datetime(2019, 1, 1, 12, 0, tzinfo=timezone.utc)
+    pod.status.start_time = started
+    pending = MagicMock()
+    pending.metadata.labels = {'app': 'rstudio'}
+    pending.metadata.namespace = 'user-bob'
+    pending.status.start_time = None
+
+    lookup = {
+        ('pod', 'user-alice'): idler.project_pod(pod),
+        ('pending', 'user-bob'): idler.project_pod(pending),
+    }
+    with patch('idler.pods_lookup', lookup), patch('idler.pod_starts_lookup', {}):
+        idler.build_pod_starts_lookup()
+        assert idler.pod_starts_lookup[('rstudio', 'user-alice')] == started
+        # not started yet
+        assert idler.pod_starts_lookup[('rstudio', 'user-bob')] > started
+
+
+def test_last_started(deployment):
+    pod_started = datetime(2019, 1, 1, 12, 0, tzinfo=timezone.utc)
+    available = MagicMock(
+        type='Available', status='True',
+        last_transition_time=datetime(2019, 1, 1, 12, 5, tzinfo=timezone.utc))
+    deployment.status.conditions = [available]
+    deployment.metadata.annotations = {IDLED_AT: '2019-01-01T12:03:00+00:00'}
+
+    with patch('idler.pod_starts_lookup', {('rstudio', 'user-alice'): pod_started}):
+        assert idler.last_started(deployment) == available.last_transition_time
+
+        deployment.status.conditions = []
+        assert idler.last_started(deployment) == datetime(2019, 1, 1, 12, 3, tzinfo=timezone.utc)
+
+        deployment.metadata.annotations = {}
+        assert idler.last_started(deployment) == pod_started
+
+
+def test_should_idle_during_warmup(deployment, env):
+    deployment.status.conditions = []
+    deployment.metadata.annotations = {IDLED_AT: '2019-01-01T12:00:00+00:00'}
+
+    with patch('idler.WARMUP_SECONDS', 600), \
+            patch('idler.avg_cpu_percent', return_value=0):
+        assert not idler.should_idle(
+            deployment, now=datetime(2019, 1, 1, 12, 5, tzinfo=timezone.utc))
+        assert idler.should_idle(
+            deployment, now=datetime(2019, 1, 1, 12, 15, tzinfo=timezone.utc))
+
+
+def test_should_idle_skips_unchanged_apps(deployment, env, tmp_path):
+    deployment.metadata.resource_version = '42'
+    evaluations = idler.state.Evaluations()
+
+    with patch('idler.STATE_FILE', str(tmp_path / 'state.json')), \
+            patch('idler.evaluations', evaluations), \
+            patch('idler.avg_cpu_percent') as cpu:
+        cpu.return_value = 100
+        assert not idler.should_idle(deployment)
+        cpu.return_value = 0
+        assert not idler.should_idle(deployment)
+        assert cpu.call_count == 1
+
+        deployment.metadata.resource_version = '43'
+        assert idler.should_idle(deployment)
+        assert cpu.call_count == 2
+
+
+def test_evaluation_cache_loaded_once(tmp_path):
+    import threading
+    barrier = threading.Barrier(4, timeout=5)
+    loaded = []
+
+    def load(path):
+        loaded.append(path)
+        time.sleep(0.05)
+        return idler.state.Evaluations()
+
+    def evaluation_cache(results):
+        barrier.wait()
+        results.append(idler.evaluation_cache())
+
+    results = []
+    with patch('idler.STATE_FILE', str(tmp_path / 'state.json')), \
+            patch('idler.evaluations', None), \
+            patch('idler.state.Evaluations.load', side_effect=load):
+        threads = [threading.Thread(target=evaluation_cache, args=(results,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert len(loaded) == 1
+    assert len({id(evaluations) for evaluations in results}) == 1
+def test_state_files_per_shard(tmp_path):
+    path = str(tmp_path / 'state.json')
+    for index in range(2):
+        evaluations = idler.state.Evaluations()
+        evaluations.record(('rstudio', f'user-{index}'), str(index), idled=False)
+        with patch('idler.STATE_FILE', path), \
+                patch('idler.SHARD_COUNT', 2), patch('idler.SHARD_INDEX', index), \
+                patch('idler.evaluations', evaluations):
+            idler.save_evaluations()
+
+    # each shard's decisions are kept
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['state.0.json', 'state.1.json']
+    with patch('idler.STATE_FILE', path), \
+            patch('idler.SHARD_COUNT', 2), patch('idler.SHARD_INDEX', 1), \
+            patch('idler.evaluations', None):
+        assert list(idler.evaluation_cache().entries) == [('rstudio', 'user-1')]
+
+    with patch('idler.SHARD_COUNT', 1):
+        assert idler.shard_file(path) == path
+
+
+def test_metrics_textfile_per_shard(tmp_path):
+    path = str(tmp_path / 'idler.prom')
+    idler.registry.reset()
+    idler.DEPLOYMENTS.inc(result='evaluated')
+
+    with patch('idler.METRICS_TEXTFILE', path), \
+            patch('idler.SHARD_COUNT', 2), patch('idler.SHARD_INDEX', 1):
+        idler.export_metrics()
+
+    exported = (tmp_path / 'idler.1.prom').read_text()
+    assert 'idler_deployments{shard="1",result="evaluated"} 1.0' in exported
+
+
+@pytest.fixture
+def api_patches():
+    return []
+
+
+@pytest.yield_fixture
+def api_server(api_patches):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from threading import Thread
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            body = b'{}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_PATCH(self):
+            length = int(self.headers['Content-Length'])
+            api_patches.append((self.path, self.headers['Content-Type'], self.rfile.read(length)))
+            self.do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+def test_api_client_is_shared_and_reuses_connections(api_server):
+    from kubernetes.client import Configuration
+
+    configuration = Configuration()
+    configuration.host = api_server
+
+    with patch('idler._api_client', None), \
+            patch('idler.client.Configuration', return_value=configuration):
+        api_client = idler.api_client()
+        assert idler.api_client() is api_client
+        assert api_client.configuration.connection_pool_maxsize == idler.API_POOL_SIZE
+
+        for _ in range(3):
+            api_client.call_api('/version', 'GET', _return_http_data_only=True)
+
+        assert idler.connection_stats() == (1, 2)
+        api_client.rest_client.pool_manager.clear()
+
+
+def test_apply(api_server, api_patches):
+    from kubernetes.client import Configuration
+
+    configuration = Configuration()
+    configuration.host = api_server
+    body = {'apiVersion': 'v1', 'kind': 'Service', 'spec': {'selector': None}}
+
+    with patch('idler._api_client', None), \
+            patch('idler.client.Configuration', return_value=configuration), \
+            patch('idler.FIELD_MANAGER', 'idler'):
+        idler.apply(idler.SERVICE_PATH, 'rstudio', 'user-alice', body)
+        idler.api_client().rest_client.pool_manager.clear()
+
+    [(path, content_type, sent)] = api_patches
+    assert path == '/api/v1/namespaces/user-alice/services/rstudio?fieldManager=idler&force=true'
+    assert content_type == 'application/apply-patch+yaml'
+    assert json.loads(sent) == body
+
+
+def test_redirect_to_unidler_apply(api_server, api_patches):
+    from kubernetes.client import Configuration, V1Service, V1ServiceSpec
+
+    configuration = Configuration()
+    configuration.host = api_server
+    service = V1Service(spec=V1ServiceSpec(selector={'app': 'rstudio'}, cluster_ip='10.0.0.1'))
+
+    with patch('idler._api_client', None), \
+            patch('idler.client.Configuration', return_value=configuration), \
+            patch('idler.PATCH_MODE', 'apply'):
+        idler.App('rstudio', 'user-alice').redirect_to_unidler(service)
+        idler.api_client().rest_client.pool_manager.clear()
+
+    [(_, json_patch_type, json_patch), (_, apply_type, applied)] = api_patches
+    # apply doesn't remove the fields other managers own, a JSON patch does
+    assert json_patch_type == 'application/json-patch+json'
+    assert json.loads(json_patch) == [
+        {'op': 'remove', 'path': '/spec/selector'},
+        {'op': 'remove', 'path': '/spec/clusterIP'},
+    ]
+    assert apply_type == 'application/apply-patch+yaml'
+    spec = json.loads(applied)['spec']
+    assert 'selector' not in spec and 'clusterIP' not in spec
+    assert spec['type'] == SERVICE_TYPE_EXTERNAL_NAME
+    assert spec['externalName'] == UNIDLER_SERVICE_HOST
+
+
+def test_list_objects_metadata_only():
+    from kubernetes.client import Configuration
+    from benchmark import fake_apiserver
+
+    server = fake_apiserver.serve(apps=2)
+    configuration = Configuration()
+    configuration.host = fake_apiserver.url(server)
+
+    with patch('idler._api_client', None), \
+            patch('idler.client.Configuration', return_value=configuration):
+        list_fn = idler.list_objects(
+            idler.DEPLOYMENTS_PATH, idler.records.Deployment, metadata_only=True)
+        page = list_fn(label_selector=f'!{IDLED}', limit=1)
+        [deployment] = list(page.items)
+        idler.api_client().rest_client.pool_manager.clear()
+    server.shutdown()
+
+    assert page.metadata._continue == 'user-0/rstudio'
+    assert deployment.metadata.name == 'rstudio'
+    assert deployment.metadata.namespace == 'user-0'
+    assert deployment.spec is None
+
+
+@pytest.mark.parametrize('path, protobuf', [
+    (idler.PODS_PATH, True),
+    # served as JSON only
+    ('/api/v1/unknown', False),
+])
+def test_list_objects_protobuf(api_server, path, protobuf):
+    from kubernetes.client import Configuration
+    from benchmark import fake_apiserver
+
+    server = fake_apiserver.serve(apps=2)
+    configuration = Configuration()
+    configuration.host = fake_apiserver.url(server) if protobuf else api_server
+
+    with patch('idler._api_client', None), \
+            patch('idler.client.Configuration', return_value=configuration), \
+            patch('idler.PROTOBUF', True), \
+            patch('idler.protobuf.decode_list', wraps=idler.protobuf.decode_list) as decode_list:
+        page = idler.list_objects(path, idler.records.Pod)(label_selector='app')
+        pods = list(page.items)
+        idler.api_client().rest_client.pool_manager.clear()
+    server.shutdown()
+
+    assert decode_list.called == protobuf
+    assert [pod.metadata.namespace for pod in pods] == (['user-0', 'user-1'] if protobuf else [])
+
+
+def test_fetch_candidates(env):
+    created = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    deployments = []
+    for namespace in ['user-alice', 'user-bob', 'user-carol']:
+        deployment = mock_deployment('rstudio', namespace)
+        deployment.metadata.labels = {'app': 'rstudio'}
+        deployment.metadata.annotations = {}
+        deployment.metadata.creation_timestamp = created
+        deployment.status = None
+        deployments.append(deployment)
+    deployments[1].metadata.creation_timestamp = datetime.now(timezone.utc)
+
+    def read_deployment(name, namespace):
+        if namespace == 'user-carol':
+            raise ApiException(status=404)
+        return (name, namespace)
+
+    rules = idler.policies.compile_rules({'default': {'min_age': 3600}})
+    with patch('idler.rules', rules), \
+            patch('idler.read_deployment', side_effect=read_deployment) as read:
+        failed = []
+        assert list(idler.fetch_candidates(deployments, failed)) == [('rstudio', 'user-alice')]
+        # too recent to be idled, not fetched
+        assert read.call_count == 2
+        assert failed == []
+
+
+def test_fetch_candidates_bounded(env):
+    created = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    listed = []
+
+    def deployments():
+        for index in range(20):
+            deployment = mock_deployment('rstudio', f'user-{index}')
+            deployment.metadata.labels = {'app': 'rstudio'}
+            deployment.metadata.annotations = {}
+            deployment.metadata.creation_timestamp = created
+            deployment.status = None
+            listed.append(deployment)
+            yield deployment
+
+    with patch('idler.API_POOL_SIZE', 2), \
+            patch('idler.rules', idler.policies.compile_rules({})), \
+            patch('idler.read_deployment', side_effect=lambda name, namespace: namespace):
+        fetched = idler.fetch_candidates(deployments(), [])
+        assert next(fetched) == 'user-0'
+        # no more than `API_POOL_SIZE * 2` fetched ahead
+        assert len(listed) <= 1 + 2 * 2
+        assert list(fetched) == [f'user-{index}' for index in range(1, 20)]
+
+
+def test_fetch_candidates_failures(env):
+    idler.registry.reset()
+    created = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    deployments = []
+    for namespace in ['user-alice', 'user-bob', 'user-carol']:
+        deployment = mock_deployment('rstudio', namespace)
+        deployment.metadata.labels = {'app': 'rstudio'}
+        deployment.metadata.annotations = {}
+        deployment.metadata.creation_timestamp = created
+        deployment.status = None
+        deployments.append(deployment)
+    # no app label
+    deployments[2].metadata.labels = {}
+
+    def read_deployment(name, namespace):
+        if namespace == 'user-bob':
+            raise ApiException(status=403)
+        return (name, namespace)
+
+    failed = []
+    with patch('idler.rules', idler.policies.compile_rules({})), \
+            patch('idler.read_deployment', side_effect=read_deployment):
+        assert list(idler.fetch_candidates(deployments, failed)) == [('rstudio', 'user-alice')]
+
+    assert sorted(failed) == ['(user-bob, rstudio)', '(user-carol, rstudio)']
+    assert idler.DEPLOYMENTS.values[('failed',)] == 2
+
+
+@pytest.mark.parametrize('settings, metadata_only', [
+    ({}, True),
+    ({'WARMUP_SECONDS': 600}, False),
+    ({'IDLE_POLICY': 'memory'}, False),
+    ({'DRY_RUN': True}, False),
+])
+def test_list_pods_metadata_only(client, settings, metadata_only):
+    from contextlib import ExitStack
+
+    with ExitStack() as stack:
+        stack.enter_context(patch('idler.METADATA_ONLY', True))
+        for name, value in settings.items():
+            stack.enter_context(patch(f'idler.{name}', value))
+        list_objects = stack.enter_context(patch('idler.list_objects'))
+        list_objects.return_value.return_value.metadata._continue = None
+        idler.list_pods()
+
+    assert list_objects.called == metadata_only
+
+
+@pytest.mark.parametrize('patch_mode', ['apply', 'scale'])
+def test_scale_to_zero_patch_modes(client, patch_mode):
+    app = idler.App('rstudio', 'user-alice')
+    apps_api = client.AppsV1beta1Api.return_value
+
+    with patch('idler.PATCH_MODE', patch_mode), patch('idler.apply') as apply:
+        app.scale_to_zero(replicas_when_unidled=2)
+
+    if patch_mode == 'apply':
+        apply.assert_called_once()
+        body = apply.call_args[1]['body']
+        assert body['kind'] == 'Deployment'
+        assert body['spec'] == {'replicas': 0}
+        assert body['metadata']['labels'] == {IDLED: 'true'}
+        apps_api.patch_namespaced_deployment.assert_not_called()
+    else:
+        apply.assert_not_called()
+        apps_api.patch_namespaced_deployment_scale.assert_called_once_with(
+            'rstudio', 'user-alice', body={'spec': {'replicas': 0}})
+        body = apps_api.patch_namespaced_deployment.call_args[1]['body']
+        assert set(body) == {'metadata'}
+
+
+def test_scale_with_subresource_removes_label_on_failure(client):
+    app = idler.App('rstudio', 'user-alice')
+    apps_api = client.AppsV1beta1Api.return_value
+    apps_api.patch_namespaced_deployment_scale.side_effect = api_exception(403)
+
+    with patch('idler.PATCH_MODE', 'scale'), pytest.raises(ApiException):
+        app.scale_to_zero()
+
+    apps_api.patch_namespaced_deployment.assert_called_with(
+        'rstudio', 'user-alice', body={'metadata': {'labels': {IDLED: None}}})
+
+
+def api_exception(status, retry_after=None):
+    e = ApiException(status=status, reason='Error')
+    e.headers = {'Retry-After': retry_after} if retry_after else {}
+    return e
+
+
+@pytest.yield_fixture
+def sleep():
+    with patch('idler.time.sleep') as sleep:
+        yield sleep
+
+
+@pytest.mark.parametrize('status', [409, 429, 500, 503])
+def test_with_retries_retries(sleep, status):
+    fn = MagicMock(side_effect=[api_exception(status), api_exception(status), 'ok'])
+
+    assert idler.with_retries(fn, 'name', namespace='ns') == 'ok'
+    assert fn.call_count == 3
+    fn.assert_called_with('name', namespace='ns')
+    assert sleep.call_count == 2
+
+
+def test_with_retries_honours_retry_after(sleep):
+    fn = MagicMock(side_effect=[api_exception(429, retry_after='7'), 'ok'])
+
+    idler.with_retries(fn)
+    sleep.assert_called_once_with(7.0)
+
+
+def test_with_retries_gives_up(sleep):
+    fn = MagicMock(side_effect=api_exception(503))
+
+    with patch('idler.MAX_RETRIES', 2), pytest.raises(ApiException):
+        idler.with_retries(fn)
+    assert fn.call_count == 3
+
+
+def test_with_retries_does_not_retry_client_errors(sleep):
+    fn = MagicMock(side_effect=api_exception(404))
+
+    with pytest.raises(ApiException):
+        idler.with_retries(fn)
+    assert fn.call_count == 1
+    sleep.assert_not_called()
+
+
+def test_list_all_retries_pages(sleep):
+    list_fn = MagicMock()
+    list_fn.side_effect = [
+        mock_page(['a', 'b'], _continue='token-1'),
+        api_exception(503),
+        mock_page(['c']),
+    ]
+
+    with patch('idler.PAGE_SIZE', 2):
+        assert list(idler.list_all(list_fn)) == ['a', 'b', 'c']
+
+    assert list_fn.call_args_list[1:] == [
+        ((), {'limit': 2, '_continue': 'token-1'}),
+        ((), {'limit': 2, '_continue': 'token-1'}),
+    ]
+
+
+def test_list_all_relists_when_continue_expired(sleep):
+    alice = mock_deployment('rstudio', 'user-alice')
+    bob = mock_deployment('rstudio', 'user-bob')
+    carol = mock_deployment('rstudio', 'user-carol')
+    list_fn = MagicMock()
+    list_fn.side_effect = [
+        mock_page([alice, bob], _continue='token-1'),
+        api_exception(410),
+        # listed again from the start
+        mock_page([alice, bob], _continue='token-2'),
+        mock_page([carol]),
+    ]
+
+    with patch('idler.PAGE_SIZE', 2):
+        assert list(idler.list_all(list_fn)) == [alice, bob, carol]
+
+    assert list_fn.call_args_list[1:] == [
+        ((), {'limit': 2, '_continue': 'token-1'}),
+        ((), {'limit': 2}),
+        ((), {'limit': 2, '_continue': 'token-2'}),
+    ]
+    sleep.assert_not_called()
+
+
+def test_idle_restores_service_when_scaling_fails(client, deployment, sleep):
+    core_api = client.CoreV1Api.return_value
+    apps_api = client.AppsV1beta1Api.return_value
+    service = core_api.read_namespaced_service.return_value
+    apps_api.patch_namespaced_deployment.side_effect = api_exception(403)
+
+    with pytest.raises(ApiException):
+        idler.idle(deployment)
+
+    core_api.patch_namespaced_service.assert_called_once()
+    core_api.replace_namespaced_service.assert_called_once_with(
+        name=deployment.metadata.name,
+        namespace=deployment.metadata.namespace,
+        body=service,
+    )
+    assert service.metadata.resource_version is None
+    assert service.spec.cluster_ip is None
+
+
+def test_idle_restores_service_when_apply_fails(client, deployment, sleep):
+    core_api = client.CoreV1Api.return_value
+    apps_api = client.AppsV1beta1Api.return_value
+    service = core_api.read_namespaced_service.return_value
+
+    with patch('idler.PATCH_MODE', 'apply'), \
+            patch('idler.apply', side_effect=api_exception(415)):
+        with pytest.raises(ApiException):
+            idler.idle(deployment)
+
+    core_api.patch_namespaced_service.assert_called_once()
+    core_api.replace_namespaced_service.assert_called_once()
+    apps_api.patch_namespaced_deployment.assert_not_called()
+
+
+def test_idle_deployments_metrics(client, deployment, env, metrics, tmp_path):
+    busy = mock_deployment('busy', 'user-bob')
+    busy.metadata.labels = {'app': 'busy'}
+    apps_api = client.AppsV1beta1Api.return_value
+    apps_api.list_deployment_for_all_namespaces.return_value.items = [
+        deployment, busy,
+    ]
+    textfile = tmp_path / 'idler.prom'
+
+    with patch('idler.avg_cpu_percent', side_effect=[0, 95]), \
+            patch('idler.METRICS_TEXTFILE', str(textfile)):
+        idler.idle_deployments()
+
+    exported = textfile.read_text()
+    assert 'idler_deployments{result="evaluated"} 2.0' in exported
+    assert 'idler_deployments{result="idled"} 1.0' in exported
+    assert 'idler_deployments{result="skipped"} 1.0' in exported
+    assert 'idler_app_cpu_usage_percent_count 2.0' in exported
+    for phase in ['build_pods_lookup', 'build_metrics_lookup', 'eligible_deployments', 'idle']:
+        assert f'idler_phase_duration_seconds{{phase="{phase}"}}' in exported
+
+
+def test_idle_deployments_times_listing(client, deployment, env):
+    def eligible_deployments(failed=None):
+        # listing the deployments' pages as they're idled
+        time.sleep(0.05)
+        yield deployment
+
+    with patch('idler.eligible_deployments', side_effect=eligible_deployments), \
+            patch('idler.should_idle', return_value=False):
+        idler.idle_deployments()
+
+    durations = idler.PHASE_DURATION.values
+    assert durations[('eligible_deployments',)] >= 0.05
+    assert durations[('idle',)] < 0.05
+
+
+@pytest.mark.parametrize('memory, expected', [
+    ('0', 0),
+    ('1024', 1024),
+    ('128974848000m', 128974848),
+    ('500k', 500 * 10**3),
+    ('500K', 500 * 10**3),
+    ('5M', 5 * 10**6),
+    ('5G', 5 * 10**9),
+    ('2E', 2 * 10**18),
+    ('100Ki', 100 * 2**10),
+    ('512Mi', 512 * 2**20),
+    ('12Gi', 12 * 2**30),
+    ('1Ti', 2**40),
+    ('1Ei', 2**60),
+])
+def test_mem_val_with_unit_to_int(memory, expected):
+    assert idler.mem_val_with_unit_to_int(memory) == expected
+
+
+def mock_container_resources(requests, limits):
+    container = MagicMock()
+    container.resources.requests = requests
+    container.resources.limits = limits
+    return container
+
+
+def test_dry_run_writes_plan(client, deployment, env, metrics, tmp_path):
+    deployment.metadata.name = 'rstudio'
+    deployment.spec.template.spec.containers = [
+        mock_container_resources({'cpu': '200m', 'memory': '5Gi'}, {'cpu': '1500m', 'memory': '12Gi'}),
+        mock_container_resources(None, {'cpu': '100m', 'memory': '64Mi'}),
+    ]
+    busy = mock_deployment('busy', 'user-bob')
+    busy.metadata.labels = {'app': 'busy'}
+    busy.spec.replicas = 1
+    apps_api = client.AppsV1beta1Api.return_value
+    apps_api.list_deployment_for_all_namespaces.return_value.items = [
+        deployment, busy,
+    ]
+    plan_file = tmp_path / 'plan.jsonl'
+
+    busy.spec.template.spec.containers = [
+        mock_container_resources(None, {'cpu': '1000m', 'memory': '1Gi'}),
+    ]
+    usages = {'rstudio': 0, 'busy': 950}
+
+    with patch('idler.DRY_RUN', True), \
+            patch('idler.PLAN_FILE', str(plan_file)), \
+            patch('idler.cpu_usage', side_effect=lambda d, window=None: usages[d.metadata.name]):
+        idler.idle_deployments()
+
+    client.CoreV1Api.return_value.patch_namespaced_service.assert_not_called()
+    apps_api.patch_namespaced_deployment.assert_not_called()
+
+    plan = [json.loads(line) for line in plan_file.read_text().splitlines()]
+    assert plan == [
+        {
+            'app': 'rstudio',
+            'namespace': 'user-alice',
+            'deployment': 'rstudio',
+            'replicas': 2,
+            'cpu_percent': 0,
+            'cpu_usage': 0,
+            'threshold': idler.CPU_ACTIVITY_THRESHOLD,
+            'decision': 'idle',
+            'limits': {'cpu': 1500 + 100, 'memory': 12 * 2**30 + 64 * 2**20},
+            'reclaimed': {
+                'cpu': 2 * (200 + 100),
+                'memory': 2 * (5 * 2**30 + 64 * 2**20),
+            },
+        },
+        {
+            'app': 'busy',
+            'namespace': 'user-bob',
+            'deployment': 'busy',
+            'replicas': 1,
+            'cpu_percent': 95,
+            'cpu_usage': 950,
+            'threshold': idler.CPU_ACTIVITY_THRESHOLD,
+            'decision': 'keep',
+            'limits': {'cpu': 1000, 'memory': 2**30},
+            'reclaimed': {'cpu': 0, 'memory': 0},
+        },
+    ]
+
+
+def test_dry_run_plans_failures(env):
+    from io import StringIO
+
+    unlimited = mock_deployment('unlimited', 'user-alice')
+    unlimited.metadata.labels = {'app': 'unlimited'}
+    unlimited.spec.template.spec.containers = [
+        mock_container_resources(None, {'memory': '1Gi'}),
+    ]
+    busy = mock_deployment('busy', 'user-bob')
+    busy.metadata.labels = {'app': 'busy'}
+    busy.spec.replicas = 1
+    busy.spec.template.spec.containers = [
+        mock_container_resources(None, {'cpu': '1000m', 'memory': '1Gi'}),
+    ]
+    f = StringIO()
+
+    with patch('idler.cpu_usage', return_value=950):
+        failed = idler.write_plan_to(f, [unlimited, busy])
+
+    assert failed == ['(user-alice, unlimited)']
+    plan = [json.loads(line) for line in f.getvalue().splitlines()]
+    assert [entry['decision'] for entry in plan] == ['failed', 'keep']
+    assert plan[0]['error'] == 'No CPU limit set'
+
+
+def test_idle_deployments_sharded(client, deployment, env, metrics, tmp_path):
+    # user-alice is in shard 1 of 4, user-bob in shard 0
+    deployment.metadata.name = 'rstudio'
+    other = mock_deployment('rstudio', 'user-bob')
+    other.metadata.labels = {'app': 'rstudio'}
+    apps_api = client.AppsV1beta1Api.return_value
+    apps_api.list_deployment_for_all_namespaces.return_value.items = [
+        deployment, other,
+    ]
+    plan_file = tmp_path / 'plan.jsonl'
+
+    with patch('idler.SHARD_COUNT', 4), patch('idler.SHARD_INDEX', 1), \
+            patch('idler.DRY_RUN', True), \
+            patch('idler.PLAN_FILE', str(plan_file)), \
+            patch('idler.PUSHGATEWAY_URL', 'http://pushgateway:9091'), \
+            patch('idler.registry.push') as push, \
+            patch('idler.pods_lookup', {}), \
+            patch('idler.avg_cpu_percent', return_value=95):
+        idler.idle_deployments()
+        assert list(idler.pods_lookup) == [('rstudio-whatever-1234-abcde', 'user-alice')]
+
+    plan = [json.loads(line) for line in plan_file.read_text().splitlines()]
+    assert [(entry['namespace'], entry['shard']) for entry in plan] == [('user-alice', 1)]
+    push.assert_called_once_with('http://pushgateway:9091', job='idler', grouping_key={'shard': 1})
+
+
+def test_largest_first_to_free():
+    gib = 2 ** 30
+    usages = [
+        {'node-a': 6 * gib, 'node-b': 4 * gib},
+        {'node-a': 5 * gib},
+        {'node-b': 3 * gib},
+        {'node-a': 2 * gib},
+        {'node-c': 1 * gib, None: 8 * gib},
+    ]
+
+    # node-a: 0 (6+4 GiB) frees 6 GiB, then 1 frees 5 more
+    # node-b: 0 already frees 4 GiB, then 2 frees 3 more
+    # node-c: only 4 can free memory there
+    assert idler.largest_first_to_free(usages, 8 * gib) == [0, 1, 2, 4]
+    assert idler.largest_first_to_free(usages, 4 * gib) == [0, 4]
+    assert idler.largest_first_to_free(usages, 0) == []
+
+
+def mock_memory_deployment(name, node_memory):
+    deployment = mock_deployment(name, 'user-alice')
+    deployment.metadata.labels = {'app': name}
+    pods = {}
+    pods_metrics = []
+    for i, (node, memory) in enumerate(node_memory):
+        pod = idler.PodEntry(app=name, owner=None, start_time=None, phase='Running', node=node)
+        pod_metrics = mock_podmetric()
+        pod_metrics.metadata.name = f'{name}-{i}'
+        pod_metrics.metadata.namespace = 'user-alice'
+        pod_metrics.containers[0].usage['memory'] = memory
+        pods[(f'{name}-{i}', 'user-alice')] = pod
+        pods_metrics.append(pod_metrics)
+    return deployment, pods, {(name, 'user-alice'): pods_metrics}
+
+
+def test_select_by_memory():
+    pods = {}
+    metrics = {}
+    deployments = []
+    for name, node_memory in [
+            ('small', [('node-a', '1Gi')]),
+            ('busy', [('node-a', '20Gi')]),
+            ('large', [('node-a', '10Gi'), ('node-b', '2Gi')]),
+            ('medium', [('node-b', '4Gi')]),
+    ]:
+        deployment, deployment_pods, deployment_metrics = mock_memory_deployment(name, node_memory)
+        deployments.append(deployment)
+        pods.update(deployment_pods)
+        metrics.update(deployment_metrics)
+
+    def should_idle(deployment):
+        return deployment.metadata.name != 'busy'
+
+    with patch('idler.pods_lookup', pods), \
+            patch('idler.metrics_lookup', metrics), \
+            patch('idler.should_idle', side_effect=should_idle):
+        selected, failed = idler.select_by_memory(deployments)
+        assert [d.metadata.name for d in selected] == ['large', 'medium', 'small']
+        assert failed == []
+
+        with patch('idler.FREE_MEMORY_PER_NODE', 4):
+            selected, _ = idler.select_by_memory(deployments)
+            assert [d.metadata.name for d in selected] == ['large', 'medium']
+
+
+def test_dry_run_plans_memory_selection(tmp_path):
+    pods = {}
+    metrics = {}
+    deployments = []
+    for name, node_memory in [
+            ('small', [('node-a', '1Gi')]),
+            ('busy', [('node-a', '20Gi')]),
+            ('large', [('node-a', '10Gi'), ('node-b', '2Gi')]),
+            ('medium', [('node-b', '4Gi')]),
+    ]:
+        deployment, deployment_pods, deployment_metrics = mock_memory_deployment(name, node_memory)
+        deployment.spec.replicas = 1
+        deployments.append(deployment)
+        pods.update(deployment_pods)
+        metrics.update(deployment_metrics)
+    plan_file = tmp_path / 'plan.jsonl'
+    idler.DEPLOYMENTS.reset()
+
+    with patch('idler.IDLE_POLICY', 'memory'), \
+            patch('idler.FREE_MEMORY_PER_NODE', 4), \
+            patch('idler.DRY_RUN', True), \
+            patch('idler.PLAN_FILE', str(plan_file)), \
+            patch('idler.pods_lookup', pods), \
+            patch('idler.metrics_lookup', metrics), \
+            patch('idler.cpu_percent', return_value=0), \
+            patch('idler.should_idle', side_effect=lambda d: d.metadata.name != 'busy'):
+        assert idler.process(iter(deployments)) == []
+
+    plan = [json.loads(line) for line in plan_file.read_text().splitlines()]
+    # every deployment is planned, in order
+    assert [(entry['deployment'], entry['decision']) for entry in plan] == [
+        ('small', 'keep'),
+        ('busy', 'keep'),
+        ('large', 'idle'),
+        ('medium', 'idle'),
+    ]
+    counts = {labels[0][1]: value for _, labels, value in idler.DEPLOYMENTS.samples()}
+    assert counts == {'evaluated': 4, 'skipped': 2}
+
+
+def test_main_runs_the_idler_module():
+    import runpy
+
+    with patch('idler.main') as main:
+        runpy.run_path(idler.__file__, run_name='__main__')
+
+    # the state set by the run is the one `controller` and `async_client` see
+    main.assert_called_once_with()
@@ -0,0 +1,127 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import policies
+
+
+RULES = {
+    'rules': [
+        {'match': {'namespace': 'user-alice'}, 'threshold': 50},
+        {
+            'match': {'namespace_prefix': 'user-', 'labels': {'app': 'airflow'}},
+            'threshold': 20,
+            'window': 7200,
+        },
+        {'match': {'labels': {'app': 'jupyter-lab'}}, 'min_age': 3600},
+        {'match': {'annotations': {'example.com/owner': 'data'}}, 'schedule': '19:00-07:00'},
+        {'match': {'namespace_prefix': 'user-'}, 'threshold': 80},
+    ],
+}
+
+
+@pytest.fixture
+def rules():
+    return policies.compile_rules(RULES)
+
+
+@pytest.mark.parametrize('namespace, labels, annotations, expected', [
+    # first matching rule wins
+    ('user-alice', {'app': 'airflow'}, {}, 50),
+    ('user-bob', {'app': 'airflow'}, {}, 20),
+    ('user-bob', {'app': 'rstudio'}, {}, 80),
+    ('user-bob', {'app': 'jupyter-lab'}, {}, None),
+    ('team-data', {'app': 'rstudio'}, {}, None),
+])
+def test_lookup(rules, namespace, labels, annotations, expected):
+    assert rules.lookup(namespace, labels, annotations).threshold == expected
+
+
+def test_lookup_no_match(rules):
+    assert rules.lookup('kube-system', {'app': 'dns'}, {}) == policies.DEFAULT
+
+
+def test_lookup_annotations(rules):
+    policy = rules.lookup('team-data', {}, {'example.com/owner': 'data'})
+    assert policy.schedule.allows(datetime(2019, 1, 1, 23, 0))
+    assert not policy.schedule.allows(datetime(2019, 1, 1, 12, 0))
+
+
+def test_candidates_only_include_rules_which_could_match(rules):
+    assert rules.candidates('team-data', {'app': 'rstudio'}, {}) == []
+    assert rules.candidates('user-bob', {'app': 'rstudio'}, {}) == [1, 4]
+
+
+def test_with_defaults(rules):
+    policy = rules.lookup('user-bob', {'app': 'airflow'}, {})
+    assert policy.with_defaults(threshold=90, window=3600, min_age=0) == (
+        policies.Policy(threshold=20, window=7200, min_age=0, schedule=None, calendar=None))
+
+
+@pytest.mark.parametrize('time_range, allowed, denied', [
+    ('09:00-17:00', (9, 0), (17, 0)),
+    ('19:00-07:00', (6, 59), (7, 0)),
+    ('19:00-07:00', (19, 0), (18, 59)),
+])
+def test_schedule(time_range, allowed, denied):
+    schedule = policies.Schedule([time_range])
+    assert schedule.allows(datetime(2019, 1, 1, *allowed))
+    assert not schedule.allows(datetime(2019, 1, 1, *denied))
+
+
+@pytest.mark.parametrize('data', [
+    [],
+    {'rules': [{'match': {'name': 'rstudio'}}]},
+    {'rules': [{'threshold': 'high'}]},
+    {'rules': [{'schedule': '7pm-7am'}]},
+])
+def test_invalid_rules(data):
+    with pytest.raises(ValueError):
+        policies.compile_rules(data)
+
+
+def test_load(tmp_path):
+    path = tmp_path / 'policies.yaml'
+    path.write_text('rules:\n- match: {namespace: user-alice}\n  threshold: 50\n')
+
+    assert policies.load(str(path)).lookup('user-alice').threshold == 50
+
+
+CALENDARS = {
+    'calendars': {
+        'london': {
+            'timezone': 'Europe/London',
+            'hours': '08:00-19:00',
+            'holidays': ['2019-12-25'],
+        },
+        'sydney': {'timezone': 'Australia/Sydney'},
+    },
+    'default': {'calendar': 'london', 'threshold': 75},
+    'rules': [
+        {'match': {'namespace': 'user-bruce'}, 'calendar': 'sydney'},
+        {'match': {'namespace': 'user-alice'}, 'threshold': 50},
+    ],
+}
+
+
+def test_rules_fall_back_to_default_policy():
+    rules = policies.compile_rules(CALENDARS)
+
+    assert rules.lookup('user-alice').threshold == 50
+    assert rules.lookup('user-alice').calendar is rules.default.calendar
+    assert rules.lookup('user-bob').threshold == 75
+
+
+def test_any_allows():
+    rules = policies.compile_rules(dict(CALENDARS, rules=CALENDARS['rules'][1:]))
+    # 12:00 in London (BST) on a Monday, 21:00 in Sydney
+    assert not rules.any_allows(datetime(2019, 7, 1, 11, 0, tzinfo=timezone.utc))
+    assert rules.any_allows(datetime(2019, 7, 1, 19, 0, tzinfo=timezone.utc))
+
+    rules = policies.compile_rules(CALENDARS)
+    assert rules.any_allows(datetime(2019, 7, 1, 11, 0, tzinfo=timezone.utc))
+
+
+def test_unknown_calendar():
+    with pytest.raises(ValueError):
+        policies.compile_rules({'rules': [{'calendar': 'paris'}]})
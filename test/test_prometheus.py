@@ -0,0 +1,66 @@
+from unittest.mock import patch
+
+import prometheus
+
+
+def test_gauge():
+    gauge = prometheus.Gauge('idler_deployments', 'Deployments.', labelnames=['result'])
+    gauge.inc(result='idled')
+    gauge.inc(result='idled')
+    gauge.set(3, result='skipped')
+
+    assert gauge.render() == '\n'.join([
+        '# HELP idler_deployments Deployments.',
+        '# TYPE idler_deployments gauge',
+        'idler_deployments{result="idled"} 2.0',
+        'idler_deployments{result="skipped"} 3.0',
+    ])
+
+
+def test_histogram():
+    histogram = prometheus.Histogram('cpu_percent', 'CPU.', buckets=[10, 50])
+    for value in [5, 20, 70]:
+        histogram.observe(value)
+
+    assert histogram.render() == '\n'.join([
+        '# HELP cpu_percent CPU.',
+        '# TYPE cpu_percent histogram',
+        'cpu_percent_bucket{le="10.0"} 1.0',
+        'cpu_percent_bucket{le="50.0"} 2.0',
+        'cpu_percent_bucket{le="+Inf"} 3.0',
+        'cpu_percent_sum 95.0',
+        'cpu_percent_count 3.0',
+    ])
+
+
+def test_label_values_are_escaped():
+    gauge = prometheus.Gauge('g', 'G.', labelnames=['path'])
+    gauge.set(1, path='a"b\\c')
+
+    assert 'g{path="a\\"b\\\\c"} 1.0' in gauge.render()
+
+
+def test_registry_reset_and_write_textfile(tmp_path):
+    registry = prometheus.Registry()
+    gauge = registry.register(prometheus.Gauge('g', 'G.'))
+    gauge.set(1)
+    registry.reset()
+    gauge.set(2)
+
+    path = tmp_path / 'idler.prom'
+    registry.write_textfile(str(path))
+
+    assert path.read_text() == '# HELP g G.\n# TYPE g gauge\ng 2.0\n'
+
+
+def test_push():
+    registry = prometheus.Registry()
+    registry.register(prometheus.Gauge('g', 'G.')).set(1)
+
+    with patch('prometheus.urlopen') as urlopen:
+        registry.push('http://pushgateway:9091/', 'idler', {'shard': '0'})
+
+    request = urlopen.call_args[0][0]
+    assert request.full_url == 'http://pushgateway:9091/metrics/job/idler/shard/0'
+    assert request.get_method() == 'PUT'
+    assert request.data == registry.render().encode('utf-8')
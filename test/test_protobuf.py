@@ -0,0 +1,132 @@
+from datetime import datetime, timezone
+import json
+
+import pytest
+
+from benchmark import fake_apiserver
+import protobuf
+import records
+
+
+def field(number, payload):
+    """
+    Encodes a length-delimited (wire type 2) field.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return fake_apiserver.encode_field(number, 2, payload)
+
+
+def varint_field(number, value):
+    return fake_apiserver.encode_field(number, 0, value)
+
+
+def envelope(kind, raw, api_version='v1'):
+    # runtime.Unknown{typeMeta: {apiVersion, kind}, raw}
+    type_meta = field(1, api_version) + field(2, kind)
+    return protobuf.MAGIC + field(1, type_meta) + field(2, raw)
+
+
+# a PodList of one pod, as sent by the API server, with fields the records
+# don't hold (managedFields, volumes, a fixed64 and a fixed32 field) in the
+# way
+POD_LIST = envelope('PodList', b''.join([
+    # metadata: ListMeta{resourceVersion, continue}
+    field(1, field(2, '1234') + field(3, 'next')),
+    # items: Pod
+    field(2, b''.join([
+        field(1, b''.join([
+            field(1, 'rstudio-1234-abcde'),
+            field(3, 'user-alice'),
+            field(6, '42'),
+            # creationTimestamp: Time{seconds: 2019-01-01T12:00:00Z}
+            field(8, varint_field(1, 1546344000)),
+            # labels: {app: rstudio}
+            field(11, field(1, 'app') + field(2, 'rstudio')),
+            field(13, field(1, 'ReplicaSet') + field(3, 'rstudio-1234') + varint_field(6, 1)),
+            # managedFields
+            field(17, field(1, 'kubectl') + field(2, 'Update')),
+        ])),
+        field(2, b''.join([
+            # volumes
+            field(1, field(1, 'home')),
+            # terminationGracePeriodSeconds, as fixed64 and fixed32 fields
+            bytes([4 << 3 | 1]) + bytes(8),
+            bytes([5 << 3 | 5]) + bytes(4),
+            field(10, 'node-a'),
+        ])),
+        field(3, field(1, 'Running') + field(7, varint_field(1, 1546344060))),
+    ])),
+]))
+
+
+def test_decode_list():
+    page = protobuf.decode_list(POD_LIST, records.Pod)
+
+    assert page.metadata.resource_version == '1234'
+    assert page.metadata._continue == 'next'
+
+    [pod] = page.items
+    assert pod.metadata.name == 'rstudio-1234-abcde'
+    assert pod.metadata.namespace == 'user-alice'
+    assert pod.metadata.resource_version == '42'
+    assert pod.metadata.creation_timestamp == datetime(2019, 1, 1, 12, tzinfo=timezone.utc)
+    assert pod.metadata.labels == {'app': 'rstudio'}
+    assert pod.metadata.annotations is None
+    assert [(owner.kind, owner.name) for owner in pod.metadata.owner_references] == [
+        ('ReplicaSet', 'rstudio-1234'),
+    ]
+    assert pod.spec.node_name == 'node-a'
+    assert pod.status.phase == 'Running'
+    assert pod.status.start_time == datetime(2019, 1, 1, 12, 1, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize('kind, record', [
+    ('pods', records.Pod),
+    ('metrics', records.PodMetrics),
+    ('deployments', records.Deployment),
+])
+@pytest.mark.parametrize('metadata_only', [False, True])
+def test_decode_list_like_json(kind, record, metadata_only):
+    cluster = fake_apiserver.Cluster(apps=3)
+    body = cluster.list(kind, {'limit': ['2']}, metadata_only=metadata_only)
+
+    decoded = protobuf.decode_list(fake_apiserver.encode_list(kind, body), record)
+    expected = records.decode_list(json.dumps(body), record)
+
+    assert decoded.items == expected.items
+    assert decoded.metadata == expected.metadata
+
+
+def test_decode_empty_list():
+    page = protobuf.decode_list(envelope('PodList', b''), records.Pod)
+
+    assert page.items == []
+    assert page.metadata._continue is None
+
+
+@pytest.mark.parametrize('data, error', [
+    (b'{"items": []}', 'Not a Kubernetes protobuf message'),
+    (envelope('Status', field(1, '')), 'Expected a list'),
+    (protobuf.MAGIC + field(2, b'') + field(3, 'gzip'), 'Unsupported content encoding'),
+    (envelope('PodList', field(2, b'\x0a\x10abc')), 'Truncated message'),
+])
+def test_decode_invalid(data, error):
+    with pytest.raises(ValueError, match=error):
+        protobuf.decode_list(data, records.Pod)
+
+
+@pytest.mark.parametrize('content_type, expected', [
+    ('application/vnd.kubernetes.protobuf', True),
+    ('application/vnd.kubernetes.protobuf;stream=watch', True),
+    ('application/json', False),
+    (None, False),
+])
+def test_is_protobuf(content_type, expected):
+    assert protobuf.is_protobuf(content_type) == expected
+
+
+def test_int32():
+    assert protobuf.int32(3) == 3
+    # negative values are sign extended to 64 bits
+    assert protobuf.int32((1 << 64) - 1) == -1
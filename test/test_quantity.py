@@ -0,0 +1,72 @@
+from fractions import Fraction
+
+import pytest
+
+import quantity
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('0', 0),
+    ('1', 1),
+    ('1.5', Fraction(3, 2)),
+    ('.5', Fraction(1, 2)),
+    ('+2', 2),
+    ('-2', -2),
+    ('100m', Fraction(1, 10)),
+    ('250000u', Fraction(1, 4)),
+    ('500000000n', Fraction(1, 2)),
+    ('500k', 500000),
+    ('500K', 500000),
+    ('2M', 2 * 10**6),
+    ('1E', 10**18),
+    ('1e3', 1000),
+    ('1E3', 1000),
+    ('12e-3', Fraction(12, 1000)),
+    ('1.5Gi', 3 * 2**29),
+    ('64Mi', 64 * 2**20),
+    ('1Ei', 2**60),
+    (' 2Ki ', 2048),
+])
+def test_parse(value, expected):
+    assert quantity.parse(value) == expected
+
+
+@pytest.mark.parametrize('value', ['', 'm', '1.2.3', '1x', '1mi', '1Ki3', 'e3', '1e'])
+def test_parse_invalid(value):
+    with pytest.raises(ValueError):
+        quantity.parse(value)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2', 2000),
+    ('1.5', 1500),
+    ('100m', 100),
+    ('1n', 0.000001),
+    ('1500000n', 1.5),
+])
+def test_cpu_millicores(value, expected):
+    assert quantity.cpu_millicores(value) == expected
+
+
+def test_memory_bytes():
+    assert quantity.memory_bytes('128974848000m') == 128974848
+    assert quantity.memory_bytes('1.5Gi') == 3 * 2**29
+
+
+@pytest.mark.parametrize('value', [
+    '0', '2', '100m', '1n', '1425000000n', '250000u', '1k', '1Ki', '1.5', '1e3', ' 2 ', '-2',
+])
+def test_integer_fast_path(value):
+    # same results (and types) as parsing the quantity as a fraction
+    expected = quantity.to_number(quantity.parse(value) * 1000)
+    assert quantity.cpu_millicores(value) == expected
+    assert type(quantity.cpu_millicores(value)) is type(expected)
+    assert quantity.memory_bytes(value) == int(quantity.parse(value))
+
+
+@pytest.mark.parametrize('value', ['', 'm', '1x', '1mi', '1Ki3'])
+def test_fast_path_invalid(value):
+    with pytest.raises(ValueError):
+        quantity.cpu_millicores(value)
+    with pytest.raises(ValueError):
+        quantity.memory_bytes(value)
@@ -0,0 +1,91 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from kubernetes.client import ApiClient
+
+import metrics_api  # noqa: F401
+import records
+from benchmark import fake_apiserver
+
+
+@pytest.fixture
+def cluster():
+    return fake_apiserver.Cluster(apps=2)
+
+
+def decode_both(cluster, kind, response_type, record):
+    data = json.dumps(cluster.list(kind, {'limit': ['1']}))
+    model = ApiClient().deserialize(SimpleNamespace(data=data), response_type)
+    return model, records.decode_list(data, record)
+
+
+def test_decode_pods(cluster):
+    model, decoded = decode_both(cluster, 'pods', 'V1PodList', records.Pod)
+
+    assert decoded.metadata._continue == model.metadata._continue == 'user-0/rstudio-5d8c9b7f4-00000'
+    [pod], [expected] = decoded.items, model.items
+    assert pod.metadata.name == expected.metadata.name
+    assert pod.metadata.namespace == expected.metadata.namespace
+    assert pod.metadata.labels == expected.metadata.labels
+    assert pod.spec.node_name == expected.spec.node_name
+    assert pod.status.start_time == expected.status.start_time
+
+
+def test_decode_pod_metrics(cluster):
+    model, decoded = decode_both(
+        cluster, 'metrics', 'MetricsV1beta1PodMetricsList', records.PodMetrics)
+
+    [pod_metrics], [expected] = decoded.items, model.items
+    assert pod_metrics.metadata.name == expected.metadata.name
+    assert pod_metrics.timestamp == expected.timestamp
+    assert [c.usage for c in pod_metrics.containers] == [c.usage for c in expected.containers]
+
+
+def test_decode_deployments(cluster):
+    model, decoded = decode_both(
+        cluster, 'deployments', 'AppsV1beta1DeploymentList', records.Deployment)
+
+    [deployment], [expected] = decoded.items, model.items
+    assert deployment.metadata.creation_timestamp == expected.metadata.creation_timestamp
+    assert deployment.spec.replicas == expected.spec.replicas
+    [container] = deployment.spec.template.spec.containers
+    [expected_container] = expected.spec.template.spec.containers
+    assert container.resources.limits == expected_container.resources.limits
+    assert container.resources.requests == expected_container.resources.requests
+
+
+def test_sanitize_for_serialization(cluster):
+    data = json.dumps(cluster.list('pods', {}))
+    pod = records.decode_list(data, records.Pod).items[0]
+
+    serialized = ApiClient().sanitize_for_serialization(pod)
+    assert serialized['metadata']['name'] == pod.metadata.name
+    assert records.Pod.decode(serialized) == pod
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2019-01-01T12:00:00Z', '2019-01-01T12:00:00+00:00'),
+    ('2019-01-01T12:00:00.5+01:00', '2019-01-01T12:00:00.500000+01:00'),
+])
+def test_timestamp(value, expected):
+    assert records.timestamp(value).isoformat() == expected
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1024])
+def test_stream_list(cluster, chunk_size):
+    data = json.dumps(cluster.list('pods', {})).encode('utf-8')
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    page = records.stream_list(chunks, records.Pod)
+
+    assert list(page.items) == records.decode_list(data, records.Pod).items
+
+
+def test_stream_list_metadata_after_items():
+    data = b'{"items": [{"metadata": {"name": "a"}}], "metadata": {"continue": "x"}, "kind": "PodList"}'
+
+    page = records.stream_list([data[:30], data[30:]], records.Pod)
+
+    assert [pod.metadata.name for pod in page.items] == ['a']
+    assert page.metadata._continue == 'x'
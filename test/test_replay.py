@@ -0,0 +1,138 @@
+import gzip
+import json
+from unittest.mock import patch
+
+import pytest
+
+from benchmark.fake_apiserver import Cluster
+import idler
+import replay
+import snapshot
+
+
+def record_snapshot(path, **header):
+    # every other app is busy (95% CPU)
+    cluster = Cluster(apps=4)
+    recorder = snapshot.Recorder(path, lambda obj: obj, label_selector='foo', **header)
+    for i in range(cluster.apps):
+        recorder.record(snapshot.POD, cluster.pod(i))
+    for i in range(cluster.apps):
+        recorder.record(snapshot.POD_METRICS, cluster.pod_metrics(i))
+    for i in range(cluster.apps):
+        recorder.record(snapshot.DEPLOYMENT, cluster.deployment(i))
+    recorder.close()
+    return path
+
+
+@pytest.fixture
+def snapshot_path(tmp_path):
+    return record_snapshot(str(tmp_path / 'snapshot.jsonl.gz'))
+
+
+def test_read(snapshot_path):
+    header, objects = snapshot.read(snapshot_path)
+
+    assert header['version'] == snapshot.VERSION
+    assert header['label_selector'] == 'foo'
+    kinds = [kind for kind, _ in objects]
+    assert kinds == [snapshot.POD] * 4 + [snapshot.POD_METRICS] * 4 + [snapshot.DEPLOYMENT] * 4
+
+
+def test_read_not_a_snapshot(tmp_path):
+    path = tmp_path / 'not-a-snapshot.gz'
+    with gzip.open(str(path), 'wt') as f:
+        f.write('{"version": 42}\n')
+
+    with pytest.raises(ValueError):
+        snapshot.read(str(path))
+
+
+def test_replay_deployments(snapshot_path):
+    with patch('idler.pods_lookup', {}), patch('idler.metrics_lookup', {}):
+        _, deployments = replay.read(snapshot_path)
+        deployments = list(deployments)
+
+        assert [d.metadata.namespace for d in deployments] == [
+            'user-0', 'user-1', 'user-2', 'user-3',
+        ]
+        assert len(idler.pods_lookup) == 4
+        assert idler.metrics_lookup[('rstudio', 'user-1')][0].containers[0].usage == {
+            'cpu': '1500000n',
+            'memory': '3145728Ki',
+        }
+
+
+def test_summarize(snapshot_path):
+    with patch('idler.pods_lookup', {}), patch('idler.metrics_lookup', {}):
+        summary = replay.summarize(snapshot_path, thresholds=[50, 99])
+
+    assert summary[50] == {
+        'evaluated': 4,
+        'idled': 2,
+        'failed': 0,
+        'cpu': 2 * 200,
+        'memory': 2 * 5 * 2**30,
+    }
+    assert summary[99]['idled'] == 4
+    assert idler.CPU_ACTIVITY_THRESHOLD == 90
+
+
+def test_summarize_failures(snapshot_path):
+    def cpu_percent(deployment):
+        if deployment.metadata.namespace == 'user-1':
+            raise LookupError('No CPU limit set')
+        return 0
+
+    with patch('idler.pods_lookup', {}), patch('idler.metrics_lookup', {}), \
+            patch('idler.cpu_percent', side_effect=cpu_percent):
+        summary = replay.summarize(snapshot_path, thresholds=[50])
+
+    assert summary[50]['evaluated'] == 4
+    assert summary[50]['failed'] == 1
+    assert summary[50]['idled'] == 3
+def test_main(snapshot_path, capsys):
+    with patch('idler.pods_lookup', {}), patch('idler.metrics_lookup', {}):
+        replay.main(['--threshold', '50,99', snapshot_path])
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(line['threshold'], line['idled']) for line in lines] == [(50, 2), (99, 4)]
+
+
+def test_main_invalid_threshold(snapshot_path):
+    with pytest.raises(SystemExit):
+        replay.main(['--threshold', '50,high', snapshot_path])
+
+
+def test_main_uses_policies(snapshot_path, tmp_path, capsys):
+    policy_file = tmp_path / 'policies.yaml'
+    # user-0 is busy (95% CPU)
+    policy_file.write_text(
+        'rules:\n'
+        '  - match: {namespace: user-0}\n'
+        '    threshold: 99\n'
+    )
+
+    with patch('idler.pods_lookup', {}), patch('idler.metrics_lookup', {}), \
+            patch('idler.POLICY_FILE', str(policy_file)), patch('idler.rules', None):
+        replay.main(['--threshold', '50', snapshot_path])
+
+    [line] = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert line['idled'] == 3
+
+
+@pytest.mark.parametrize('recorded_at, idled', [
+    ('2019-01-07T03:00:00+00:00', 2),
+    # outside of the schedule
+    ('2019-01-07T12:00:00+00:00', 0),
+])
+def test_summarize_at_recorded_time(tmp_path, recorded_at, idled):
+    path = record_snapshot(str(tmp_path / 'snapshot.jsonl.gz'), recorded_at=recorded_at)
+    rules = idler.policies.compile_rules({'rules': [
+        {'match': {}, 'schedule': '19:00-07:00'},
+    ]})
+
+    with patch('idler.pods_lookup', {}), patch('idler.metrics_lookup', {}), \
+            patch('idler.rules', rules):
+        summary = replay.summarize(path, thresholds=[50])
+
+    assert summary[50]['idled'] == idled
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+import shards
+
+
+def test_shard_of():
+    # stable across processes and Python versions, unlike `hash()`
+    assert [shards.shard_of(namespace, 4) for namespace in [
+        'user-alice', 'user-bob', 'user-carol', 'user-dave',
+    ]] == [1, 0, 1, 2]
+    assert shards.shard_of('user-alice', 1) == 0
+
+
+def test_shard_of_spreads_namespaces():
+    counts = [0] * 4
+    for i in range(1000):
+        counts[shards.shard_of(f'user-{i}', 4)] += 1
+
+    assert all(200 < count < 300 for count in counts)
+
+
+def plan(namespace, shard, decision='idle', cpu=100, memory=1024):
+    return {
+        'namespace': namespace,
+        'shard': shard,
+        'decision': decision,
+        'reclaimed': {'cpu': cpu, 'memory': memory} if decision == 'idle' else {'cpu': 0, 'memory': 0},
+    }
+
+
+def test_merge():
+    report = shards.merge([
+        plan('user-bob', 0),
+        plan('user-alice', 1),
+        plan('user-carol', 1, decision='keep'),
+        plan('user-alice', 1),
+    ], count=2)
+
+    assert report['evaluated'] == 4
+    assert report['idled'] == 3
+    assert report['reclaimed'] == {'cpu': 300, 'memory': 3072}
+    assert report['shards']['0'] == {
+        'evaluated': 1, 'idled': 1, 'reclaimed': {'cpu': 100, 'memory': 1024},
+    }
+    assert report['shards']['1']['evaluated'] == 3
+
+
+@pytest.mark.parametrize('entries, count, error', [
+    ([plan('user-alice', 0), plan('user-alice', 1)], None, 'planned by shards 0 and 1'),
+    ([plan('user-alice', 1)], 3, 'Missing plans of shards 0, 2'),
+])
+def test_merge_invalid(entries, count, error):
+    with pytest.raises(ValueError, match=error):
+        shards.merge(entries, count=count)
+
+
+def test_main_merge(tmp_path, capsys):
+    paths = []
+    for shard, namespace in enumerate(['user-bob', 'user-alice']):
+        path = tmp_path / f'plan-{shard}.jsonl'
+        path.write_text(json.dumps(plan(namespace, shard)) + '\n')
+        paths.append(str(path))
+
+    shards.main(['merge', '--count', '2'] + paths)
+
+    report = json.loads(capsys.readouterr().out)
+    assert report['idled'] == 2
+    assert list(report['shards']) == ['0', '1']
+
+
+def test_main_which(capsys):
+    shards.main(['which', '--count', '4', 'user-alice', 'user-dave'])
+
+    assert capsys.readouterr().out == 'user-alice 1\nuser-dave 2\n'
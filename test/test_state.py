@@ -0,0 +1,87 @@
+import pytest
+
+import state
+
+
+KEY = ('rstudio', 'user-alice')
+
+
+@pytest.mark.parametrize('statistic, expected', [
+    ('mean', 30),
+    ('max', 90),
+    ('min', 0),
+    ('p50', 20),
+    ('p95', 90),
+])
+def test_window_statistic(statistic, expected):
+    assert state.window_statistic([20, 0, 90, 10, 30], statistic) == expected
+
+
+@pytest.mark.parametrize('statistic', ['median', 'pabc', 'p150', 'p-5'])
+def test_window_statistic_unknown(statistic):
+    with pytest.raises(ValueError):
+        state.window_statistic([1], statistic)
+
+
+def test_cpu_history_is_a_ring_buffer():
+    history = state.CpuHistory(size=3)
+    for usage in [10, 20, 30, 40]:
+        history.record(KEY, usage, timestamp=1000 + usage)
+
+    assert list(history.samples[KEY]) == [(1020, 20), (1030, 30), (1040, 40)]
+
+
+def test_cpu_history_statistic_window():
+    history = state.CpuHistory(size=10)
+    history.record(KEY, 500, timestamp=100)
+    history.record(KEY, 10, timestamp=900)
+    history.record(KEY, 30, timestamp=950)
+
+    assert history.statistic(KEY, 'max', window=200, now=1000) == 30
+    assert history.statistic(KEY, 'max', window=1000, now=1000) == 500
+    assert history.statistic(KEY, 'max', window=10, now=1000) is None
+    assert history.statistic(('other', 'user-bob'), 'max', 1000) is None
+
+
+def test_cpu_history_persistence(tmp_path):
+    path = str(tmp_path / 'cpu-history.json')
+    history = state.CpuHistory(size=2)
+    history.record(KEY, 10, timestamp=900)
+    history.record(('stale', 'user-bob'), 10, timestamp=100)
+
+    history.save(path, window=300, now=1000)
+    loaded = state.CpuHistory.load(path, size=2)
+
+    assert loaded.samples == {KEY: history.samples[KEY]}
+
+
+def test_load_missing_or_corrupted(tmp_path):
+    path = tmp_path / 'state.json'
+    assert state.load(str(path), default={}) == {}
+
+    path.write_text('{not json')
+    assert state.load(str(path), default={}) == {}
+
+
+def test_evaluations_unchanged():
+    evaluations = state.Evaluations()
+    evaluations.record(KEY, '42', idled=False, now=1000)
+
+    assert evaluations.unchanged(KEY, '42', grace=300, now=1200)
+    assert not evaluations.unchanged(KEY, '43', grace=300, now=1200)
+    assert not evaluations.unchanged(KEY, '42', grace=300, now=1400)
+
+    evaluations.record(KEY, '42', idled=True, now=1000)
+    assert not evaluations.unchanged(KEY, '42', grace=300, now=1200)
+
+
+def test_evaluations_save_drops_expired(tmp_path):
+    path = str(tmp_path / 'state.json')
+    evaluations = state.Evaluations()
+    evaluations.record(KEY, '42', idled=False, now=1000)
+    evaluations.record(('jupyter', 'user-bob'), '7', idled=False, now=100)
+    evaluations.save(path, grace=300, now=1200)
+
+    assert state.Evaluations.load(path).entries == {
+        KEY: {'resource_version': '42', 'evaluated_at': 1000, 'idled': False},
+    }